@@ -0,0 +1,209 @@
+import sys
+import time
+import pickle
+import tracemalloc
+import numpy as np
+from matcha.track import Track
+from matcha.track_point import TrackPoint
+from matcha.crthit import CRTHit
+from matcha.match_candidate import MatchCandidate
+"""
+Benchmark the slotted Track, TrackPoint, CRTHit and MatchCandidate against
+their former __dict__-based layout, kept below as it was so that both the
+memory and the construction times compare with the real former classes.
+
+Usage:
+    python scripts/benchmark_data_classes.py [N_OBJECTS]
+"""
+
+class LegacyTrack:
+    """
+    Track laid out as before __slots__: underscore attributes in an instance
+    __dict__, behind properties. Only used as a benchmark baseline.
+    """
+    def __init__(self, id, image_id, interaction_id, 
+                 points, depositions,
+                 start_x=None, start_y=None, start_z=None, 
+                 start_dir_x=None, start_dir_y=None, start_dir_z=None, 
+                 end_x=None, end_y=None, end_z=None,
+                 end_dir_x=None, end_dir_y=None, end_dir_z=None):
+        self._id = id
+        self._image_id       = image_id
+        self._interaction_id = interaction_id
+        self._points = points
+        self._depositions = depositions
+        self._start_x = start_x
+        self._start_y = start_y
+        self._start_z = start_z
+        self._start_dir_x = start_dir_x
+        self._start_dir_y = start_dir_y
+        self._start_dir_z = start_dir_z
+        self._end_x = end_x
+        self._end_y = end_y
+        self._end_z = end_z
+        self._end_dir_x = end_dir_x
+        self._end_dir_y = end_dir_y
+        self._end_dir_z = end_dir_z
+
+    @property
+    def start_x(self):
+        return self._start_x
+
+class LegacyTrackPoint:
+    """
+    TrackPoint laid out as before __slots__. Only used as a benchmark baseline.
+    """
+    def __init__(self, track_id,
+                 position_x, position_y, position_z,
+                 direction_x, direction_y, direction_z):
+        self._track_id    = track_id
+        self._position_x  = position_x
+        self._position_y  = position_y
+        self._position_z  = position_z
+        self._direction_x = direction_x
+        self._direction_y = direction_y
+        self._direction_z = direction_z
+        # The region helpers do not depend on the instance
+        self._tpc_region = TrackPoint._get_tpc_region(self, position_x)
+        self._drift_direction = TrackPoint._get_drift_direction(self, self._tpc_region)
+
+    @property
+    def position_x(self):
+        return self._position_x
+
+class LegacyCRTHit:
+    """
+    CRTHit laid out as before __slots__: underscore attributes in an instance
+    __dict__, behind properties. Only used as a benchmark baseline.
+    """
+    def __init__(self, id, t0_sec, t0_ns, t1_ns, 
+                 position_x, position_y, position_z, 
+                 error_x=0, error_y=0, error_z=0, 
+                 total_pe=-1, plane=-1, tagger=''):
+        self._id = id
+        self._total_pe = total_pe
+        self._t0_sec = t0_sec
+        self._t0_ns  = t0_ns
+        self._t1_ns = t1_ns
+        self._position_x = position_x
+        self._position_y = position_y
+        self._position_z = position_z
+        self._error_x = error_x
+        self._error_y = error_y
+        self._error_z = error_z
+        self._plane  = plane
+        self._tagger = tagger
+
+    @property
+    def position_x(self):
+        return self._position_x
+
+class LegacyMatchCandidate:
+    """
+    MatchCandidate laid out as before __slots__. Only used as a benchmark baseline.
+    """
+    def __init__(self, track_id, crthit_id, distance_of_closest_approach):
+        self._track_id  = track_id
+        self._crthit_id = crthit_id
+        self._distance_of_closest_approach = distance_of_closest_approach
+
+    @property
+    def distance_of_closest_approach(self):
+        return self._distance_of_closest_approach
+
+def benchmark_data_classes(n_objects=100_000, n_round_trip_objects=100):
+    """
+    Compare the memory footprint, pickle size, construction time and attribute
+    read time of the slotted Track, TrackPoint, CRTHit and MatchCandidate with
+    their former __dict__-based layout, and check that their pickles round trip.
+
+    Parameters:
+        n_objects (int, optional): Number of objects of each class to build. Default: 100_000
+        n_round_trip_objects (int, optional): Number of objects of each class whose
+                                              pickles are checked. Default: 100
+
+    Returns:
+        dict: Dictionary mapping 'Track', 'TrackPoint', 'CRTHit' and 'MatchCandidate' to
+              dictionaries with keys 'legacy_bytes_per_object', 'bytes_per_object',
+              'legacy_pickle_bytes_per_object', 'pickle_bytes_per_object',
+              'legacy_construct_seconds', 'construct_seconds', 'legacy_read_seconds' and
+              'read_seconds' (totals over n_objects), and 'round_trip' (True if pickled
+              objects load with the same attributes, and legacy pickles load with the
+              attributes of the legacy objects).
+    """
+    # Tracks get their own small point clouds, pickles store shared arrays only once
+    track_arguments = [(index, 0, 0, np.full((10, 3), index, dtype=float), np.ones(10),
+                        1., 2., 3., 0., 0., 1., 4., 5., 6., 0., 0., 1.) for index in range(n_objects)]
+    trackpoint_arguments = [(index, 100. + index % 200, 2., 3., 0., 0., 1.) for index in range(n_objects)]
+    crthit_arguments = [(index, 0, 1000. * index, 1000. * index, 1., 2., 3.) for index in range(n_objects)]
+    candidate_arguments = [(index, index, 0.5 * index) for index in range(n_objects)]
+    cases = {
+        'Track': (LegacyTrack, Track, track_arguments, 'start_x'),
+        'TrackPoint': (LegacyTrackPoint, TrackPoint, trackpoint_arguments, 'position_x'),
+        'CRTHit': (LegacyCRTHit, CRTHit, crthit_arguments, 'position_x'),
+        'MatchCandidate': (LegacyMatchCandidate, MatchCandidate, candidate_arguments, 'distance_of_closest_approach'),
+    }
+
+    def measure(cls, arguments, attribute):
+        start_time = time.perf_counter()
+        objects = [cls(*object_arguments) for object_arguments in arguments]
+        construct_seconds = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        for instance in objects: getattr(instance, attribute)
+        read_seconds = time.perf_counter() - start_time
+        pickle_bytes = len(pickle.dumps(objects, protocol=pickle.HIGHEST_PROTOCOL))
+        del objects
+
+        # Memory is traced in a separate pass, tracing slows construction down
+        tracemalloc.start()
+        objects = [cls(*object_arguments) for object_arguments in arguments]
+        allocated_bytes, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return allocated_bytes / len(objects), pickle_bytes / len(objects), construct_seconds, read_seconds
+
+    def is_same_state(state, other_state):
+        return state.keys() == other_state.keys() \
+            and all(np.array_equal(value, other_state[key]) if isinstance(value, np.ndarray)
+                    else value == other_state[key] for key, value in state.items())
+
+    def is_round_trip(legacy_cls, cls, arguments):
+        for object_arguments in arguments:
+            instance = cls(*object_arguments)
+            state = instance.__getstate__()
+            if not is_same_state(state, pickle.loads(pickle.dumps(instance)).__getstate__()):
+                return False
+            # Legacy pickles hold the __dict__ of the legacy object
+            legacy_state = legacy_cls(*object_arguments).__dict__
+            legacy_instance = cls.__new__(cls)
+            legacy_instance.__setstate__(pickle.loads(pickle.dumps(legacy_state)))
+            loaded_state = legacy_instance.__getstate__()
+            if not is_same_state(legacy_state, {key: loaded_state.get(key) for key in legacy_state}):
+                return False
+        return True
+
+    benchmark_results = {}
+    for name, (legacy_cls, cls, arguments, attribute) in cases.items():
+        legacy_bytes, legacy_pickle_bytes, legacy_construct_seconds, legacy_read_seconds = \
+            measure(legacy_cls, arguments, attribute)
+        slotted_bytes, pickle_bytes, construct_seconds, read_seconds = measure(cls, arguments, attribute)
+        benchmark_results[name] = {
+            'legacy_bytes_per_object': legacy_bytes,
+            'bytes_per_object': slotted_bytes,
+            'legacy_pickle_bytes_per_object': legacy_pickle_bytes,
+            'pickle_bytes_per_object': pickle_bytes,
+            'legacy_construct_seconds': legacy_construct_seconds,
+            'construct_seconds': construct_seconds,
+            'legacy_read_seconds': legacy_read_seconds,
+            'read_seconds': read_seconds,
+            'round_trip': is_round_trip(legacy_cls, cls, arguments[:n_round_trip_objects]),
+        }
+
+    return benchmark_results
+
+if __name__ == '__main__':
+    n_objects = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    for name, results in benchmark_data_classes(n_objects).items():
+        print(name)
+        for key, value in results.items():
+            print('   ', key, value)
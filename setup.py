@@ -16,12 +16,13 @@ setup(
     install_requires=['scikit-learn', 
                       'numpy', 
                       'scipy', 
-                      'pandas', 
-                      'plotly', 
-                      'matplotlib',
                       'pyyaml',
     ],
-    extras_require={'nbstripout': ['nbstripout']},
+    extras_require={'nbstripout': ['nbstripout'],
+                    'viz': ['pandas', 'plotly', 'matplotlib'],
+                    'io': ['h5py', 'pyarrow'],
+    },
+    entry_points={'console_scripts': ['matcha=matcha.cli:main']},
     python_requires='>=3.6',
     classifiers=[
         "Programming Language :: Python :: 3",
@@ -0,0 +1,158 @@
+import sys
+import copy
+import time
+import subprocess
+import numpy as np
+"""
+Benchmarks comparing optional fast paths with the default matcha behavior.
+"""
+
+# Dependencies that should only be imported on the code paths that use them
+HEAVY_MODULES = ['sklearn', 'scipy', 'pandas', 'plotly', 'matplotlib']
+
+def benchmark_voxelized_endpoints(tracks, pca_params, voxel_pitches):
+    """
+    Compare the end points estimated with voxelized global PCA against the
+    full-resolution result. Copies of the tracks are used, so the inputs are
+    not modified.
+
+    Parameters:
+        tracks (list): List of matcha.Track instances with points and depositions.
+        pca_params (dict): Dictionary of PCA parameters from loaded matcha config file
+        voxel_pitches (list): Voxel pitches (in cm) to benchmark.
+
+    Returns:
+        list: One dictionary per voxel pitch with keys 'voxel_pitch', 'seconds',
+              'speedup' (relative to full resolution), 'max_position_deviation' (cm),
+              'max_direction_deviation' (ignoring direction sign) and 'n_tracks_changed'
+              (number of tracks with a different start or end point).
+    """
+    full_resolution_params = dict(pca_params, voxel_pitch=0)
+    reference_seconds, reference_endpoints = time_track_endpoints(tracks, full_resolution_params)
+
+    benchmark_results = []
+    for voxel_pitch in voxel_pitches:
+        voxel_params = dict(pca_params, voxel_pitch=voxel_pitch)
+        seconds, endpoints = time_track_endpoints(tracks, voxel_params)
+        position_deviations = np.abs(endpoints[:, :, :3] - reference_endpoints[:, :, :3]).max(axis=(1, 2))
+        direction_deviations = np.minimum(
+            np.abs(endpoints[:, :, 3:] - reference_endpoints[:, :, 3:]).max(axis=2),
+            np.abs(endpoints[:, :, 3:] + reference_endpoints[:, :, 3:]).max(axis=2)
+        )
+        benchmark_results.append({
+            'voxel_pitch': voxel_pitch,
+            'seconds': seconds,
+            'speedup': reference_seconds / seconds if seconds > 0 else np.inf,
+            'max_position_deviation': float(position_deviations.max(initial=0.)),
+            'max_direction_deviation': float(direction_deviations.max(initial=0.)),
+            'n_tracks_changed': int(np.sum(position_deviations > 0)),
+        })
+
+    return benchmark_results
+
+def time_track_endpoints(tracks, pca_params):
+    """
+    Time Track.get_endpoints over copies of the tracks.
+
+    Parameters:
+        tracks (list): List of matcha.Track instances with points and depositions.
+        pca_params (dict): Dictionary of PCA parameters from loaded matcha config file
+
+    Returns:
+        tuple: Total time in seconds, and a numpy array of shape (n_tracks, 2, 6)
+               with the start and end positions and directions of each track.
+    """
+    track_copies = copy.deepcopy(tracks)
+    start_time = time.perf_counter()
+    track_points = [track.get_endpoints(pca_params) for track in track_copies]
+    seconds = time.perf_counter() - start_time
+
+    endpoints = np.array([
+        [[point.position_x, point.position_y, point.position_z,
+          point.direction_x, point.direction_y, point.direction_z] for point in points]
+        for points in track_points
+    ], dtype=np.float64).reshape(-1, 2, 6)
+
+    return seconds, endpoints
+
+def benchmark_event_latencies(events, config, percentiles=(50, 90, 99)):
+    """
+    Time get_track_best_matches event by event, to tune the per-track compute
+    budget (pca_parameters max_points and max_seconds). Copies of the events
+    are used, so the inputs are not modified. The first event is run once
+    beforehand so that lazy imports are not counted.
+
+    Parameters:
+        events (list): List of (image_id, tracks, crthits) tuples.
+        config (dict): Dictionary from parsing matcha config file
+        percentiles (tuple, optional): Latency percentiles to report. Default: (50, 90, 99)
+
+    Returns:
+        dict: Dictionary with keys 'n_events', 'latency_percentiles' (percentile to
+              seconds), 'max_latency' and 'mean_latency' (seconds), 'slowest_image_ids'
+              (up to five, slowest first) and 'n_fallback_tracks' (fallback name to
+              number of tracks, see Track.endpoint_fallback).
+    """
+    from .match_maker import get_track_best_matches
+
+    if events:
+        _, tracks, crthits = copy.deepcopy(events[0])
+        get_track_best_matches(tracks, crthits, config)
+
+    latencies, n_fallback_tracks = [], {}
+    for _, tracks, crthits in copy.deepcopy(events):
+        start_time = time.perf_counter()
+        get_track_best_matches(tracks, crthits, config)
+        latencies.append(time.perf_counter() - start_time)
+        for track in tracks:
+            if track.endpoint_fallback is None: continue
+            n_fallback_tracks[track.endpoint_fallback] = n_fallback_tracks.get(track.endpoint_fallback, 0) + 1
+
+    latencies = np.array(latencies)
+    slowest_events = np.argsort(latencies)[::-1][:5]
+    return {
+        'n_events': len(latencies),
+        'latency_percentiles': {percentile: float(np.percentile(latencies, percentile))
+                                for percentile in percentiles} if len(latencies) else {},
+        'max_latency': float(latencies.max()) if len(latencies) else 0.,
+        'mean_latency': float(latencies.mean()) if len(latencies) else 0.,
+        'slowest_image_ids': [events[i][0] for i in slowest_events],
+        'n_fallback_tracks': n_fallback_tracks,
+    }
+
+def benchmark_import_time(module='matcha.match_maker', n_repeats=5):
+    """
+    Time importing a module in fresh interpreters, the cost paid by every
+    short-lived worker process before doing any work.
+
+    Parameters:
+        module (str, optional): Module to import. Default: 'matcha.match_maker'
+        n_repeats (int, optional): Number of interpreters to time. Default: 5
+
+    Returns:
+        dict: Dictionary with keys 'interpreter_seconds' (median startup time of
+              an interpreter that imports nothing), 'import_seconds' (median extra 
+              time spent importing the module) and 'heavy_modules' (list of 
+              HEAVY_MODULES loaded as a side effect of the import).
+    """
+    def get_median_seconds(command):
+        durations = []
+        for _ in range(n_repeats):
+            start_time = time.perf_counter()
+            subprocess.run([sys.executable, '-c', command], check=True)
+            durations.append(time.perf_counter() - start_time)
+        return float(np.median(durations))
+
+    interpreter_seconds = get_median_seconds('pass')
+    module_seconds = get_median_seconds(f'import {module}')
+
+    check_command = (f'import sys, {module}; '
+                     f'print(",".join(name for name in {HEAVY_MODULES!r} if name in sys.modules))')
+    loaded_modules = subprocess.run([sys.executable, '-c', check_command], check=True,
+                                    capture_output=True, text=True).stdout.strip()
+
+    return {
+        'interpreter_seconds': interpreter_seconds,
+        'import_seconds': max(module_seconds - interpreter_seconds, 0.),
+        'heavy_modules': loaded_modules.split(',') if loaded_modules else [],
+    }
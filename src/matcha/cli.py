@@ -0,0 +1,100 @@
+import argparse
+from .sharding import build_manifest, run_shard, run_local, merge_shards, load_manifest, \
+                      get_shard_status, SHARDING_MODES, FILE_SHARDING
+from .columnar_store import convert_to_store
+from .service import serve, DEFAULT_SOCKET_PATH
+from .loader import load_config
+"""
+Command line interface of matcha, installed as the `matcha` command.
+
+    matcha manifest --config CONFIG --n-shards N --output MANIFEST INPUT [INPUT ...]
+    matcha run-shard MANIFEST SHARD_INDEX OUTPUT_DIR
+    matcha run-local MANIFEST OUTPUT_DIR [--n-processes N] [--shards I [I ...]]
+    matcha status MANIFEST OUTPUT_DIR
+    matcha merge MANIFEST OUTPUT_DIR [--file-path DIR] [--file-name NAME]
+    matcha convert STORE_DIR INPUT [INPUT ...] [--n-processes N] [--overwrite]
+    matcha serve --config CONFIG [--socket PATH] [--n-workers N]
+"""
+
+def main(argv=None):
+    """
+    Parse the command line and run the selected command.
+
+    Parameters:
+        argv (list, optional): Command line arguments. Default: None (sys.argv)
+
+    Returns:
+        int: Exit code.
+    """
+    parser = argparse.ArgumentParser(prog='matcha', description='Match CRT hits with TPC tracks.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    manifest_parser = subparsers.add_parser('manifest', help='Assign input files or events to shards')
+    manifest_parser.add_argument('input_files', nargs='+', help='Pickle files written by write_to_file')
+    manifest_parser.add_argument('--config', required=True, help='matcha config file')
+    manifest_parser.add_argument('--n-shards', type=int, required=True, help='Number of shards')
+    manifest_parser.add_argument('--output', required=True, help='Manifest json file to write')
+    manifest_parser.add_argument('--mode', choices=SHARDING_MODES, default=FILE_SHARDING,
+                                 help='Shard whole files or single events')
+
+    shard_parser = subparsers.add_parser('run-shard', help='Run the matcher on one shard')
+    shard_parser.add_argument('manifest')
+    shard_parser.add_argument('shard_index', type=int)
+    shard_parser.add_argument('output_dir')
+
+    local_parser = subparsers.add_parser('run-local', help='Run shards as local processes')
+    local_parser.add_argument('manifest')
+    local_parser.add_argument('output_dir')
+    local_parser.add_argument('--n-processes', type=int, default=None)
+    local_parser.add_argument('--shards', type=int, nargs='+', default=None,
+                              help='Shards to run. Default: the ones without a valid output')
+
+    status_parser = subparsers.add_parser('status', help='List missing, duplicated and failed shards')
+    status_parser.add_argument('manifest')
+    status_parser.add_argument('output_dir')
+
+    merge_parser = subparsers.add_parser('merge', help='Merge shard outputs in event order')
+    merge_parser.add_argument('manifest')
+    merge_parser.add_argument('output_dir')
+    merge_parser.add_argument('--file-path', default='./')
+    merge_parser.add_argument('--file-name', default='matcha_output.pkl')
+
+    convert_parser = subparsers.add_parser('convert', help='Convert pickle outputs to a columnar store')
+    convert_parser.add_argument('store_dir')
+    convert_parser.add_argument('input_files', nargs='+', help='Pickle files written by write_to_file')
+    convert_parser.add_argument('--n-processes', type=int, default=1)
+    convert_parser.add_argument('--overwrite', action='store_true',
+                                help='Convert files again even if their chunk exists')
+
+    serve_parser = subparsers.add_parser('serve', help='Run the matching service on a Unix socket')
+    serve_parser.add_argument('--config', required=True, help='matcha config file')
+    serve_parser.add_argument('--socket', default=DEFAULT_SOCKET_PATH, help='Path of the Unix socket')
+    serve_parser.add_argument('--n-workers', type=int, default=None, help='Number of worker processes')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'manifest':
+        build_manifest(args.input_files, args.n_shards, args.config, args.output, mode=args.mode)
+    elif args.command == 'run-shard':
+        run_shard(args.manifest, args.shard_index, args.output_dir)
+    elif args.command == 'run-local':
+        return_codes = run_local(args.manifest, args.output_dir, args.n_processes, args.shards)
+        return int(any(return_codes.values()))
+    elif args.command == 'status':
+        status = get_shard_status(load_manifest(args.manifest), args.output_dir)
+        print('completed:', len(status['completed']))
+        print('missing:', status['missing'])
+        print('duplicated:', status['duplicated'])
+        print('failed:', status['failed'])
+        return int(bool(status['missing'] or status['duplicated']))
+    elif args.command == 'merge':
+        print(merge_shards(args.manifest, args.output_dir, args.file_path, args.file_name))
+    elif args.command == 'convert':
+        convert_to_store(args.input_files, args.store_dir, args.n_processes, args.overwrite)
+    elif args.command == 'serve':
+        serve(load_config(args.config), args.socket, args.n_workers)
+
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,320 @@
+import os
+import json
+import shutil
+import pickle
+import tempfile
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from .readers import get_offsets, get_event_offsets
+"""
+Chunked columnar store for matcha pickle outputs.
+
+convert_to_store reads pickle files written by write_to_file one at a time
+and writes each one as a chunk directory of .npy columns, so that later
+queries memory-map only the columns they need instead of unpickling whole
+object graphs. Files are converted in parallel, each by its own process, and
+a chunk only appears under its final name once it is complete.
+
+Column names follow matcha.readers buffers. Per chunk:
+    tracks_<column>.npy: ids, image_ids, interaction_ids, point_offsets
+        (chunk-local, n_tracks + 1 entries), point_counts, deposition_sums,
+        endpoint_fallbacks ('' if the end points were fully estimated) and
+        start_positions, start_directions, end_positions, end_directions of
+        shape (n_tracks, 3), NaN where the end point was not stored
+    points_<column>.npy: points (n_points, 3) and depositions (n_points,)
+    crthits_<column>.npy: ids, image_ids, t0_sec, t0_ns, t1_ns, positions,
+        errors, total_pe, plane, tagger
+    matches_<column>.npy: track_ids, crthit_ids, dcas, image_ids
+    events_<column>.npy: event_image_ids and event_offsets into the tracks
+
+CRT hits in write_to_file outputs have no image_id; they are stored with
+image_id -1, meaning they belong to every event of the chunk, in file order.
+Match candidates only hold a track ID, so their image_id is that of the next
+track with this ID in file order, or -1 if there is none.
+
+index.json lists the chunks in input order with their row counts. Chunks
+written with another STORE_VERSION are converted again.
+"""
+
+# Bump this if the columns of a chunk change, so that stores are converted again
+STORE_VERSION = 2
+STORE_INDEX_NAME = 'index.json'
+CHUNK_META_NAME = 'meta.json'
+STORE_TABLES = ['tracks', 'points', 'crthits', 'matches', 'events']
+# Track attributes stored in each end point column
+TRACK_ENDPOINT_ATTRIBUTES = {
+    'start_positions': ['start_x', 'start_y', 'start_z'],
+    'start_directions': ['start_dir_x', 'start_dir_y', 'start_dir_z'],
+    'end_positions': ['end_x', 'end_y', 'end_z'],
+    'end_directions': ['end_dir_x', 'end_dir_y', 'end_dir_z'],
+}
+
+def convert_to_store(input_files, store_dir, n_processes=1, overwrite=False):
+    """
+    Convert pickle files written by write_to_file to a chunked columnar store.
+
+    Parameters:
+        input_files (list): Paths to the pickle files, one chunk each, in chunk order.
+        store_dir (str): Directory of the store, created if needed.
+        n_processes (int, optional): Number of files converted in parallel. Default: 1
+        overwrite (bool, optional): Convert files again even if their chunk exists.
+                                    Default: False, so an interrupted conversion resumes.
+
+    Returns:
+        dict: The store index.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    input_files = [os.path.abspath(file_path) for file_path in input_files]
+    chunk_names = [get_chunk_name(chunk_index) for chunk_index in range(len(input_files))]
+
+    pending = []
+    for file_path, chunk_name in zip(input_files, chunk_names):
+        chunk_meta = load_chunk_meta(store_dir, chunk_name)
+        if overwrite or chunk_meta is None or chunk_meta['source_file'] != file_path \
+           or chunk_meta.get('version') != STORE_VERSION:
+            pending.append((file_path, store_dir, chunk_name))
+
+    if n_processes > 1 and len(pending) > 1:
+        with ProcessPoolExecutor(max_workers=n_processes) as executor:
+            list(executor.map(convert_file_to_chunk, *zip(*pending)))
+    else:
+        for arguments in pending: convert_file_to_chunk(*arguments)
+
+    store_index = {
+        'version': STORE_VERSION,
+        'chunks': [load_chunk_meta(store_dir, chunk_name) for chunk_name in chunk_names],
+    }
+    with open(os.path.join(store_dir, STORE_INDEX_NAME), 'w') as file:
+        json.dump(store_index, file, indent=1)
+
+    print('Converted', len(pending), 'of', len(input_files), 'files to', store_dir)
+    return store_index
+
+def get_chunk_name(chunk_index):
+    """
+    Directory name of a chunk.
+
+    Parameters:
+        chunk_index (int): Index of the chunk.
+
+    Returns:
+        str: Chunk directory name.
+    """
+    return 'chunk_{:06d}'.format(chunk_index)
+
+def load_chunk_meta(store_dir, chunk_name):
+    """
+    Load the metadata of a chunk.
+
+    Parameters:
+        store_dir (str): Directory of the store.
+        chunk_name (str): Chunk directory name.
+
+    Returns:
+        dict: Chunk metadata, or None if the chunk does not exist.
+    """
+    meta_path = os.path.join(store_dir, chunk_name, CHUNK_META_NAME)
+    if not os.path.exists(meta_path): return None
+    with open(meta_path, 'r') as file:
+        return json.load(file)
+
+def convert_file_to_chunk(file_path, store_dir, chunk_name):
+    """
+    Convert one pickle file to a chunk. The columns are written to a temporary
+    directory which is renamed once complete.
+
+    Parameters:
+        file_path (str): Path to the pickle file.
+        store_dir (str): Directory of the store.
+        chunk_name (str): Chunk directory name.
+
+    Returns:
+        dict: Chunk metadata.
+    """
+    with open(file_path, 'rb') as file:
+        output_data = pickle.load(file)
+    chunk_columns = get_chunk_columns(output_data['tracks'], output_data['crthits'],
+                                      output_data.get('match_candidates', []))
+    del output_data
+
+    chunk_meta = {
+        'name': chunk_name,
+        'version': STORE_VERSION,
+        'source_file': file_path,
+        'n_events': len(chunk_columns['events']['event_image_ids']),
+        'n_tracks': len(chunk_columns['tracks']['ids']),
+        'n_points': len(chunk_columns['points']['points']),
+        'n_crthits': len(chunk_columns['crthits']['ids']),
+        'n_matches': len(chunk_columns['matches']['track_ids']),
+    }
+
+    temporary_dir = tempfile.mkdtemp(dir=store_dir, suffix='.tmp')
+    try:
+        for table, columns in chunk_columns.items():
+            for column, values in columns.items():
+                np.save(os.path.join(temporary_dir, '{:s}_{:s}.npy'.format(table, column)), values)
+        with open(os.path.join(temporary_dir, CHUNK_META_NAME), 'w') as file:
+            json.dump(chunk_meta, file, indent=1)
+        chunk_dir = os.path.join(store_dir, chunk_name)
+        if os.path.exists(chunk_dir): shutil.rmtree(chunk_dir)
+        os.replace(temporary_dir, chunk_dir)
+    except BaseException:
+        shutil.rmtree(temporary_dir, ignore_errors=True)
+        raise
+
+    return chunk_meta
+
+def get_chunk_columns(tracks, crthits, match_candidates):
+    """
+    Extract the columns of a chunk from matcha objects. Tracks are stored
+    grouped by image_id, in file order within an event, and CRT hits in file
+    order with image_id -1.
+
+    Parameters:
+        tracks (list): List of matcha.Track instances.
+        crthits (list): List of matcha.CRTHit instances.
+        match_candidates (list): List of matcha.MatchCandidate instances.
+
+    Returns:
+        dict: Dictionary mapping each of STORE_TABLES to a dictionary of columns.
+    """
+    match_image_ids = get_match_image_ids(match_candidates, tracks)
+    tracks = sorted(tracks, key=lambda track: int(track.image_id))
+    n_tracks = len(tracks)
+
+    point_counts = np.array([len(track.points) for track in tracks], dtype=np.int64)
+    point_dtype = np.result_type(*{track.points.dtype for track in tracks}) if tracks else np.float32
+    deposition_dtype = np.result_type(*{np.asarray(track.depositions).dtype for track in tracks}) \
+                       if tracks else np.float32
+    points = np.concatenate([track.points for track in tracks]).astype(point_dtype, copy=False) \
+             if tracks else np.empty((0, 3), dtype=point_dtype)
+    depositions = np.concatenate([np.asarray(track.depositions) for track in tracks]).astype(deposition_dtype, copy=False) \
+                  if tracks else np.empty(0, dtype=deposition_dtype)
+    point_offsets = get_offsets(point_counts)
+
+    track_columns = {
+        'ids': np.array([track.id for track in tracks], dtype=np.int64),
+        'image_ids': np.array([track.image_id for track in tracks], dtype=np.int64),
+        'interaction_ids': np.array([track.interaction_id for track in tracks], dtype=np.int64),
+        'point_offsets': point_offsets,
+        'point_counts': point_counts,
+        'deposition_sums': np.bincount(np.repeat(np.arange(n_tracks), point_counts),
+                                       weights=depositions, minlength=n_tracks),
+        'endpoint_fallbacks': np.array([track.endpoint_fallback or '' for track in tracks], dtype=np.str_),
+    }
+    for key, attributes in TRACK_ENDPOINT_ATTRIBUTES.items():
+        track_columns[key] = np.array([[np.nan if getattr(track, attribute) is None else getattr(track, attribute)
+                                        for attribute in attributes] for track in tracks],
+                                      dtype=np.float64).reshape(n_tracks, 3)
+
+    event_image_ids, event_offsets = get_event_offsets(track_columns['image_ids'])
+
+    crthit_columns = {
+        'ids': np.array([crthit.id for crthit in crthits], dtype=np.int64),
+        'image_ids': np.full(len(crthits), -1, dtype=np.int64),
+        't0_sec': np.array([crthit.t0_sec for crthit in crthits], dtype=np.float64),
+        't0_ns': np.array([crthit.t0_ns for crthit in crthits], dtype=np.float64),
+        't1_ns': np.array([crthit.t1_ns for crthit in crthits], dtype=np.float64),
+        'positions': np.array([[crthit.position_x, crthit.position_y, crthit.position_z]
+                               for crthit in crthits], dtype=np.float64).reshape(-1, 3),
+        'errors': np.array([[crthit.error_x, crthit.error_y, crthit.error_z]
+                            for crthit in crthits], dtype=np.float64).reshape(-1, 3),
+        'total_pe': np.array([crthit.total_pe for crthit in crthits], dtype=np.float64),
+        'plane': np.array([crthit.plane for crthit in crthits], dtype=np.int64),
+        'tagger': np.array([str(crthit.tagger) for crthit in crthits], dtype=np.str_),
+    }
+
+    match_columns = {
+        'track_ids': np.array([candidate.track_id for candidate in match_candidates], dtype=np.int64),
+        'crthit_ids': np.array([candidate.crthit_id for candidate in match_candidates], dtype=np.int64),
+        'dcas': np.array([candidate.distance_of_closest_approach for candidate in match_candidates],
+                         dtype=np.float64),
+        'image_ids': match_image_ids,
+    }
+
+    return {
+        'tracks': track_columns,
+        'points': {'points': points, 'depositions': depositions},
+        'crthits': crthit_columns,
+        'matches': match_columns,
+        'events': {'event_image_ids': event_image_ids, 'event_offsets': event_offsets},
+    }
+
+def get_match_image_ids(match_candidates, tracks):
+    """
+    Assign match candidates to events. Matchers return candidates in track
+    order, so each candidate goes to the next track with its track ID.
+
+    Parameters:
+        match_candidates (list): List of matcha.MatchCandidate instances.
+        tracks (list): List of matcha.Track instances, in file order.
+
+    Returns:
+        numpy.ndarray: image_id of each candidate, -1 where no track follows.
+    """
+    image_ids = np.full(len(match_candidates), -1, dtype=np.int64)
+    track_index = 0
+    for i, candidate in enumerate(match_candidates):
+        search_index = track_index
+        while search_index < len(tracks) and tracks[search_index].id != candidate.track_id:
+            search_index += 1
+        if search_index == len(tracks): continue
+        image_ids[i] = tracks[search_index].image_id
+        track_index = search_index + 1
+
+    return image_ids
+
+def load_store_index(store_dir):
+    """
+    Load the index of a columnar store.
+
+    Parameters:
+        store_dir (str): Directory of the store.
+
+    Returns:
+        dict: Dictionary with keys 'version' and 'chunks'.
+    """
+    with open(os.path.join(store_dir, STORE_INDEX_NAME), 'r') as file:
+        store_index = json.load(file)
+    if store_index.get('version') != STORE_VERSION:
+        raise ValueError('Unsupported store version {} in {:s}, convert the inputs again with '
+                         'convert_to_store'.format(store_index.get('version'), store_dir))
+    return store_index
+
+def get_chunk_column(store_dir, chunk_name, table, column, mmap_mode='r'):
+    """
+    Memory-map one column of one chunk.
+
+    Parameters:
+        store_dir (str): Directory of the store.
+        chunk_name (str): Chunk directory name.
+        table (str): One of STORE_TABLES.
+        column (str): Column name.
+        mmap_mode (str, optional): numpy.load memory-map mode. Default: 'r'
+
+    Returns:
+        numpy.ndarray: Memory-mapped column.
+    """
+    if table not in STORE_TABLES:
+        raise ValueError('Invalid table {:s}, must be one of {}'.format(str(table), STORE_TABLES))
+    column_path = os.path.join(store_dir, chunk_name, '{:s}_{:s}.npy'.format(table, column))
+    return np.load(column_path, mmap_mode=mmap_mode)
+
+def read_store_column(store_dir, table, column, chunk_indices=None):
+    """
+    Read one column across chunks. Only the bytes of this column are read.
+
+    Parameters:
+        store_dir (str): Directory of the store.
+        table (str): One of STORE_TABLES.
+        column (str): Column name.
+        chunk_indices (list, optional): Chunks to read. Default: None (all chunks)
+
+    Returns:
+        numpy.ndarray: Column values of the selected chunks, back to back. Offset
+                       columns (point_offsets, event_offsets) stay chunk-local.
+    """
+    chunks = load_store_index(store_dir)['chunks']
+    if chunk_indices is None: chunk_indices = range(len(chunks))
+    return np.concatenate([get_chunk_column(store_dir, chunks[i]['name'], table, column)
+                           for i in chunk_indices])
@@ -0,0 +1,81 @@
+import os
+import csv
+import functools
+import numpy as np
+"""
+Module to load the CRT wall geometry and assign CRT hits to walls.
+"""
+
+# Project root, three directories up from src/matcha/crt_geometry.py
+MATCHA_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DEFAULT_CRT_GEOMETRY_PATH = "{:s}/data/crt_geometry.csv".format(MATCHA_DIR)
+
+REGION_ID_COLUMN   = 'Region #'
+REGION_NAME_COLUMN = 'Region Name'
+MIN_COLUMNS = ['Xmin (cm)', 'Ymin (cm)', 'Zmin (cm)']
+MAX_COLUMNS = ['Xmax (cm)', 'Ymax (cm)', 'Zmax (cm)']
+THIN_AXIS_COLUMN = 'thin range (x=0, y=1, z=2)'
+
+@functools.lru_cache(maxsize=None)
+def load_crt_geometry(file_path=DEFAULT_CRT_GEOMETRY_PATH):
+    """
+    Load the CRT wall geometry csv file. Results are cached per file path,
+    so the returned arrays must not be modified.
+
+    Parameters:
+        file_path (str, optional): Path to the CRT geometry csv file.
+                                   Default: DEFAULT_CRT_GEOMETRY_PATH
+
+    Returns:
+        dict: Dictionary with keys 'region_ids' (list of str), 'region_names'
+              (list of str), 'mins' and 'maxs' (each of shape (n_walls, 3), in cm),
+              'thin_axes' (shape (n_walls,)) and 'plane_positions' (shape (n_walls,),
+              the wall center along its thin axis in cm).
+    """
+    with open(file_path, 'r', newline='') as file:
+        rows = list(csv.DictReader(file))
+
+    corners_a = np.array([[float(row[column]) for column in MIN_COLUMNS] for row in rows]).reshape(-1, 3)
+    corners_b = np.array([[float(row[column]) for column in MAX_COLUMNS] for row in rows]).reshape(-1, 3)
+    # Some walls list their x range from larger to smaller magnitude
+    mins = np.minimum(corners_a, corners_b)
+    maxs = np.maximum(corners_a, corners_b)
+    thin_axes = np.array([int(row[THIN_AXIS_COLUMN]) for row in rows], dtype=np.int64)
+    wall_indices = np.arange(len(rows))
+    plane_positions = (mins[wall_indices, thin_axes] + maxs[wall_indices, thin_axes]) / 2
+
+    return {
+        'region_ids': [row[REGION_ID_COLUMN] for row in rows],
+        'region_names': [row[REGION_NAME_COLUMN] for row in rows],
+        'mins': mins,
+        'maxs': maxs,
+        'thin_axes': thin_axes,
+        'plane_positions': plane_positions,
+    }
+
+def get_crthit_walls(crthit_positions, crt_geometry, wall_tolerance):
+    """
+    Assign each CRT hit to the closest CRT wall.
+
+    Parameters:
+        crthit_positions (numpy.ndarray): CRT hit positions of shape (N, 3).
+        crt_geometry (dict): Output of load_crt_geometry.
+        wall_tolerance (float): Largest distance (in cm) between a hit and the
+                                box of its wall. Hits farther than this from
+                                every wall are not assigned.
+
+    Returns:
+        numpy.ndarray: Wall index of each hit, shape (N,), or -1 if unassigned.
+    """
+    if len(crthit_positions) == 0 or len(crt_geometry['thin_axes']) == 0:
+        return np.full(len(crthit_positions), -1, dtype=np.int64)
+
+    positions = crthit_positions[:, None, :]
+    outside_distance = np.maximum(np.maximum(crt_geometry['mins'] - positions,
+                                             positions - crt_geometry['maxs']), 0)
+    wall_distances = np.linalg.norm(outside_distance, axis=2)
+
+    crthit_walls = np.argmin(wall_distances, axis=1)
+    crthit_walls[wall_distances.min(axis=1) > wall_tolerance] = -1
+
+    return crthit_walls
@@ -0,0 +1,69 @@
+import numpy as np
+from .track_point import get_drift_velocity
+"""
+Analytic CRT-plane intersection matching.
+
+Instead of a distance of closest approach per CRT hit, the line through a
+track end point is intersected with the plane of each CRT wall, and hits are
+scored by their in-plane distance to the intersection point. The drift shift
+only moves the line along x, so for walls whose thin axis is y or z the
+intersection simply moves by the shift, and for walls whose thin axis is x
+the line parameter changes by -shift/direction_x. Intersections that fall
+outside the wall, enlarged by the wall tolerance, do not match.
+"""
+
+def calculate_crt_plane_distance_batch(track_point, crthit_positions, crthit_times,
+                                       crthit_walls, crt_geometry, dca_params, wall_tolerance=0.):
+    """
+    Calculate the in-plane distance between each CRT hit and the intersection
+    of the drift-shifted track end point line with the hit's CRT wall.
+
+    Parameters:
+        track_point (matcha.TrackPoint): Track end point from Track.get_endpoints()
+        crthit_positions (numpy.ndarray): CRT hit positions of shape (N, 3).
+        crthit_times (numpy.ndarray): CRT hit times in microseconds of shape (N,).
+        crthit_walls (numpy.ndarray): Wall index of each hit from get_crthit_walls,
+                                      of shape (N,), or -1 if unassigned.
+        crt_geometry (dict): Output of load_crt_geometry.
+        dca_params (dict): Loaded DCA parameters from matcha config file
+        wall_tolerance (float, optional): Largest distance (in cm) between the
+                                          intersection and the box of the wall. Default: 0
+
+    Returns:
+        numpy.ndarray: Distances of shape (N,). Hits without a wall, walls
+                       parallel to the track line and intersections outside
+                       the wall get np.inf.
+    """
+    isdata = dca_params['isdata']
+    distances = np.full(len(crthit_positions), np.inf)
+    has_wall = crthit_walls >= 0
+    if not has_wall.any(): return distances
+
+    position = np.array([track_point.position_x, track_point.position_y, track_point.position_z], dtype=float)
+    direction = np.array([track_point.direction_x, track_point.direction_y, track_point.direction_z], dtype=float)
+    thin_axes = crt_geometry['thin_axes']
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # One ray-plane solve per wall, for the unshifted end point
+        wall_steps = (crt_geometry['plane_positions'] - position[thin_axes]) / direction[thin_axes]
+
+        hit_walls = crthit_walls[has_wall]
+        hit_axes = thin_axes[hit_walls]
+        drift_shift = get_drift_velocity(isdata) * crthit_times[has_wall] * track_point.drift_direction
+        steps = wall_steps[hit_walls] - np.where(hit_axes == 0, drift_shift / direction[0], 0.)
+
+        intersections = position + steps[:, None] * direction
+        intersections[:, 0] += drift_shift
+
+    offsets = intersections - crthit_positions[has_wall]
+    offsets[np.arange(len(offsets)), hit_axes] = 0.
+    hit_distances = np.linalg.norm(offsets, axis=1)
+
+    # The thin axis of the intersection is on the plane by construction
+    with np.errstate(invalid='ignore'):
+        is_on_wall = ((intersections >= crt_geometry['mins'][hit_walls] - wall_tolerance)
+                      & (intersections <= crt_geometry['maxs'][hit_walls] + wall_tolerance))
+    is_on_wall[np.arange(len(is_on_wall)), hit_axes] = True
+    distances[has_wall] = np.where(np.isfinite(hit_distances) & is_on_wall.all(axis=1), hit_distances, np.inf)
+
+    return distances
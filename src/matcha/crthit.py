@@ -1,4 +1,29 @@
-class CRTHit:
+from .legacy_state import LegacyStateMixin
+
+# Time stamp modes of data, as fTSMode in the CRTUtils of icaruscode
+T0_TS_MODE = 0 # Time from t0_ns, relative to the trigger timestamp
+T1_TS_MODE = 1 # Time from t1_ns
+TS_MODES = (T0_TS_MODE, T1_TS_MODE)
+
+def get_ts_mode(dca_params):
+    """
+    Read the time stamp mode of data from the DCA parameters.
+
+    Parameters:
+        dca_params (dict): Loaded DCA parameters from matcha config file
+
+    Returns:
+        int: One of TS_MODES, T0_TS_MODE if it is not set.
+
+    Raises:
+        ValueError: If the time stamp mode is not one of TS_MODES.
+    """
+    ts_mode = dca_params.get('ts_mode', T0_TS_MODE)
+    if ts_mode not in TS_MODES:
+        raise ValueError('Unknown ts_mode {}, expected one of {}'.format(ts_mode, TS_MODES))
+    return ts_mode
+
+class CRTHit(LegacyStateMixin):
     """
     Class for storing CRT hit information
 
@@ -18,9 +43,11 @@ class CRTHit:
                                (TODO Find documentation on this)
         tagger (string, optional): String identifying CRT wall. Default: ''
                                    (TODO Find documentation on this)
+        constituent_ids (list): ids of the hits merged into this one by
+                                matcha.crthit_clustering, None if it was not merged.
 
     Methods:
-        get_time_in_microseconds(self, trigger_timestamp=None, isdata=False):
+        get_time_in_microseconds(self, trigger_timestamp=None, isdata=False, ts_mode=T0_TS_MODE):
             Get CRTHit time in microseconds from configured t0 values and
             trigger timestamp (only if running on data).
 
@@ -28,23 +55,32 @@ class CRTHit:
             ValueError: If isdata=True and trigger_timestamp is not provided.
         
     """
+    __slots__ = ('id', 'total_pe', 't0_sec', 't0_ns', 't1_ns', 'position_x', 'position_y',
+                 'position_z', 'error_x', 'error_y', 'error_z', 'plane', 'tagger', 'constituent_ids')
+
     def __init__(self, id, t0_sec, t0_ns, t1_ns, 
                  position_x, position_y, position_z, 
                  error_x=0, error_y=0, error_z=0, 
                  total_pe=-1, plane=-1, tagger=''):
-        self._id = id
-        self._total_pe = total_pe
-        self._t0_sec = t0_sec
-        self._t0_ns  = t0_ns
-        self._t1_ns = t1_ns
-        self._position_x = position_x
-        self._position_y = position_y
-        self._position_z = position_z
-        self._error_x = error_x
-        self._error_y = error_y
-        self._error_z = error_z
-        self._plane  = plane
-        self._tagger = tagger
+        self.id = id
+        self.total_pe = total_pe
+        self.t0_sec = t0_sec
+        self.t0_ns  = t0_ns
+        self.t1_ns = t1_ns
+        self.position_x = position_x
+        self.position_y = position_y
+        self.position_z = position_z
+        self.error_x = error_x
+        self.error_y = error_y
+        self.error_z = error_z
+        self.plane  = plane
+        self.tagger = tagger
+        self.constituent_ids = None
+
+    def __setstate__(self, state):
+        # Pickles written before constituent_ids existed do not set it
+        self.constituent_ids = None
+        super().__setstate__(state)
 
     def __str__(self):
         return (f"[CRTHit] ID {self.id}, total_pe {self.total_pe}\n\t"
@@ -53,99 +89,7 @@ class CRTHit:
                 f"err: ({self.error_x}, {self.error_y}, {self.error_z})\n\t"
                 f"plane self.plane{self.plane}, tagger {self.tagger}")
 
-    ### Getters and setters ###
-    @property
-    def id(self):
-        return self._id
-    @id.setter
-    def id(self, value):
-        self._id = value
-
-    @property
-    def total_pe(self):
-        return self._total_pe
-    @total_pe.setter
-    def total_pe(self, value):
-        self._total_pe = value
-
-    @property 
-    def t0_sec(self):
-        return self._t0_sec
-    @t0_sec.setter
-    def t0_sec(self, value):
-        self._t0_sec = value
-
-    @property 
-    def t0_ns(self):
-        return self._t0_ns
-    @t0_ns.setter
-    def t0_ns(self, value):
-        self._t0_ns = value
-
-    @property
-    def t1_ns(self):
-        return self._t1_ns
-    @t1_ns.setter
-    def t1_ns(self, value):
-        self._t1_ns = value
-
-    @property
-    def position_x(self):
-        return self._position_x
-    @position_x.setter
-    def position_x(self, value):
-        self._position_x = value
-
-    @property
-    def position_y(self):
-        return self._position_y
-    @position_y.setter
-    def position_y(self, value):
-        self._position_y = value
-
-    @property
-    def position_z(self):
-        return self._position_z
-    @position_z.setter
-    def position_z(self, value):
-        self._position_z = value
-
-    @property
-    def error_x(self):
-        return self._error_x
-    @error_x.setter
-    def error_x(self, value):
-        self._error_x = value
-
-    @property
-    def error_y(self):
-        return self._error_y
-    @error_y.setter
-    def error_y(self, value):
-        self._error_y = value
-
-    @property
-    def error_z(self):
-        return self._error_z
-    @error_z.setter
-    def error_z(self, value):
-        self._error_z = value
-
-    @property
-    def plane(self):
-        return self._plane
-    @plane.setter
-    def plane(self, value):
-        self._plane = value
-
-    @property
-    def tagger(self):
-        return self._tagger
-    @tagger.setter
-    def tagger(self, value):
-        self._tagger = value
-
-    def get_time_in_microseconds(self, trigger_timestamp=None, isdata=False):
+    def get_time_in_microseconds(self, trigger_timestamp=None, isdata=False, ts_mode=T0_TS_MODE):
         """
 		This method is a Python port of the GetCRTTime function in the CRTUtils of icaruscode.
 
@@ -153,6 +97,8 @@ class CRTHit:
             trigger_timestamp (float, optional): Timestamp of the trigger. Needed for data events but not MC,
                 where we assume a timestamp of 0. Default: None
             isdata (bool, optional): Boolean flag for running on data as opposed to MC. Default: False
+            ts_mode (int, optional): Time stamp mode of data, T1_TS_MODE takes the time from t1_ns.
+                Default: T0_TS_MODE
 
         Returns:
             float: The "actual" time in microseconds.
@@ -163,7 +109,7 @@ class CRTHit:
         if isdata:
             if not trigger_timestamp:
                 raise ValueError('If isdata=True, you need to provide a trigger_timestamp')
-            if self.fTSMode == 1:
+            if ts_mode == T1_TS_MODE:
                 crt_time = int(self.t1_ns) * 1e-3 
             else:
                 crt_time = float(self.t0_ns - (trigger_timestamp%1_000_000_000))/1e3
@@ -0,0 +1,280 @@
+import numpy as np
+from .crthit import CRTHit
+"""
+Coincidence clustering of CRT hits before matching.
+
+Overlapping CRT modules and adjacent strips can report several hits for a
+single muon crossing. Every duplicate is compared with every track end
+point, and the duplicates compete for the same track. The hits of an event
+are grouped by plane and tagger and sorted by their full timestamp, t0_sec
+and t0_ns. A sweep over each group seeds a cluster at the earliest
+unclustered hit, and adds the later hits within time_tolerance ns and
+space_tolerance cm of that seed. The hits of a
+cluster are then merged into one representative hit, see merge_crthits.
+cluster_crthit_buffers does the same on the CRT hit buffers of
+matcha.readers, which carry no tagger, so their hits are grouped by event
+and plane only.
+"""
+
+DEFAULT_SPACE_TOLERANCE = 20.
+DEFAULT_TIME_TOLERANCE = 20.
+
+def get_clustered_crthits(crthits, config, stats=None):
+    """
+    Cluster the CRT hits of an event if the crthit_clustering block of the
+    config is enabled, otherwise return them as they are.
+
+    Parameters:
+        crthits (list): List of matcha.CRTHit instances of one event.
+        config (dict): Dictionary from parsing matcha config file
+        stats (dict, optional): If provided, clustering counters are added to it,
+                                see cluster_crthits. Default: None
+
+    Returns:
+        list: List of matcha.CRTHit instances.
+    """
+    clustering_parameters = config.get('crthit_clustering') or {}
+    if not clustering_parameters.get('enabled', False):
+        return crthits
+
+    return cluster_crthits(crthits, clustering_parameters.get('space_tolerance', DEFAULT_SPACE_TOLERANCE),
+                           clustering_parameters.get('time_tolerance', DEFAULT_TIME_TOLERANCE), stats)
+
+def cluster_crthits(crthits, space_tolerance=DEFAULT_SPACE_TOLERANCE, time_tolerance=DEFAULT_TIME_TOLERANCE,
+                    stats=None):
+    """
+    Merge coincident CRT hits of one event. Hits that are not coincident with
+    any other hit are returned as they are.
+
+    Parameters:
+        crthits (list): List of matcha.CRTHit instances of one event.
+        space_tolerance (float, optional): Largest distance (cm) between a hit and the seed
+                                           of its cluster. Default: DEFAULT_SPACE_TOLERANCE
+        time_tolerance (float, optional): Largest time difference (ns) between a hit and the
+                                          seed of its cluster. Default: DEFAULT_TIME_TOLERANCE
+        stats (dict, optional): If provided, 'n_crthits' and 'n_crthit_clusters' are
+                                incremented and 'crthit_reduction_factor' is set to
+                                their ratio (1 without hits). Default: None
+
+    Returns:
+        list: List of matcha.CRTHit instances, one per cluster, in the order of
+              the first hit of each cluster.
+
+    Raises:
+        ValueError: If a tolerance is negative.
+    """
+    if space_tolerance < 0 or time_tolerance < 0:
+        raise ValueError('CRT hit clustering tolerances must be non-negative, got space_tolerance {} '
+                         'and time_tolerance {}'.format(space_tolerance, time_tolerance))
+
+    group_keys = {}
+    groups = np.array([group_keys.setdefault((crthit.plane, crthit.tagger), len(group_keys))
+                       for crthit in crthits], dtype=np.int64)
+    positions = np.array([[crthit.position_x, crthit.position_y, crthit.position_z]
+                          for crthit in crthits], dtype=float).reshape(-1, 3)
+    times_ns = get_crthit_time_keys([crthit.t0_sec for crthit in crthits], [crthit.t0_ns for crthit in crthits])
+    labels = get_crthit_cluster_labels(positions, times_ns, groups, space_tolerance, time_tolerance)
+
+    clusters = [[] for _ in range(labels.max() + 1 if len(labels) else 0)]
+    for crthit, label in zip(crthits, labels):
+        clusters[label].append(crthit)
+    clustered_crthits = [merge_crthits(cluster) for cluster in clusters]
+    add_clustering_stats(stats, len(crthits), len(clustered_crthits))
+
+    return clustered_crthits
+
+def get_clustered_crthit_buffers(crthit_buffers, config, stats=None):
+    """
+    Buffer counterpart of get_clustered_crthits.
+
+    Parameters:
+        crthit_buffers (dict): CRT hit buffers, see matcha.readers.get_crthit_buffers.
+        config (dict): Dictionary from parsing matcha config file
+        stats (dict, optional): If provided, clustering counters are added to it,
+                                see cluster_crthits. Default: None
+
+    Returns:
+        dict: CRT hit buffers.
+    """
+    clustering_parameters = config.get('crthit_clustering') or {}
+    if not clustering_parameters.get('enabled', False):
+        return crthit_buffers
+
+    return cluster_crthit_buffers(crthit_buffers,
+                                  clustering_parameters.get('space_tolerance', DEFAULT_SPACE_TOLERANCE),
+                                  clustering_parameters.get('time_tolerance', DEFAULT_TIME_TOLERANCE), stats)
+
+def cluster_crthit_buffers(crthit_buffers, space_tolerance=DEFAULT_SPACE_TOLERANCE,
+                           time_tolerance=DEFAULT_TIME_TOLERANCE, stats=None):
+    """
+    Merge coincident CRT hits of CRT hit buffers, as cluster_crthits does for
+    the hits of one event. Hits are grouped by image_id and plane, and each
+    cluster is merged as in merge_crthits, without the errors and
+    constituent_ids the buffers do not hold.
+
+    Parameters:
+        crthit_buffers (dict): CRT hit buffers, see matcha.readers.get_crthit_buffers.
+        space_tolerance (float, optional): See cluster_crthits. Default: DEFAULT_SPACE_TOLERANCE
+        time_tolerance (float, optional): See cluster_crthits. Default: DEFAULT_TIME_TOLERANCE
+        stats (dict, optional): If provided, clustering counters are added to it,
+                                see cluster_crthits. Default: None
+
+    Returns:
+        dict: CRT hit buffers with one hit per cluster, in the order of the first
+              hit of each cluster.
+
+    Raises:
+        ValueError: If a tolerance is negative.
+    """
+    if space_tolerance < 0 or time_tolerance < 0:
+        raise ValueError('CRT hit clustering tolerances must be non-negative, got space_tolerance {} '
+                         'and time_tolerance {}'.format(space_tolerance, time_tolerance))
+
+    n_crthits = len(crthit_buffers['ids'])
+    positions = np.asarray(crthit_buffers['positions'], dtype=float).reshape(-1, 3)
+    total_pes = np.asarray(crthit_buffers['total_pe'], dtype=float)
+    times_ns = get_crthit_time_keys(crthit_buffers['t0_sec'], crthit_buffers['t0_ns'])
+    group_keys = np.column_stack([crthit_buffers['image_ids'], crthit_buffers['plane']]).astype(np.int64)
+    groups = np.unique(group_keys, axis=0, return_inverse=True)[1].reshape(-1)
+    labels = get_crthit_cluster_labels(positions, times_ns, groups, space_tolerance, time_tolerance)
+    n_clusters = int(labels.max()) + 1 if n_crthits else 0
+
+    # The seed of each cluster has the largest total_pe, then the earliest time
+    # and the smallest index, as in merge_crthits
+    order = np.lexsort((np.arange(n_crthits), times_ns, -total_pes, labels))
+    seeds = order[np.searchsorted(labels[order], np.arange(n_clusters))]
+    cluster_sizes = np.bincount(labels, minlength=n_clusters)
+    is_merged = cluster_sizes > 1
+
+    is_weighted = np.bincount(labels, weights=total_pes <= 0, minlength=n_clusters) == 0
+    weights = np.where(is_weighted[labels], total_pes, 1.)
+    weighted_sums = np.zeros((n_clusters, 3))
+    np.add.at(weighted_sums, labels, weights[:, None] * positions)
+    merged_positions = weighted_sums / np.bincount(labels, weights=weights, minlength=n_clusters)[:, None]
+    is_known = total_pes >= 0
+    merged_total_pes = np.where(np.bincount(labels, weights=is_known, minlength=n_clusters) > 0,
+                                np.bincount(labels, weights=np.where(is_known, total_pes, 0.), minlength=n_clusters),
+                                -1.)
+
+    clustered_buffers = {key: np.asarray(values)[seeds] for key, values in crthit_buffers.items()}
+    clustered_buffers['positions'] = np.where(is_merged[:, None], merged_positions, positions[seeds]) \
+                                       .astype(np.asarray(crthit_buffers['positions']).dtype, copy=False)
+    clustered_buffers['total_pe'] = np.where(is_merged, merged_total_pes, total_pes[seeds])
+    add_clustering_stats(stats, n_crthits, n_clusters)
+
+    return clustered_buffers
+
+def add_clustering_stats(stats, n_crthits, n_crthit_clusters):
+    """
+    Add the counters of one clustering call to stats, see cluster_crthits.
+
+    Parameters:
+        stats (dict): Statistics dictionary, or None to skip.
+        n_crthits (int): Number of CRT hits before clustering.
+        n_crthit_clusters (int): Number of CRT hits after clustering.
+
+    Returns: None
+        This function does not return any value.
+    """
+    if stats is None: return
+    stats['n_crthits'] = stats.get('n_crthits', 0) + n_crthits
+    stats['n_crthit_clusters'] = stats.get('n_crthit_clusters', 0) + n_crthit_clusters
+    stats['crthit_reduction_factor'] = stats['n_crthits'] / stats['n_crthit_clusters'] \
+                                       if stats['n_crthit_clusters'] else 1.
+
+def get_crthit_time_keys(t0_sec, t0_ns):
+    """
+    Full CRT hit timestamps in nanoseconds, t0_sec*1e9 + t0_ns, counted from
+    the earliest second of the hits. Hits in different seconds are thus never
+    coincident, and the offsets stay small enough for double precision to
+    keep every nanosecond.
+
+    Parameters:
+        t0_sec (numpy.ndarray): CRT hit t0_sec, shape (n_hits,).
+        t0_ns (numpy.ndarray): CRT hit t0_ns, shape (n_hits,).
+
+    Returns:
+        numpy.ndarray: Timestamps (ns) as float64, shape (n_hits,).
+    """
+    t0_sec = np.asarray(t0_sec, dtype=np.float64)
+    t0_ns = np.asarray(t0_ns, dtype=np.float64)
+    if len(t0_sec) == 0:
+        return t0_ns
+    return (t0_sec - t0_sec.min()) * 1e9 + t0_ns
+
+def get_crthit_cluster_labels(positions, times_ns, groups, space_tolerance, time_tolerance):
+    """
+    Group CRT hits around seeds. Each group is swept in time order: the
+    earliest unclustered hit seeds a cluster, which takes every later
+    unclustered hit of the group whose time is at most time_tolerance after
+    the seed's and whose position is at most space_tolerance from the seed's.
+    Hits are not linked to each other, so a chain of nearby hits cannot grow a
+    cluster beyond the tolerances around its seed.
+
+    Parameters:
+        positions (numpy.ndarray): CRT hit positions, shape (n_hits, 3).
+        times_ns (numpy.ndarray): CRT hit times (ns), see get_crthit_time_keys, shape (n_hits,).
+        groups (numpy.ndarray): Group (plane and tagger) index of each hit, shape (n_hits,).
+        space_tolerance (float): Largest distance (cm) between a hit and its seed.
+        time_tolerance (float): Largest time difference (ns) between a hit and its seed.
+
+    Returns:
+        numpy.ndarray: Cluster label of each hit, shape (n_hits,), numbered in the
+                       order of the first hit of each cluster.
+    """
+    seeds = np.full(len(times_ns), -1, dtype=np.int64)
+    for group in np.unique(groups):
+        group_indices = np.flatnonzero(groups == group)
+        group_indices = group_indices[np.argsort(times_ns[group_indices], kind='stable')]
+        group_times_ns = times_ns[group_indices]
+        window_ends = np.searchsorted(group_times_ns, group_times_ns + time_tolerance, side='right')
+        for first, window_end in enumerate(window_ends):
+            seed = group_indices[first]
+            if seeds[seed] >= 0: continue
+            seeds[seed] = seed
+            window_indices = group_indices[first + 1:window_end]
+            window_indices = window_indices[seeds[window_indices] < 0]
+            distances = np.linalg.norm(positions[window_indices] - positions[seed], axis=1)
+            seeds[window_indices[distances <= space_tolerance]] = seed
+
+    # Number the clusters by their smallest hit index, to follow the input order
+    first_hits = np.full(len(seeds), len(seeds), dtype=np.int64)
+    np.minimum.at(first_hits, seeds, np.arange(len(seeds)))
+    return np.unique(first_hits[seeds], return_inverse=True)[1].astype(np.int64).reshape(-1)
+
+def merge_crthits(crthits):
+    """
+    Merge coincident CRT hits into one representative hit. It takes the id,
+    times, plane and tagger of the hit with the largest total_pe (the earliest
+    one if several have the same total_pe), and its position is the
+    PE-weighted mean of the hit positions (unweighted if a hit has no PE).
+    Its error along each axis is the weighted root mean square of the hit
+    errors and of the hit offsets from that mean, and its total_pe is the sum
+    of the known total_pe values (-1 if none is known). The ids of the merged
+    hits (or of their own constituents) are kept in its constituent_ids.
+
+    Parameters:
+        crthits (list): List of coincident matcha.CRTHit instances.
+
+    Returns:
+        matcha.CRTHit: The representative hit, or the only hit of crthits.
+    """
+    if len(crthits) == 1:
+        return crthits[0]
+
+    seed = max(crthits, key=lambda crthit: (crthit.total_pe, -crthit.t0_sec, -crthit.t0_ns))
+    positions = np.array([[crthit.position_x, crthit.position_y, crthit.position_z] for crthit in crthits],
+                         dtype=float)
+    errors = np.array([[crthit.error_x, crthit.error_y, crthit.error_z] for crthit in crthits], dtype=float)
+    total_pes = np.array([crthit.total_pe for crthit in crthits], dtype=float)
+
+    weights = total_pes if (total_pes > 0).all() else np.ones(len(crthits))
+    position = np.average(positions, axis=0, weights=weights)
+    error = np.sqrt(np.average(errors**2 + (positions - position)**2, axis=0, weights=weights))
+    known_total_pes = total_pes[total_pes >= 0]
+    total_pe = float(known_total_pes.sum()) if len(known_total_pes) else -1
+
+    merged_crthit = CRTHit(seed.id, seed.t0_sec, seed.t0_ns, seed.t1_ns, *position.tolist(), *error.tolist(),
+                           total_pe=total_pe, plane=seed.plane, tagger=seed.tagger)
+    merged_crthit.constituent_ids = [id for crthit in crthits for id in crthit.constituent_ids or [crthit.id]]
+    return merged_crthit
@@ -0,0 +1,662 @@
+import numpy as np
+from .track import NATIVE_PRECISION
+from .track_point import get_drift_velocity, get_drift_directions
+from .match_candidate import MatchCandidate
+from .dca_methods import get_crthit_columns, get_max_tile_pairs, get_yz_pruning_mask, get_top_k, \
+                         get_top_k_check_interval, get_unshifted_distances, DCA_BYTES_PER_PAIR
+from .endpoint_cache import get_endpoint_cache
+from .match_maker import get_track_endpoints, get_matching_method
+from .crthit_clustering import get_clustered_crthits
+"""
+Dataset-wide matching of every event in a single vectorized call.
+
+Tracks and CRT hits from all events are stored as flat columns with an
+image_id column. Both are sorted by event, every track is paired with the
+hits of its own event, the DCA of every pair is calculated at once, and the
+per-track best matches are found with segmented reductions over the pairs.
+This avoids the per-event (and per-track) Python overhead of
+get_track_crthit_matches, which dominates for small events, while giving
+the same matches.
+"""
+
+# Optional track columns flagging single precision end point values
+TRACK_PRECISION_KEYS = ['start_single_positions', 'start_single_directions',
+                        'end_single_positions', 'end_single_directions']
+# Per end point terms that get_pair_terms indexes for each pair
+ENDPOINT_TERM_KEYS = ['positions', 'directions', 'denominators', 'drift_directions',
+                      'single_positions', 'single_sums']
+
+def get_dataset_columns(events, config, stats=None):
+    """
+    Build flat track and CRT hit columns from per-event lists of Track and
+    CRTHit instances. Track end points are estimated if they are not provided,
+    and the CRT hits of each event are clustered if crthit_clustering is enabled.
+
+    Parameters:
+        events (iterable): Iterable of (image_id, tracks, crthits) tuples.
+        config (dict): Dictionary from parsing matcha config file
+        stats (dict, optional): If provided, CRT hit clustering counters are added
+                                to it, see matcha.crthit_clustering. Default: None
+
+    Returns:
+        tuple: Track columns (see get_track_columns) and CRT hit columns (see
+               get_crthit_columns) with an extra 'image_ids' column.
+    """
+    endpoint_cache = get_endpoint_cache(config)
+
+    all_tracks, all_crthits, crthit_image_ids, crthit_counts = [], [], [], []
+    for image_id, tracks, crthits in events:
+        crthits = get_clustered_crthits(crthits, config, stats)
+        all_tracks.extend(tracks)
+        all_crthits.extend(crthits)
+        crthit_image_ids.append(image_id)
+        crthit_counts.append(len(crthits))
+
+    track_columns = get_track_columns(all_tracks, config['pca_parameters'], endpoint_cache)
+    crthit_columns = get_crthit_columns(all_crthits, config['dca_parameters'])
+    crthit_columns['image_ids'] = np.repeat(np.array(crthit_image_ids, dtype=np.int64), crthit_counts)
+
+    return track_columns, crthit_columns
+
+def get_track_columns(tracks, pca_parameters, endpoint_cache=None):
+    """
+    Gather track IDs, image IDs and end points into flat numpy arrays.
+
+    Parameters:
+        tracks (list): List of matcha.Track instances.
+        pca_parameters (dict): Dictionary of PCA parameters from loaded matcha config file
+        endpoint_cache (EndpointCache, optional): On-disk cache of estimated end points.
+                                                  Default: None (no caching)
+
+    Returns:
+        dict: Dictionary with keys 'ids' and 'image_ids' (shape (N,)),
+              'start_positions', 'start_directions', 'end_positions' and
+              'end_directions' (shape (N, 3), double precision), and
+              TRACK_PRECISION_KEYS (shape (N,), True where the end point held
+              the value in single precision, see get_endpoint_terms).
+    """
+    track_points = [get_track_endpoints(track, pca_parameters, endpoint_cache) for track in tracks]
+
+    # Positions and directions of both end points, shape (N, 2, 6)
+    endpoints = np.array([
+        [[point.position_x, point.position_y, point.position_z,
+          point.direction_x, point.direction_y, point.direction_z]
+         for point in points]
+        for points in track_points
+    ], dtype=np.float64).reshape(-1, 2, 6)
+
+    def get_single_precision_mask(index, attribute):
+        return np.array([np.asarray(getattr(points[index], attribute)).dtype == np.float32
+                         for points in track_points], dtype=bool)
+
+    return {
+        'ids': np.array([track.id for track in tracks]),
+        'image_ids': np.array([track.image_id for track in tracks], dtype=np.int64),
+        'start_positions': endpoints[:, 0, :3],
+        'start_directions': endpoints[:, 0, 3:],
+        'end_positions': endpoints[:, 1, :3],
+        'end_directions': endpoints[:, 1, 3:],
+        'start_single_positions': get_single_precision_mask(0, 'position_x'),
+        'start_single_directions': get_single_precision_mask(0, 'direction_x'),
+        'end_single_positions': get_single_precision_mask(1, 'position_x'),
+        'end_single_directions': get_single_precision_mask(1, 'direction_x'),
+    }
+
+def get_dataset_track_best_matches(track_columns, crthit_columns, config, stats=None):
+    """
+    Find the best CRT hit of every track in the dataset. Each track is only
+    compared with the CRT hits sharing its image_id.
+
+    The DCA is calculated exactly as in get_track_crthit_dcas, so the result
+    is the same as calling get_track_best_matches event by event.
+
+    Track/CRT hit pairs are evaluated in tiles of at most get_max_tile_pairs
+    pairs, so that dca_parameters.memory_budget_mb bounds the working set.
+    A tile holds whole events, or a slice of the hits of a single track in
+    very large events, and only the running best DCA of each track is kept.
+    With dca_parameters.top_k, the hits of a split track are ranked over all
+    of its slices first, see get_split_track_top_k_hits. With
+    dca_parameters.top_k_check_interval, one track in that many (except split
+    tracks) is also matched with every hit, see get_top_k_missed_tracks.
+
+    Parameters:
+        track_columns (dict): Output of get_track_columns.
+        crthit_columns (dict): Output of get_crthit_columns with an 'image_ids' column.
+        config (dict): Dictionary from parsing matcha config file
+        stats (dict, optional): If provided, filled with 'n_pairs', 'n_tiles',
+                                'peak_working_set_bytes' (estimated from the largest
+                                tile) and, with dca_parameters.yz_pruning and top_k,
+                                'n_pruned_pairs' and 'n_top_k_skipped_pairs'. With
+                                top_k_check_interval, 'n_top_k_checked_tracks' and
+                                'n_top_k_missed_tracks' are also set. Default: None
+
+    Returns:
+        dict: Dictionary with keys 'track_ids', 'image_ids', 'crthit_ids' and
+              'distances', each of shape (n_tracks,) in the input track order.
+              Tracks without a match below threshold have a crthit_id of -1
+              and a distance of np.inf.
+    """
+    if get_matching_method(config) != 'dca':
+        raise ValueError('Dataset-wide matching only supports the dca matching_method')
+
+    dca_parameters = config['dca_parameters']
+    threshold = dca_parameters['threshold']
+
+    track_order = np.argsort(track_columns['image_ids'], kind='stable')
+    crthit_order = np.argsort(crthit_columns['image_ids'], kind='stable')
+    sorted_track_image_ids = track_columns['image_ids'][track_order]
+    sorted_crthit_image_ids = crthit_columns['image_ids'][crthit_order]
+
+    # Segment offsets: the hits of each track's event in the sorted hit columns
+    first_hits = np.searchsorted(sorted_crthit_image_ids, sorted_track_image_ids, side='left')
+    last_hits  = np.searchsorted(sorted_crthit_image_ids, sorted_track_image_ids, side='right')
+    pair_counts = last_hits - first_hits
+
+    endpoint_terms = get_endpoint_terms(track_columns, dca_parameters)
+    max_tile_pairs = get_max_tile_pairs(dca_parameters)
+
+    # Running best of each sorted track over the tiles
+    sorted_min_dcas = np.full(len(track_order), np.inf)
+    sorted_best_hits = np.full(len(track_order), -1, dtype=np.int64)
+    n_tiles, largest_tile_pairs = 0, 0
+    top_k = get_top_k(dca_parameters)
+    top_k_check_interval = get_top_k_check_interval(dca_parameters) if stats is not None and top_k else 0
+    if stats is not None and dca_parameters.get('yz_pruning', False): stats['n_pruned_pairs'] = 0
+    if stats is not None and top_k: stats['n_top_k_skipped_pairs'] = 0
+    if top_k_check_interval: stats['n_top_k_checked_tracks'], stats['n_top_k_missed_tracks'] = 0, 0
+    for first_track, last_track, first_offset, last_offset in get_pair_tiles(pair_counts, max_tile_pairs):
+        is_split_track = last_offset - first_offset < pair_counts[first_track:last_track].max()
+        if top_k and is_split_track:
+            # The top_k hits are ranked over all slices, then evaluated in a single tile
+            if first_offset > 0: continue
+            tile_hits = get_split_track_top_k_hits(crthit_columns, track_order[first_track], crthit_order,
+                                                   first_hits[first_track], pair_counts[first_track],
+                                                   max_tile_pairs, dca_parameters, endpoint_terms, stats)
+            tile_counts = np.array([len(tile_hits)])
+            tile_offsets = np.zeros(1, dtype=np.int64)
+            tile_tracks = np.zeros(len(tile_hits), dtype=np.int64)
+        else:
+            tile_counts = np.minimum(pair_counts[first_track:last_track], last_offset) - first_offset
+            tile_offsets = np.cumsum(tile_counts) - tile_counts
+            tile_tracks = np.repeat(np.arange(len(tile_counts)), tile_counts)
+            tile_hits = first_hits[first_track:last_track][tile_tracks] + first_offset \
+                      + np.arange(len(tile_tracks)) - tile_offsets[tile_tracks]
+
+        tile_dcas = get_pair_dcas(track_columns, crthit_columns, track_order[first_track + tile_tracks],
+                                  crthit_order[tile_hits], dca_parameters, endpoint_terms, stats)
+        tile_dcas[tile_dcas > threshold] = np.inf
+        tile_min_dcas, tile_best_pairs = get_segment_minima(tile_dcas, tile_tracks, tile_offsets, tile_counts)
+        if top_k_check_interval and not is_split_track:
+            is_checked = (first_track + np.arange(len(tile_counts))) % top_k_check_interval == 0
+            checked_pairs = np.flatnonzero(is_checked[tile_tracks])
+            n_missed_tracks = get_top_k_missed_tracks(
+                track_columns, crthit_columns, track_order[first_track + tile_tracks[checked_pairs]],
+                crthit_order[tile_hits[checked_pairs]], tile_counts[is_checked], tile_dcas[checked_pairs],
+                dca_parameters, endpoint_terms)
+            stats['n_top_k_checked_tracks'] += int(is_checked.sum())
+            stats['n_top_k_missed_tracks'] += n_missed_tracks
+
+        # Strict improvement keeps the first hit on ties, as in a single pass
+        is_better = tile_min_dcas < sorted_min_dcas[first_track:last_track]
+        sorted_min_dcas[first_track:last_track][is_better] = tile_min_dcas[is_better]
+        sorted_best_hits[first_track:last_track][is_better] = tile_hits[tile_best_pairs[is_better]]
+        n_tiles += 1
+        largest_tile_pairs = max(largest_tile_pairs, len(tile_tracks))
+
+    if stats is not None:
+        stats['n_tiles'] = n_tiles
+        stats['n_pairs'] = int(pair_counts.sum())
+        stats['peak_working_set_bytes'] = largest_tile_pairs * DCA_BYTES_PER_PAIR
+
+    n_tracks = len(track_order)
+    crthit_ids = np.full(n_tracks, -1, dtype=np.asarray(crthit_columns['ids']).dtype)
+    distances = np.full(n_tracks, np.inf)
+    has_match = np.isfinite(sorted_min_dcas)
+    matched_tracks = track_order[has_match]
+    crthit_ids[matched_tracks] = crthit_columns['ids'][crthit_order[sorted_best_hits[has_match]]]
+    distances[matched_tracks] = sorted_min_dcas[has_match]
+
+    return {
+        'track_ids': track_columns['ids'],
+        'image_ids': track_columns['image_ids'],
+        'crthit_ids': crthit_ids,
+        'distances': distances,
+    }
+
+def get_segment_minima(pair_values, pair_tracks, pair_offsets, pair_counts):
+    """
+    Find the minimum value of each track's segment of pairs, and the first
+    pair reaching it, using segmented reductions.
+
+    Parameters:
+        pair_values (numpy.ndarray): Values of shape (n_pairs,), grouped by track.
+        pair_tracks (numpy.ndarray): Track index of each pair, shape (n_pairs,).
+        pair_offsets (numpy.ndarray): Index of the first pair of each track, shape (n_tracks,).
+        pair_counts (numpy.ndarray): Number of pairs of each track, shape (n_tracks,).
+
+    Returns:
+        tuple: Minimum value of each track (np.inf for tracks without pairs)
+               and index of the first pair with that value (-1 without pairs).
+    """
+    n_tracks = len(pair_counts)
+    min_values = np.full(n_tracks, np.inf)
+    best_pairs = np.full(n_tracks, -1, dtype=np.int64)
+    has_pairs = pair_counts > 0
+    if not has_pairs.any(): return min_values, best_pairs
+
+    # reduceat needs strictly valid, non-empty segment starts
+    segment_starts = pair_offsets[has_pairs]
+    min_values[has_pairs] = np.minimum.reduceat(pair_values, segment_starts)
+
+    pair_indices = np.arange(len(pair_values))
+    is_minimum = pair_values == min_values[pair_tracks]
+    first_minimum = np.where(is_minimum, pair_indices, len(pair_values))
+    best_pairs[has_pairs] = np.minimum.reduceat(first_minimum, segment_starts)
+
+    return min_values, best_pairs
+
+def get_pair_dcas(track_columns, crthit_columns, pair_tracks, pair_hits, dca_parameters, endpoint_terms=None,
+                  stats=None):
+    """
+    Calculate the DCA of track/CRT hit pairs, using the end point closest to
+    each hit as in get_track_crthit_dcas. Pairs dropped by get_kept_pairs
+    (y-z pruning and top_k) get np.inf without shifting their end point.
+
+    Parameters:
+        track_columns (dict): Output of get_track_columns.
+        crthit_columns (dict): Output of get_crthit_columns.
+        pair_tracks (numpy.ndarray): Track index of each pair, shape (n_pairs,).
+        pair_hits (numpy.ndarray): CRT hit index of each pair, shape (n_pairs,).
+        dca_parameters (dict): Loaded DCA parameters from matcha config file
+        endpoint_terms (dict, optional): Output of get_endpoint_terms, to reuse
+                                         between calls. Default: None (computed here)
+        stats (dict, optional): If provided, pruning and top_k counters are
+                                incremented, see get_kept_pairs. Default: None
+
+    Returns:
+        numpy.ndarray: DCA of each pair, np.inf if the closest end point is
+                       outside the TPCs or has a zero direction.
+    """
+    if dca_parameters['method'] != 'simple':
+        raise ValueError('Invalid DCA method specified')
+
+    if endpoint_terms is None:
+        endpoint_terms = get_endpoint_terms(track_columns, dca_parameters)
+
+    pair_terms = get_pair_terms(crthit_columns, pair_tracks, pair_hits, endpoint_terms)
+    kept_pairs = get_kept_pairs(pair_terms, pair_tracks, dca_parameters, stats)
+    crthit_positions = pair_terms['crthit_positions'][kept_pairs]
+    crthit_times = pair_terms['crthit_times'][kept_pairs]
+    pair_positions = pair_terms['positions'][kept_pairs]
+    pair_directions = pair_terms['directions'][kept_pairs]
+    pair_denominators = pair_terms['denominators'][kept_pairs]
+    pair_drift_directions = pair_terms['drift_directions'][kept_pairs]
+
+    pair_dcas = np.full(len(pair_tracks), np.inf)
+    drift_shifts = get_drift_velocity(dca_parameters['isdata']) * crthit_times * pair_drift_directions
+    if 'single_positions' in pair_terms:
+        # Same two-point form as simple_dca_batch with the native precision,
+        # rounding the single precision end points as it does
+        shifted_endpoints = pair_positions.astype(np.float64)
+        shifted_endpoints[:, 0] += drift_shifts
+        single_positions = pair_terms['single_positions'][kept_pairs]
+        shifted_endpoints[single_positions, 0] = pair_positions[single_positions, 0].astype(np.float32) \
+                                               + drift_shifts[single_positions].astype(np.float32)
+        points_on_line = shifted_endpoints + pair_directions.astype(np.float64)
+        # A float32 sum calculated in double precision and rounded once is exact
+        single_sums = pair_terms['single_sums'][kept_pairs]
+        points_on_line[single_sums] = points_on_line[single_sums].astype(np.float32)
+        numerators = np.linalg.norm(np.cross((crthit_positions - shifted_endpoints),
+                                             (crthit_positions - points_on_line)), axis=1)
+    else:
+        # Same double precision offsets as simple_dca_batch with a reduced precision
+        offsets = crthit_positions - pair_positions.astype(np.float64)
+        offsets[:, 0] -= drift_shifts
+        numerators = np.linalg.norm(np.cross(offsets, pair_directions.astype(np.float64)), axis=1)
+    is_valid = (pair_drift_directions != 0) & (pair_denominators != 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pair_dcas[kept_pairs] = np.where(is_valid, numerators / pair_denominators, np.inf)
+
+    return pair_dcas
+
+def get_top_k_missed_tracks(track_columns, crthit_columns, pair_tracks, pair_hits, pair_counts, pair_dcas,
+                            dca_parameters, endpoint_terms):
+    """
+    Count the tracks whose best match is lost to dca_parameters.top_k, by
+    calculating their DCAs again with every CRT hit.
+
+    Parameters:
+        track_columns (dict): Output of get_track_columns.
+        crthit_columns (dict): Output of get_crthit_columns.
+        pair_tracks (numpy.ndarray): Track index of each pair, grouped by track, shape (n_pairs,).
+        pair_hits (numpy.ndarray): CRT hit index of each pair, shape (n_pairs,).
+        pair_counts (numpy.ndarray): Number of pairs of each track, shape (n_tracks,).
+        pair_dcas (numpy.ndarray): DCAs with top_k, above threshold set to np.inf, shape (n_pairs,).
+        dca_parameters (dict): Loaded DCA parameters from matcha config file
+        endpoint_terms (dict): Output of get_endpoint_terms.
+
+    Returns:
+        int: Number of tracks whose best DCA or best hit changes without top_k.
+    """
+    full_dcas = get_pair_dcas(track_columns, crthit_columns, pair_tracks, pair_hits,
+                              dict(dca_parameters, top_k=0), endpoint_terms)
+    full_dcas[full_dcas > dca_parameters['threshold']] = np.inf
+
+    segments = (np.repeat(np.arange(len(pair_counts)), pair_counts), np.cumsum(pair_counts) - pair_counts,
+                pair_counts)
+    min_dcas, best_pairs = get_segment_minima(pair_dcas, *segments)
+    full_min_dcas, full_best_pairs = get_segment_minima(full_dcas, *segments)
+    return int(np.sum((min_dcas != full_min_dcas) | (best_pairs != full_best_pairs)))
+
+def get_pair_terms(crthit_columns, pair_tracks, pair_hits, endpoint_terms):
+    """
+    Gather the CRT hit and closest end point quantities of each track/CRT hit
+    pair. The closest end point is chosen as in get_closest_track_point_mask.
+
+    Parameters:
+        crthit_columns (dict): Output of get_crthit_columns.
+        pair_tracks (numpy.ndarray): Track index of each pair, shape (n_pairs,).
+        pair_hits (numpy.ndarray): CRT hit index of each pair, shape (n_pairs,).
+        endpoint_terms (dict): Output of get_endpoint_terms.
+
+    Returns:
+        dict: Dictionary with keys 'crthit_positions', 'positions' and 'directions'
+              (shape (n_pairs, 3)), and 'crthit_times', 'endpoints' (0 for the
+              start, 1 for the end), 'denominators' and 'drift_directions'
+              (shape (n_pairs,)), as well as 'single_positions' and 'single_sums'
+              if they are in endpoint_terms.
+    """
+    positions = endpoint_terms['positions']
+    crthit_positions = crthit_columns['positions'][pair_hits]
+
+    # Same comparison as get_closest_track_point_mask
+    distance_to_start = np.linalg.norm(crthit_positions - positions[0][pair_tracks], axis=1)
+    distance_to_end   = np.linalg.norm(crthit_positions - positions[1][pair_tracks], axis=1)
+    pair_endpoints = np.where(distance_to_start <= distance_to_end, 0, 1)
+
+    # Index the (2, n_tracks, ...) end point arrays per pair
+    pair_terms = {
+        'crthit_positions': crthit_positions,
+        'crthit_times': crthit_columns['times'][pair_hits],
+        'endpoints': pair_endpoints,
+    }
+    for key in ENDPOINT_TERM_KEYS:
+        if key in endpoint_terms:
+            pair_terms[key] = endpoint_terms[key][pair_endpoints, pair_tracks]
+
+    return pair_terms
+
+def get_kept_pairs(pair_terms, pair_tracks, dca_parameters, stats=None):
+    """
+    Select the pairs whose DCA is calculated. As in get_track_crthit_dcas,
+    pairs whose y-z lower bound exceeds the threshold are dropped if
+    dca_parameters['yz_pruning'] is set, then only the top_k remaining hits of
+    each track end point, ranked by get_unshifted_distances, are kept if
+    dca_parameters['top_k'] is set. Ties are kept in pair order.
+
+    The top_k ranking only sees the given pairs, so every hit of a track must be
+    in them, see get_split_track_top_k_hits, and the pairs of each track must
+    be contiguous, see get_block_top_k_mask.
+
+    Parameters:
+        pair_terms (dict): Output of get_pair_terms.
+        pair_tracks (numpy.ndarray): Track index of each pair, shape (n_pairs,).
+        dca_parameters (dict): Loaded DCA parameters from matcha config file
+        stats (dict, optional): If provided, 'n_pruned_pairs' (with yz_pruning) and
+                                'n_top_k_skipped_pairs' (with top_k) are incremented.
+                                Default: None
+
+    Returns:
+        numpy.ndarray or slice: Indices of the kept pairs, or slice(None) if all are kept.
+    """
+    kept_pairs = slice(None)
+    if dca_parameters.get('yz_pruning', False):
+        is_kept = get_yz_pruning_mask(pair_terms['positions'], pair_terms['directions'],
+                                      pair_terms['crthit_positions'], dca_parameters['threshold'])
+        if stats is not None:
+            stats['n_pruned_pairs'] = stats.get('n_pruned_pairs', 0) + int(len(is_kept) - is_kept.sum())
+        kept_pairs = np.flatnonzero(is_kept)
+
+    top_k = get_top_k(dca_parameters)
+    if top_k:
+        if isinstance(kept_pairs, slice): kept_pairs = np.arange(len(pair_tracks))
+        distances = get_unshifted_distances(pair_terms['positions'][kept_pairs],
+                                            pair_terms['directions'][kept_pairs],
+                                            pair_terms['crthit_positions'][kept_pairs])
+        is_top_k = get_block_top_k_mask(pair_tracks[kept_pairs], pair_terms['endpoints'][kept_pairs],
+                                        distances, top_k)
+        if stats is not None:
+            stats['n_top_k_skipped_pairs'] = stats.get('n_top_k_skipped_pairs', 0) \
+                                           + int(len(is_top_k) - is_top_k.sum())
+        kept_pairs = kept_pairs[is_top_k]
+
+    return kept_pairs
+
+def get_block_top_k_mask(blocks, endpoints, values, top_k):
+    """
+    Flag the top_k smallest values of each end point of each block. The
+    values of a block must be contiguous, and ties are kept in order.
+
+    Blocks longer than top_k are gathered into rows padded to the next power
+    of two, at most twice their length, and the top_k of each row are found
+    with np.partition rather than by sorting every value.
+
+    Parameters:
+        blocks (numpy.ndarray): Block (e.g. track) index of each value, shape (n,).
+        endpoints (numpy.ndarray): End point (0 or 1) of each value, shape (n,).
+        values (numpy.ndarray): Values to rank, shape (n,).
+        top_k (int): Number of values kept per end point of each block.
+
+    Returns:
+        numpy.ndarray: Boolean mask of shape (n,).
+    """
+    is_top_k = np.ones(len(values), dtype=bool)
+    if len(values) == 0: return is_top_k
+
+    is_block_start = np.ones(len(blocks), dtype=bool)
+    is_block_start[1:] = blocks[1:] != blocks[:-1]
+    block_starts = np.flatnonzero(is_block_start)
+    block_lengths = np.diff(np.append(block_starts, len(blocks)))
+    padded_lengths = 1 << np.ceil(np.log2(block_lengths)).astype(np.int64)
+    padded_lengths[block_lengths <= top_k] = 0
+
+    for padded_length in np.unique(padded_lengths[padded_lengths > 0]):
+        rows = np.flatnonzero(padded_lengths == padded_length)
+        columns = np.arange(padded_length)
+        is_inside = columns < block_lengths[rows, None]
+        indices = np.where(is_inside, block_starts[rows, None] + columns, 0)
+        row_is_top_k = np.zeros(indices.shape, dtype=bool)
+        for endpoint in (0, 1):
+            is_candidate = is_inside & (endpoints[indices] == endpoint)
+            candidate_values = np.where(is_candidate, values[indices], np.inf)
+            kth_values = np.partition(candidate_values, top_k - 1, axis=1)[:, top_k - 1, None]
+            is_below = is_candidate & (candidate_values < kth_values)
+            # Values equal to the k-th fill the remaining places in order
+            is_tied = is_candidate & (candidate_values == kth_values)
+            n_free = top_k - is_below.sum(axis=1, keepdims=True)
+            row_is_top_k |= is_below | (is_tied & (np.cumsum(is_tied, axis=1) <= n_free))
+        is_top_k[indices[is_inside]] = row_is_top_k[is_inside]
+
+    return is_top_k
+
+def get_split_track_top_k_hits(crthit_columns, track, crthit_order, first_hit, n_hits, max_tile_pairs,
+                               dca_parameters, endpoint_terms, stats=None):
+    """
+    Find the top_k hits of each end point of a track whose hits are split over
+    several tiles. The hits are ranked slice by slice, keeping the running
+    top_k of each end point, so the working set stays within max_tile_pairs.
+
+    Parameters:
+        crthit_columns (dict): Output of get_crthit_columns.
+        track (int): Track index.
+        crthit_order (numpy.ndarray): Order of the CRT hits sorted by image_id.
+        first_hit (int): Index of the first hit of the track's event in the sorted hits.
+        n_hits (int): Number of hits of the track's event.
+        max_tile_pairs (int): Largest number of pairs per slice.
+        dca_parameters (dict): Loaded DCA parameters from matcha config file
+        endpoint_terms (dict): Output of get_endpoint_terms.
+        stats (dict, optional): If provided, counters are incremented as in
+                                get_kept_pairs. Default: None
+
+    Returns:
+        numpy.ndarray: Sorted hit indices of the kept hits, at most 2 * top_k.
+    """
+    top_k = get_top_k(dca_parameters)
+    kept_hits = np.zeros(0, dtype=np.int64)
+    kept_endpoints = np.zeros(0, dtype=np.int64)
+    kept_distances = np.zeros(0)
+    n_candidates = 0
+    for first_offset in range(0, n_hits, max_tile_pairs):
+        slice_hits = first_hit + np.arange(first_offset, min(first_offset + max_tile_pairs, n_hits))
+        slice_tracks = np.full(len(slice_hits), track)
+        pair_terms = get_pair_terms(crthit_columns, slice_tracks, crthit_order[slice_hits], endpoint_terms)
+        if dca_parameters.get('yz_pruning', False):
+            is_kept = get_yz_pruning_mask(pair_terms['positions'], pair_terms['directions'],
+                                          pair_terms['crthit_positions'], dca_parameters['threshold'])
+            if stats is not None:
+                stats['n_pruned_pairs'] = stats.get('n_pruned_pairs', 0) + int(len(is_kept) - is_kept.sum())
+            slice_hits = slice_hits[is_kept]
+            pair_terms = {key: values[is_kept] for key, values in pair_terms.items()}
+
+        n_candidates += len(slice_hits)
+        kept_hits = np.concatenate([kept_hits, slice_hits])
+        kept_endpoints = np.concatenate([kept_endpoints, pair_terms['endpoints']])
+        kept_distances = np.concatenate([kept_distances, get_unshifted_distances(
+            pair_terms['positions'], pair_terms['directions'], pair_terms['crthit_positions'])])
+
+        # Kept hits come first and in hit order, so ties are broken as in a single pass
+        is_top_k = get_block_top_k_mask(np.zeros(len(kept_hits), dtype=np.int64), kept_endpoints,
+                                        kept_distances, top_k)
+        kept_hits, kept_endpoints = kept_hits[is_top_k], kept_endpoints[is_top_k]
+        kept_distances = kept_distances[is_top_k]
+
+    if stats is not None:
+        stats['n_top_k_skipped_pairs'] = stats.get('n_top_k_skipped_pairs', 0) + n_candidates - len(kept_hits)
+
+    return np.sort(kept_hits)
+
+def get_endpoint_terms(track_columns, dca_parameters):
+    """
+    Gather the per end point quantities used by get_pair_dcas.
+
+    With the native precision, simple_dca_batch works in the precision of
+    each end point: a single precision position is shifted in single
+    precision, and summed with a single precision direction in single
+    precision, whose norm is single precision too. 'single_positions' and
+    'single_sums' flag these end points so that get_pair_dcas rounds the same way.
+
+    Parameters:
+        track_columns (dict): Output of get_track_columns.
+        dca_parameters (dict): Loaded DCA parameters from matcha config file
+
+    Returns:
+        dict: Dictionary with keys 'positions' and 'directions' (see get_endpoint_arrays),
+              and 'denominators' (direction norms) and 'drift_directions', each of
+              shape (2, n_tracks), as well as 'single_positions' and 'single_sums'
+              (shape (2, n_tracks)) with the native precision.
+    """
+    precision = dca_parameters.get('precision', NATIVE_PRECISION)
+    positions, directions = get_endpoint_arrays(track_columns, precision)
+    endpoint_terms = {
+        'positions': positions,
+        'directions': directions,
+        'denominators': np.linalg.norm(directions.astype(np.float64), axis=2),
+        'drift_directions': get_drift_directions(positions[:, :, 0]),
+    }
+    if precision != NATIVE_PRECISION: return endpoint_terms
+
+    def get_single_precision_mask(kind, values):
+        keys = ['start_single_' + kind, 'end_single_' + kind]
+        is_single = np.full(values.shape[:2], values.dtype == np.float32)
+        if all(key in track_columns for key in keys):
+            is_single |= np.stack([track_columns[key] for key in keys])
+        return is_single
+
+    single_positions = get_single_precision_mask('positions', positions)
+    single_directions = get_single_precision_mask('directions', directions)
+    # Same norm as simple_dca_batch
+    for end, track in zip(*np.nonzero(single_directions)):
+        endpoint_terms['denominators'][end, track] = np.linalg.norm(directions[end, track].astype(np.float32))
+    endpoint_terms['single_positions'] = single_positions
+    endpoint_terms['single_sums'] = single_positions & single_directions
+
+    return endpoint_terms
+
+def get_pair_tiles(pair_counts, max_tile_pairs):
+    """
+    Split the track/CRT hit pairs into tiles of at most max_tile_pairs pairs.
+    Consecutive tracks are grouped while their pairs fit; a track with more
+    pairs than that is split into slices of its hits.
+
+    Parameters:
+        pair_counts (numpy.ndarray): Number of pairs of each track, shape (n_tracks,).
+        max_tile_pairs (int): Largest number of pairs per tile, or 0 for no limit.
+
+    Yields:
+        tuple: (first_track, last_track, first_offset, last_offset). The tile holds
+               tracks first_track to last_track (excluded), paired with their hits
+               first_offset to last_offset (excluded) within their event.
+    """
+    n_tracks = len(pair_counts)
+    if max_tile_pairs <= 0:
+        if n_tracks: yield 0, n_tracks, 0, int(pair_counts.max())
+        return
+
+    pair_ends = np.cumsum(pair_counts)
+    first_track = 0
+    while first_track < n_tracks:
+        pairs_before = pair_ends[first_track] - pair_counts[first_track]
+        last_track = int(np.searchsorted(pair_ends, pairs_before + max_tile_pairs, side='right'))
+        if last_track > first_track:
+            yield first_track, last_track, 0, int(pair_counts[first_track:last_track].max())
+            first_track = last_track
+            continue
+
+        # A single track with too many hits
+        n_pairs = int(pair_counts[first_track])
+        for first_offset in range(0, n_pairs, max_tile_pairs):
+            yield first_track, first_track + 1, first_offset, min(first_offset + max_tile_pairs, n_pairs)
+        first_track += 1
+
+def get_endpoint_arrays(track_columns, precision=NATIVE_PRECISION):
+    """
+    Stack the start and end point columns.
+
+    Parameters:
+        track_columns (dict): Output of get_track_columns.
+        precision (str, optional): numpy dtype name, or 'native' to keep the
+                                   column types. Default: 'native'
+
+    Returns:
+        tuple: Positions and directions, each of shape (2, n_tracks, 3).
+    """
+    positions = np.stack([track_columns['start_positions'], track_columns['end_positions']])
+    directions = np.stack([track_columns['start_directions'], track_columns['end_directions']])
+    if precision != NATIVE_PRECISION:
+        positions = positions.astype(precision)
+        directions = directions.astype(precision)
+    elif not np.issubdtype(positions.dtype, np.floating):
+        positions = positions.astype(np.float64)
+
+    return positions, directions
+
+def get_dataset_match_candidates(dataset_matches):
+    """
+    Convert the output of get_dataset_track_best_matches to MatchCandidates.
+
+    Parameters:
+        dataset_matches (dict): Output of get_dataset_track_best_matches.
+
+    Returns:
+        dict: Dictionary mapping each image_id to the list of MatchCandidates
+              that get_track_best_matches returns for that event.
+    """
+    match_candidates = {}
+    for track_id, image_id, crthit_id, distance in zip(
+            dataset_matches['track_ids'].tolist(), dataset_matches['image_ids'].tolist(),
+            dataset_matches['crthit_ids'].tolist(), dataset_matches['distances']):
+        event_candidates = match_candidates.setdefault(image_id, [])
+        if crthit_id == -1 and not np.isfinite(distance): continue
+        event_candidates.append(MatchCandidate(track_id, crthit_id, distance))
+
+    return match_candidates
@@ -1,8 +1,19 @@
-from .track import Track
-from .track_point import TrackPoint
-from .crthit import CRTHit
+from .track import Track, NATIVE_PRECISION
+from .track_point import TrackPoint, get_drift_velocity
+from .crthit import CRTHit, get_ts_mode
 import numpy as np
 
+# Peak bytes allocated per track/CRT hit pair by the vectorized DCA, measured
+# with tracemalloc on get_pair_dcas (float64 inputs, rounded up)
+DCA_BYTES_PER_PAIR = 400
+# Same, for get_track_crthit_dcas with the numpy kernel (including its output)
+EVENT_DCA_BYTES_PER_PAIR = 160
+
+# Pairs are only pruned if their y-z lower bound exceeds the threshold by more
+# than this margin (in cm). Single precision DCAs take the cross product of
+# vectors of up to ~1e3 cm and can be off by ~0.1 cm near the threshold.
+YZ_PRUNING_MARGIN = 1.
+
 def calculate_distance_of_closest_approach(track_point, crt_hit, dca_params):
     """
     Calculate distance of closest approach between a CRTHit and a line segment
@@ -47,15 +58,37 @@ def simple_dca(track_point, crt_hit, dca_params):
     trigger_timestamp = dca_params['trigger_timestamp']
     isdata = dca_params['isdata'] 
 
-    crt_hit_time = crt_hit.get_time_in_microseconds(trigger_timestamp, isdata)
-    shifted_x = track_point.shift_position_x(crt_hit_time, isdata)
+    crt_hit_time = crt_hit.get_time_in_microseconds(trigger_timestamp, isdata, get_ts_mode(dca_params))
+
+    if dca_params.get('precision', NATIVE_PRECISION) == NATIVE_PRECISION:
+        shifted_x = track_point.shift_position_x(crt_hit_time, isdata)
+
+        crt_hit_position = np.array([crt_hit.position_x, crt_hit.position_y, crt_hit.position_z])
+        track_endpoint = np.array([shifted_x, track_point.position_y, track_point.position_z])
+        track_point_direction = np.array([track_point.direction_x, track_point.direction_y,
+                                          track_point.direction_z])
+        point_on_line = np.array(track_endpoint + track_point_direction)
 
-    crt_hit_position = np.array([crt_hit.position_x, crt_hit.position_y, crt_hit.position_z])
-    track_endpoint = np.array([shifted_x, track_point.position_y, track_point.position_z])
-    track_point_direction = np.array([track_point.direction_x, track_point.direction_y, track_point.direction_z])
-    point_on_line = np.array(track_endpoint + track_point_direction)
+        numerator = np.linalg.norm(np.cross((crt_hit_position - track_endpoint),
+                                            (crt_hit_position - point_on_line)))
+        denominator = np.linalg.norm(track_point_direction)
 
-    numerator = np.linalg.norm(np.cross((crt_hit_position - track_endpoint), (crt_hit_position - point_on_line)))
+        if denominator == 0: return np.inf
+
+        return numerator/denominator
+
+    # With a reduced precision, work on the offset of the hit from the shifted
+    # end point in double precision: with coordinates of ~1e3 cm, the
+    # difference of two single precision offsets cancels catastrophically
+    crt_hit_position = np.array([crt_hit.position_x, crt_hit.position_y, crt_hit.position_z], dtype=np.float64)
+    track_endpoint = np.array([track_point.position_x, track_point.position_y, track_point.position_z],
+                              dtype=np.float64)
+    track_point_direction = np.array([track_point.direction_x, track_point.direction_y, track_point.direction_z],
+                                     dtype=np.float64)
+    offset = crt_hit_position - track_endpoint
+    offset[0] -= get_drift_velocity(isdata) * crt_hit_time * track_point.drift_direction
+
+    numerator = np.linalg.norm(np.cross(offset, track_point_direction))
     denominator = np.linalg.norm(track_point_direction)
 
     if denominator == 0: return np.inf
@@ -63,3 +96,284 @@ def simple_dca(track_point, crt_hit, dca_params):
     dca = numerator/denominator
 
     return dca
+
+def get_crthit_columns(crthits, dca_params):
+    """
+    Gather the CRT hit quantities needed for DCA calculations into flat 
+    numpy arrays so that a track end point can be compared with every hit
+    in a single vectorized pass.
+
+    Parameters:
+        crthits (list): List of matcha.CRTHit instances.
+        dca_params (dict): Loaded DCA parameters from matcha config file
+
+    Returns:
+        dict: Dictionary with keys 'ids' (shape (N,)), 'positions' (shape (N, 3), 
+              stored with dca_params['precision']) and 'times' (shape (N,), in 
+              microseconds).
+    """
+    trigger_timestamp = dca_params['trigger_timestamp']
+    isdata = dca_params['isdata']
+    ts_mode = get_ts_mode(dca_params)
+    precision = dca_params.get('precision', NATIVE_PRECISION)
+    position_dtype = float if precision == NATIVE_PRECISION else precision
+
+    ids = np.array([crt_hit.id for crt_hit in crthits])
+    positions = np.array([[crt_hit.position_x, crt_hit.position_y, crt_hit.position_z] 
+                          for crt_hit in crthits], dtype=position_dtype).reshape(-1, 3)
+    # Times are kept in double precision since they are derived from ns timestamps
+    times = np.array([crt_hit.get_time_in_microseconds(trigger_timestamp, isdata, ts_mode) 
+                      for crt_hit in crthits], dtype=float)
+
+    return {'ids': ids, 'positions': positions, 'times': times}
+
+def calculate_distance_of_closest_approach_batch(track_point, crthit_positions, crthit_times, dca_params):
+    """
+    Vectorized counterpart of calculate_distance_of_closest_approach that
+    evaluates one track end point against many CRT hits at once.
+
+    Parameters:
+        track_point (matcha.TrackPoint): Track end point from Track.get_endpoints() 
+        crthit_positions (numpy.ndarray): CRT hit positions of shape (N, 3).
+        crthit_times (numpy.ndarray): CRT hit times in microseconds of shape (N,).
+        dca_params (dict): Loaded DCA parameters from matcha config file
+
+    Returns:
+        numpy.ndarray: DCA values of shape (N,).
+    """
+    dca_method = dca_params['method']
+    if dca_method == 'simple':
+        return simple_dca_batch(track_point, crthit_positions, crthit_times, dca_params)
+    else:
+        raise ValueError('Invalid DCA method specified')
+
+def simple_dca_batch(track_point, crthit_positions, crthit_times, dca_params):
+    """
+    Vectorized version of simple_dca. Each CRT hit time is used to shift the
+    track point along the drift direction before the point-line distance is
+    calculated, exactly as in simple_dca: in the end point's own precision
+    with the native precision, and in double precision from the rounded inputs
+    otherwise.
+
+    Parameters:
+        track_point (matcha.TrackPoint): Track end point from Track.get_endpoints() 
+        crthit_positions (numpy.ndarray): CRT hit positions of shape (N, 3).
+        crthit_times (numpy.ndarray): CRT hit times in microseconds of shape (N,).
+        dca_params (dict): Loaded DCA parameters from matcha config file
+
+    Returns:
+        numpy.ndarray: DCA values of shape (N,). All values are np.inf if the
+                       track point direction has zero length.
+    """
+    isdata = dca_params['isdata'] 
+    precision = dca_params.get('precision', NATIVE_PRECISION)
+
+    track_point_position, track_point_direction, denominator = get_track_point_arrays(track_point, precision)
+    if denominator == 0: return np.full(len(crthit_positions), np.inf)
+
+    if precision == NATIVE_PRECISION:
+        # Keep the end point in its own precision, as the scalar arithmetic and
+        # np.array do in simple_dca
+        drift_shift = get_drift_velocity(isdata) * crthit_times * track_point.drift_direction
+        track_endpoints = np.empty(crthit_positions.shape, dtype=track_point_position.dtype)
+        track_endpoints[:, 0] = track_point_position[0] + drift_shift.astype(track_point_position.dtype)
+        track_endpoints[:, 1] = track_point_position[1]
+        track_endpoints[:, 2] = track_point_position[2]
+        points_on_line = track_endpoints + track_point_direction
+
+        numerator = np.linalg.norm(np.cross((crthit_positions - track_endpoints),
+                                            (crthit_positions - points_on_line)), axis=1)
+        return numerator/denominator
+
+    direction = track_point_direction.astype(np.float64)
+    offsets = crthit_positions - track_point_position.astype(np.float64)
+    offsets[:, 0] -= get_drift_velocity(isdata) * crthit_times * track_point.drift_direction
+
+    return np.linalg.norm(np.cross(offsets, direction), axis=1) / np.linalg.norm(direction)
+
+def get_track_point_arrays(track_point, precision=NATIVE_PRECISION):
+    """
+    Gather the position and direction of a TrackPoint into arrays. The position
+    keeps its own floating point type, as in simple_dca, unless a precision is set.
+
+    Parameters:
+        track_point (matcha.TrackPoint): Track end point.
+        precision (str, optional): numpy dtype name, or 'native'. Default: 'native'
+
+    Returns:
+        tuple: Position and direction arrays of shape (3,), and the norm of the direction.
+    """
+    direction = np.array([track_point.direction_x, track_point.direction_y, track_point.direction_z])
+    position = np.array([track_point.position_x, track_point.position_y, track_point.position_z])
+    if precision != NATIVE_PRECISION:
+        direction = direction.astype(precision)
+        position = position.astype(precision)
+    elif not np.issubdtype(position.dtype, np.floating):
+        position = position.astype(np.float64)
+
+    return position, direction, np.linalg.norm(direction)
+
+def get_max_tile_pairs(dca_params):
+    """
+    Get the largest number of track/CRT hit pairs whose DCAs can be evaluated
+    at once within dca_params['memory_budget_mb'].
+
+    Parameters:
+        dca_params (dict): Loaded DCA parameters from matcha config file
+
+    Returns:
+        int: Largest number of pairs per tile, or 0 if there is no memory budget.
+    """
+    memory_budget_mb = dca_params.get('memory_budget_mb', 0) or 0
+    if memory_budget_mb < 0:
+        raise ValueError('memory_budget_mb must be positive, or 0 for no limit')
+    if memory_budget_mb == 0: return 0
+    return max(int(memory_budget_mb * 1024**2) // DCA_BYTES_PER_PAIR, 1)
+
+def get_yz_lower_bounds(track_point_positions, track_point_directions, crthit_positions):
+    """
+    Lower bound on the DCA that does not depend on the CRT hit time. The drift
+    shift only moves the track point along x, so the distance between the hit
+    and the track line projected on the y-z plane is the same for every t0, and
+    projecting cannot increase a distance.
+
+    Parameters:
+        track_point_positions (numpy.ndarray): Track point positions, shape (3,) or (N, 3).
+        track_point_directions (numpy.ndarray): Track point directions, shape (3,) or (N, 3).
+        crthit_positions (numpy.ndarray): CRT hit positions of shape (N, 3).
+
+    Returns:
+        numpy.ndarray: Lower bounds of shape (N,), in double precision.
+    """
+    track_point_positions = np.asarray(track_point_positions, dtype=np.float64)
+    track_point_directions = np.asarray(track_point_directions, dtype=np.float64)
+    offset_y = crthit_positions[:, 1] - track_point_positions[..., 1]
+    offset_z = crthit_positions[:, 2] - track_point_positions[..., 2]
+    direction_y = track_point_directions[..., 1]
+    direction_z = track_point_directions[..., 2]
+
+    # A line along x projects to a point
+    direction_norm = np.hypot(direction_y, direction_z)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        line_distances = np.abs(offset_y*direction_z - offset_z*direction_y) / direction_norm
+    return np.where(direction_norm > 0, line_distances, np.hypot(offset_y, offset_z))
+
+def get_yz_pruning_mask(track_point_positions, track_point_directions, crthit_positions, threshold):
+    """
+    Select the track point/CRT hit pairs whose y-z lower bound cannot rule out
+    a DCA below threshold.
+
+    Parameters:
+        track_point_positions (numpy.ndarray): Track point positions, shape (3,) or (N, 3).
+        track_point_directions (numpy.ndarray): Track point directions, shape (3,) or (N, 3).
+        crthit_positions (numpy.ndarray): CRT hit positions of shape (N, 3).
+        threshold (float): DCA threshold in cm.
+
+    Returns:
+        numpy.ndarray: Boolean mask of shape (N,), True for the pairs to keep.
+    """
+    lower_bounds = get_yz_lower_bounds(track_point_positions, track_point_directions, crthit_positions)
+    return lower_bounds <= threshold + YZ_PRUNING_MARGIN
+
+def get_top_k(dca_params):
+    """
+    Get the number of CRT hits nearest to each track end point whose DCA is
+    calculated, see get_top_k_indices.
+
+    Parameters:
+        dca_params (dict): Loaded DCA parameters from matcha config file
+
+    Returns:
+        int: Number of hits kept per end point, or 0 to keep every hit.
+    """
+    top_k = dca_params.get('top_k', 0) or 0
+    if top_k < 0:
+        raise ValueError('top_k must be positive, or 0 to keep every CRT hit')
+    return int(top_k)
+
+def get_top_k_check_interval(dca_params):
+    """
+    Get how often a track matched with top_k is also matched with every CRT
+    hit, to count the best matches that top_k loses while matching.
+
+    Parameters:
+        dca_params (dict): Loaded DCA parameters from matcha config file
+
+    Returns:
+        int: One track in top_k_check_interval is checked, or 0 for none.
+    """
+    top_k_check_interval = dca_params.get('top_k_check_interval', 0) or 0
+    if top_k_check_interval < 0:
+        raise ValueError('top_k_check_interval must be positive, or 0 to check no track')
+    return int(top_k_check_interval)
+
+def get_unshifted_distances(track_point_position, track_point_direction, crthit_positions):
+    """
+    Distance between each CRT hit and the line through a track end point
+    before it is drift-shifted, i.e. the DCA for a t0 of 0. It is a cheap
+    proxy for the DCA: no shift is calculated, and it is larger for the hits
+    far from the line whatever their time. If the direction is null, the
+    distance to the end point is used.
+
+    Parameters:
+        track_point_position (numpy.ndarray): Track point position, shape (3,) or (N, 3).
+        track_point_direction (numpy.ndarray): Track point direction, shape (3,) or (N, 3).
+        crthit_positions (numpy.ndarray): CRT hit positions of shape (N, 3).
+
+    Returns:
+        numpy.ndarray: Distances of shape (N,).
+    """
+    offsets = crthit_positions - track_point_position
+    squared_distances = np.einsum('ij,ij->i', offsets, offsets)
+    if np.ndim(track_point_direction) == 2:
+        # One end point per hit, as in the dataset-wide matcher
+        direction_norms = np.linalg.norm(track_point_direction, axis=1)
+        has_direction = direction_norms > 0
+        squared_distances[has_direction] -= (np.einsum('ij,ij->i', offsets[has_direction],
+                                                       track_point_direction[has_direction])
+                                             / direction_norms[has_direction])**2
+        return np.sqrt(np.maximum(squared_distances, 0))
+
+    direction_norm = np.linalg.norm(track_point_direction)
+    if direction_norm > 0:
+        # Remove the offset along the line, cheaper than a cross product
+        squared_distances -= (offsets @ (track_point_direction / direction_norm))**2
+    return np.sqrt(np.maximum(squared_distances, 0))
+
+def get_top_k_indices(track_point_position, track_point_direction, crthit_positions, top_k):
+    """
+    Select the top_k CRT hits nearest to the unshifted track line, see
+    get_unshifted_distances. The DCA is then only calculated for these hits.
+
+    Parameters:
+        track_point_position (numpy.ndarray): Track point position, shape (3,).
+        track_point_direction (numpy.ndarray): Track point direction, shape (3,).
+        crthit_positions (numpy.ndarray): CRT hit positions of shape (N, 3).
+        top_k (int): Number of hits to keep.
+
+    Returns:
+        numpy.ndarray: Sorted indices of the kept hits, shape (min(top_k, N),).
+    """
+    if len(crthit_positions) <= top_k:
+        return np.arange(len(crthit_positions))
+    distances = get_unshifted_distances(track_point_position, track_point_direction, crthit_positions)
+    return np.sort(np.argpartition(distances, top_k - 1)[:top_k])
+
+def get_unshifted_distance_ranks(track_point_position, track_point_direction, crthit_positions):
+    """
+    Rank CRT hits by their distance to the unshifted track line, i.e. by the
+    proxy used by get_top_k_indices. A hit of rank r is kept by every top_k
+    larger than r.
+
+    Parameters:
+        track_point_position (numpy.ndarray): Track point position, shape (3,).
+        track_point_direction (numpy.ndarray): Track point direction, shape (3,).
+        crthit_positions (numpy.ndarray): CRT hit positions of shape (N, 3).
+
+    Returns:
+        numpy.ndarray: Rank of each hit, 0 for the nearest, shape (N,).
+    """
+    distances = get_unshifted_distances(track_point_position, track_point_direction, crthit_positions)
+    ranks = np.empty(len(distances), dtype=np.int64)
+    ranks[np.argsort(distances, kind='stable')] = np.arange(len(distances))
+    return ranks
@@ -0,0 +1,227 @@
+import os
+import json
+import hashlib
+import zipfile
+import tempfile
+import numpy as np
+from .track_point import TrackPoint
+from .track import TIME_BUDGET_FALLBACK
+"""
+Persistent on-disk cache of PCA track end points.
+
+Entries are keyed by a hash of the track points, depositions and PCA
+parameters, so a track is only ever matched to an entry computed from
+identical inputs. Writes are atomic (write to a temporary file, then
+os.replace), so several worker processes can share one cache directory.
+Reading an entry updates its modification time, and the least recently
+used entries are evicted once the directory exceeds its size limit. The
+size is checked when a cache directory is first opened by a process and then
+every EVICTION_CHECK_INTERVAL writes; get_endpoint_cache keeps one
+EndpointCache per directory, so writes are counted across events.
+End points estimated after running out of time (see Track.get_endpoints)
+depend on the machine load, so they are never stored. Other entries keep the
+endpoint_fallback of the track, which is restored on a cache hit.
+"""
+
+# Bump this if the stored array layout changes to invalidate old entries
+CACHE_VERSION = 2
+CACHE_FILE_SUFFIX = '.npz'
+EVICTION_LOCK_FILE = '.eviction.lock'
+# Number of writes between checks of the total cache size
+EVICTION_CHECK_INTERVAL = 100
+
+# EndpointCache of each (cache_dir, max_size_bytes) opened by this process
+_endpoint_caches = {}
+
+class EndpointCache:
+    """
+    Size-bounded LRU cache of track start/end positions and directions.
+
+    Attributes:
+        cache_dir (str): Directory in which cache entries are stored.
+        max_size_bytes (int): Total size of cached entries above which the
+                              least recently used entries are evicted.
+        hits (int): Number of successful lookups by this instance.
+        misses (int): Number of failed lookups by this instance.
+
+    Methods:
+        get_endpoints(track, pca_params):
+            Returns cached start and end TrackPoints, estimating and storing
+            them with Track.get_endpoints on a cache miss.
+    """
+    def __init__(self, cache_dir, max_size_bytes):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        self._writes_since_eviction_check = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        # Other processes may have filled the directory since it was last checked
+        self.evict()
+
+    def get_key(self, track, pca_params):
+        """
+        Hash the inputs of Track.get_endpoints.
+
+        Parameters:
+            track (Track): matcha.Track instance.
+            pca_params (dict): Dictionary of PCA parameters from loaded matcha config file
+
+        Returns:
+            str: Hexadecimal digest identifying the cache entry.
+        """
+        key_hash = hashlib.sha256()
+        key_hash.update(str(CACHE_VERSION).encode())
+        for array in (track.points, track.depositions):
+            array = np.ascontiguousarray(array)
+            key_hash.update(str((array.dtype.str, array.shape)).encode())
+            key_hash.update(array.tobytes())
+        key_hash.update(json.dumps(pca_params, sort_keys=True, default=str).encode())
+        return key_hash.hexdigest()
+
+    def get_endpoints(self, track, pca_params):
+        """
+        Get the start and end points of a track from the cache, or estimate
+        and cache them if they are not stored yet. As with Track.get_endpoints,
+        the start and end positions of the track are updated.
+
+        Parameters:
+            track (Track): matcha.Track instance.
+            pca_params (dict): Dictionary of PCA parameters from loaded matcha config file
+
+        Returns:
+            tuple: Start and end point TrackPoint instances.
+        """
+        key = self.get_key(track, pca_params)
+        entry = self._load(key)
+        if entry is None:
+            self.misses += 1
+            track_startpoint, track_endpoint = track.get_endpoints(pca_params)
+            if track.endpoint_fallback != TIME_BUDGET_FALLBACK:
+                self._store(key, track_startpoint, track_endpoint, track.endpoint_fallback)
+            return track_startpoint, track_endpoint
+
+        self.hits += 1
+        endpoint_array, track.endpoint_fallback = entry
+        start_position, start_direction = endpoint_array[0, :3], endpoint_array[0, 3:]
+        end_position, end_direction = endpoint_array[1, :3], endpoint_array[1, 3:]
+        track.start_x, track.start_y, track.start_z = start_position
+        track.end_x, track.end_y, track.end_z = end_position
+
+        track_startpoint = TrackPoint(track.id, *start_position, *start_direction)
+        track_endpoint = TrackPoint(track.id, *end_position, *end_direction)
+        return track_startpoint, track_endpoint
+
+    def _get_path(self, key):
+        return os.path.join(self.cache_dir, key + CACHE_FILE_SUFFIX)
+
+    def _load(self, key):
+        path = self._get_path(key)
+        try:
+            with np.load(path) as entry:
+                endpoint_array, endpoint_fallback = entry['endpoints'], str(entry['endpoint_fallback'])
+            os.utime(path)
+        except (ValueError, OSError, KeyError, zipfile.BadZipFile):
+            # Missing, evicted by another process, or unreadable
+            return None
+        return endpoint_array, endpoint_fallback or None
+
+    def _store(self, key, track_startpoint, track_endpoint, endpoint_fallback):
+        endpoint_array = np.array([
+            [track_point.position_x, track_point.position_y, track_point.position_z,
+             track_point.direction_x, track_point.direction_y, track_point.direction_z]
+            for track_point in (track_startpoint, track_endpoint)
+        ])
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as file:
+                np.savez(file, endpoints=endpoint_array, endpoint_fallback=np.str_(endpoint_fallback or ''))
+            os.replace(temporary_path, self._get_path(key))
+        except OSError:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            return
+
+        self._writes_since_eviction_check += 1
+        if self._writes_since_eviction_check >= EVICTION_CHECK_INTERVAL:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is below
+        max_size_bytes. Only one process evicts at a time; others skip.
+
+        Returns:
+            int: Number of entries removed.
+        """
+        self._writes_since_eviction_check = 0
+        try:
+            import fcntl
+        except ImportError:
+            fcntl = None
+
+        with open(os.path.join(self.cache_dir, EVICTION_LOCK_FILE), 'w') as lock_file:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return 0
+
+            entries = []
+            for entry in os.scandir(self.cache_dir):
+                if not entry.name.endswith(CACHE_FILE_SUFFIX): continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, get_disk_usage(stat), entry.path))
+
+            total_size = sum(size for _, size, _ in entries)
+            n_removed = 0
+            for _, size, path in sorted(entries):
+                if total_size <= self.max_size_bytes: break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total_size -= size
+                n_removed += 1
+
+        return n_removed
+
+def get_disk_usage(stat):
+    """
+    Get the disk space used by a file, which is larger than its size for
+    files as small as cache entries.
+
+    Parameters:
+        stat (os.stat_result): Result of os.stat for the file.
+
+    Returns:
+        int: Allocated size in bytes (the file size where blocks are not reported).
+    """
+    if hasattr(stat, 'st_blocks'):
+        return stat.st_blocks * 512
+    return stat.st_size
+
+def get_endpoint_cache(config):
+    """
+    Get the EndpointCache described by the endpoint_cache section of the
+    matcha config, if it is enabled. The same instance is returned for every
+    call with the same cache directory and size limit.
+
+    Parameters:
+        config (dict): Dictionary from parsing matcha config file
+
+    Returns:
+        EndpointCache or None: None if the cache is disabled or not configured.
+    """
+    cache_config = config.get('endpoint_cache')
+    if not cache_config or not cache_config.get('enabled', False):
+        return None
+
+    max_size_bytes = int(cache_config['max_size_mb'] * 1024**2)
+    cache_key = (os.path.abspath(cache_config['cache_dir']), max_size_bytes)
+    if cache_key not in _endpoint_caches:
+        _endpoint_caches[cache_key] = EndpointCache(cache_config['cache_dir'], max_size_bytes)
+    return _endpoint_caches[cache_key]
@@ -0,0 +1,257 @@
+import numpy as np
+from .track import Track
+from .crthit import CRTHit
+from .columnar_store import load_store_index, get_chunk_column, TRACK_ENDPOINT_ATTRIBUTES
+"""
+Random-access events over a columnar store written by matcha.columnar_store.
+
+EventDataset keeps only the per-event offset index in memory. Point,
+deposition and CRT hit columns are memory-mapped, and an event's Track and
+CRTHit objects are only built when it is accessed, reading that event's
+rows. CRT hits shared by every event of a chunk (image_id -1, as in
+write_to_file outputs) are built once for the chunk last accessed, and the
+same objects go with each of its events, as in matcha.sharding. Events are
+(image_id, tracks, crthits) tuples, the input format of matcha.harness and
+matcha.dataset_matcher.get_dataset_columns, and tracks and crthits can be
+passed to get_track_crthit_matches or get_track_best_matches as they are. A
+dataset pickles as its store path and event selection, so it can be sent to
+worker processes, which open the memory maps again on first access.
+"""
+
+class EventDataset:
+    """
+    Lazily materialized events of a columnar store.
+
+    Attributes:
+        store_dir (str): Directory of the columnar store.
+        chunk_names (list): Chunk directory names, in store order.
+        event_chunks (numpy.ndarray): Chunk index of each selected event.
+        event_image_ids (numpy.ndarray): image_id of each selected event.
+        event_track_ranges (numpy.ndarray): First and last (excluded) track row of
+                                            each selected event in its chunk, shape (n_events, 2).
+
+    Methods:
+        get_event(index): Build the (image_id, tracks, crthits) tuple of an event.
+        select(image_ids): Dataset of the events with the given image_ids.
+        subset(indices): Dataset of the given events, in the given order.
+    """
+    def __init__(self, store_dir, event_chunks=None, event_image_ids=None, event_track_ranges=None):
+        self.store_dir = store_dir
+        self.chunk_names = [chunk['name'] for chunk in load_store_index(store_dir)['chunks']]
+        if event_chunks is None:
+            event_chunks, event_image_ids, event_track_ranges = get_store_event_index(store_dir, self.chunk_names)
+        self.event_chunks = np.asarray(event_chunks, dtype=np.int64)
+        self.event_image_ids = np.asarray(event_image_ids, dtype=np.int64)
+        self.event_track_ranges = np.asarray(event_track_ranges, dtype=np.int64).reshape(-1, 2)
+        self._columns = {}
+        self._shared_crthits = None
+
+    def __len__(self):
+        return len(self.event_chunks)
+
+    def __getitem__(self, index):
+        return self.get_event(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.get_event(index)
+
+    def __getstate__(self):
+        # Memory maps are opened again by the receiving process
+        return {'store_dir': self.store_dir, 'chunk_names': self.chunk_names, 'event_chunks': self.event_chunks,
+                'event_image_ids': self.event_image_ids, 'event_track_ranges': self.event_track_ranges}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._columns = {}
+        self._shared_crthits = None
+
+    def get_column(self, chunk_index, table, column):
+        """
+        Memory-map a column of a chunk, once per process.
+
+        Parameters:
+            chunk_index (int): Index of the chunk.
+            table (str): Store table, see matcha.columnar_store.STORE_TABLES.
+            column (str): Column name.
+
+        Returns:
+            numpy.ndarray: Memory-mapped column.
+        """
+        key = (chunk_index, table, column)
+        if key not in self._columns:
+            self._columns[key] = get_chunk_column(self.store_dir, self.chunk_names[chunk_index], table, column)
+        return self._columns[key]
+
+    def get_event(self, index):
+        """
+        Build the Track and CRTHit objects of one event, reading only its rows
+        and the CRT hits shared by its chunk.
+
+        Parameters:
+            index (int): Index of the event in this dataset.
+
+        Returns:
+            tuple: (image_id, tracks, crthits).
+        """
+        if index < 0: index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Event index {} out of range for {} events'.format(index, len(self)))
+
+        chunk_index = int(self.event_chunks[index])
+        image_id = int(self.event_image_ids[index])
+        first_track, last_track = (int(row) for row in self.event_track_ranges[index])
+        return image_id, self.get_tracks(chunk_index, first_track, last_track), \
+               self.get_crthits(chunk_index, image_id)
+
+    def get_tracks(self, chunk_index, first_track, last_track):
+        """
+        Build the Tracks of a range of track rows of a chunk.
+
+        Parameters:
+            chunk_index (int): Index of the chunk.
+            first_track (int): First track row.
+            last_track (int): Last track row, excluded.
+
+        Returns:
+            list: List of matcha.Track instances.
+        """
+        def get_rows(table, column, first_row, last_row):
+            return np.array(self.get_column(chunk_index, table, column)[first_row:last_row])
+
+        point_offsets = get_rows('tracks', 'point_offsets', first_track, last_track + 1)
+        points = get_rows('points', 'points', point_offsets[0], point_offsets[-1])
+        depositions = get_rows('points', 'depositions', point_offsets[0], point_offsets[-1])
+        point_offsets -= point_offsets[0]
+
+        ids = get_rows('tracks', 'ids', first_track, last_track).tolist()
+        image_ids = get_rows('tracks', 'image_ids', first_track, last_track).tolist()
+        interaction_ids = get_rows('tracks', 'interaction_ids', first_track, last_track).tolist()
+        endpoint_fallbacks = get_rows('tracks', 'endpoint_fallbacks', first_track, last_track).tolist()
+        endpoints = {key: get_rows('tracks', key, first_track, last_track) for key in TRACK_ENDPOINT_ATTRIBUTES}
+
+        tracks = []
+        for row in range(last_track - first_track):
+            first_point, last_point = point_offsets[row], point_offsets[row + 1]
+            track = Track(ids[row], image_ids[row], interaction_ids[row],
+                          points[first_point:last_point], depositions[first_point:last_point])
+            for key, attributes in TRACK_ENDPOINT_ATTRIBUTES.items():
+                if not np.isfinite(endpoints[key][row]).all(): continue
+                for attribute, value in zip(attributes, endpoints[key][row].tolist()):
+                    setattr(track, attribute, value)
+            track.endpoint_fallback = endpoint_fallbacks[row] or None
+            tracks.append(track)
+
+        return tracks
+
+    def get_crthits(self, chunk_index, image_id):
+        """
+        Build the CRTHits of an event: the hits of its chunk with its image_id,
+        and the hits with image_id -1 (shared by every event of the chunk).
+        Hits are sorted by image_id in the chunk, so both are row ranges found
+        by bisection, and the shared hits are only built once per chunk.
+
+        Parameters:
+            chunk_index (int): Index of the chunk.
+            image_id (int): image_id of the event.
+
+        Returns:
+            list: List of matcha.CRTHit instances.
+        """
+        hit_image_ids = self.get_column(chunk_index, 'crthits', 'image_ids')
+        if self._shared_crthits is None or self._shared_crthits[0] != chunk_index:
+            last_shared_row = int(np.searchsorted(hit_image_ids, -1, side='right'))
+            self._shared_crthits = chunk_index, self.get_crthit_rows(chunk_index, 0, last_shared_row)
+
+        first_row, last_row = (int(row) for row in np.searchsorted(hit_image_ids, [image_id, image_id + 1]))
+        if image_id == -1: first_row = last_row
+        return self._shared_crthits[1] + self.get_crthit_rows(chunk_index, first_row, last_row)
+
+    def get_crthit_rows(self, chunk_index, first_row, last_row):
+        """
+        Build the CRTHits of a range of CRT hit rows of a chunk.
+
+        Parameters:
+            chunk_index (int): Index of the chunk.
+            first_row (int): First CRT hit row.
+            last_row (int): Last CRT hit row, excluded.
+
+        Returns:
+            list: List of matcha.CRTHit instances.
+        """
+        if last_row <= first_row: return []
+
+        def get_values(column):
+            return np.asarray(self.get_column(chunk_index, 'crthits', column)[first_row:last_row]).tolist()
+
+        positions, errors = get_values('positions'), get_values('errors')
+        return [CRTHit(id, t0_sec, t0_ns, t1_ns, *position, *error, total_pe=total_pe, plane=plane, tagger=tagger)
+                for id, t0_sec, t0_ns, t1_ns, position, error, total_pe, plane, tagger
+                in zip(get_values('ids'), get_values('t0_sec'), get_values('t0_ns'), get_values('t1_ns'),
+                       positions, errors, get_values('total_pe'), get_values('plane'), get_values('tagger'))]
+
+    def select(self, image_ids):
+        """
+        Select the events with the given image_ids, in the order of image_ids.
+        An image_id present in several chunks selects all of its events.
+
+        Parameters:
+            image_ids (list): image_ids to select.
+
+        Returns:
+            EventDataset: Dataset of the selected events.
+
+        Raises:
+            KeyError: If an image_id is not in this dataset.
+        """
+        event_indices = {}
+        for index, image_id in enumerate(self.event_image_ids.tolist()):
+            event_indices.setdefault(image_id, []).append(index)
+
+        missing_image_ids = [image_id for image_id in image_ids if image_id not in event_indices]
+        if missing_image_ids:
+            raise KeyError('image_ids {} not found in {:s}'.format(missing_image_ids[:10], self.store_dir))
+
+        return self.subset([index for image_id in image_ids for index in event_indices[image_id]])
+
+    def subset(self, indices):
+        """
+        Select events by index, in any order.
+
+        Parameters:
+            indices (list): Indices of events in this dataset.
+
+        Returns:
+            EventDataset: Dataset of the selected events.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        event_dataset = EventDataset.__new__(EventDataset)
+        event_dataset.__setstate__({'store_dir': self.store_dir, 'chunk_names': self.chunk_names,
+                                    'event_chunks': self.event_chunks[indices],
+                                    'event_image_ids': self.event_image_ids[indices],
+                                    'event_track_ranges': self.event_track_ranges[indices]})
+        return event_dataset
+
+def get_store_event_index(store_dir, chunk_names):
+    """
+    Read the event index of every chunk of a store.
+
+    Parameters:
+        store_dir (str): Directory of the columnar store.
+        chunk_names (list): Chunk directory names.
+
+    Returns:
+        tuple: Chunk index and image_id of each event, shape (n_events,), and its
+               first and last (excluded) track row in the chunk, shape (n_events, 2).
+    """
+    event_chunks, event_image_ids, event_track_ranges = [], [], []
+    for chunk_index, chunk_name in enumerate(chunk_names):
+        chunk_image_ids = np.array(get_chunk_column(store_dir, chunk_name, 'events', 'event_image_ids'))
+        chunk_offsets = np.array(get_chunk_column(store_dir, chunk_name, 'events', 'event_offsets'))
+        event_chunks.append(np.full(len(chunk_image_ids), chunk_index, dtype=np.int64))
+        event_image_ids.append(chunk_image_ids)
+        event_track_ranges.append(np.column_stack([chunk_offsets[:-1], chunk_offsets[1:]]))
+
+    if not chunk_names:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros((0, 2), dtype=np.int64)
+    return np.concatenate(event_chunks), np.concatenate(event_image_ids), np.concatenate(event_track_ranges)
@@ -0,0 +1,438 @@
+import copy
+import time
+import pickle
+import numpy as np
+from .track import Track
+from .crthit import CRTHit
+from .track_point import TrackPoint
+from .match_candidate import MatchCandidate
+from .crthit import get_ts_mode
+from .track_point import get_drift_velocity
+from .crt_geometry import load_crt_geometry, MATCHA_DIR, DEFAULT_CRT_GEOMETRY_PATH
+from .match_maker import get_track_best_matches, get_track_endpoints, get_closest_track_point, \
+                         get_track_best_match, TPC_REGION_NAMES
+"""
+Differential correctness harness for the matcha fast paths.
+
+The reference path is the original matcher: get_reference_endpoints and
+get_reference_dca, frozen copies of the original Track.get_endpoints and
+simple_dca (so that later changes to them are measured too), applied to
+every track/CRT hit pair in Python loops. The candidate path is whatever a
+config selects (kernels, precision, voxelization, memory budget, end point
+cache, ...) run through either the per-event or the dataset-wide matcher. Both run on copies of the same events,
+recorded (data/sample_output.pkl) or generated, and the harness reports every
+difference in matches, DCAs and end points together with the speedup.
+"""
+
+SAMPLE_OUTPUT_PATH = "{:s}/data/sample_output.pkl".format(MATCHA_DIR)
+
+EVENT_MATCHER   = 'event'
+DATASET_MATCHER = 'dataset'
+CANDIDATE_MATCHERS = [EVENT_MATCHER, DATASET_MATCHER]
+
+# Largest differences (in cm) still counted as agreement
+DEFAULT_DCA_TOLERANCE = 1e-6
+DEFAULT_ENDPOINT_TOLERANCE = 1e-6
+
+# DCA settings of the original matcher, applied on top of the config
+REFERENCE_DCA_OVERRIDES = {'precision': 'native', 'kernel': 'numpy', 'memory_budget_mb': 0, 'yz_pruning': False,
+                           'top_k': 0}
+
+ENDPOINT_ATTRIBUTES = ['start_x', 'start_y', 'start_z', 'start_dir_x', 'start_dir_y', 'start_dir_z',
+                       'end_x', 'end_y', 'end_z', 'end_dir_x', 'end_dir_y', 'end_dir_z']
+
+def run_harness(events, config, candidate_config=None, candidate_matcher=EVENT_MATCHER,
+                dca_tolerance=DEFAULT_DCA_TOLERANCE, endpoint_tolerance=DEFAULT_ENDPOINT_TOLERANCE):
+    """
+    Run the reference matcher and a candidate matcher on the same events and
+    compare their matches, DCAs and end points. The input events are not modified.
+
+    Parameters:
+        events (list): List of (image_id, tracks, crthits) tuples, e.g. from
+                       load_recorded_events or generate_events.
+        config (dict): Dictionary from parsing matcha config file, used by the
+                       reference path with REFERENCE_DCA_OVERRIDES.
+        candidate_config (dict, optional): Config selecting the fast path to test.
+                                           Default: None (same as config)
+        candidate_matcher (str, optional): 'event' for get_track_best_matches, or
+                                           'dataset' for the dataset-wide matcher.
+                                           Default: 'event'
+        dca_tolerance (float, optional): Largest DCA difference (cm) counted as
+                                         agreement. Default: DEFAULT_DCA_TOLERANCE
+        endpoint_tolerance (float, optional): Largest end point position or direction
+                                              difference counted as agreement.
+                                              Default: DEFAULT_ENDPOINT_TOLERANCE
+
+    Returns:
+        dict: Dictionary with keys
+              'n_events', 'n_tracks': size of the comparison,
+              'n_reference_matches', 'n_candidate_matches': number of matched tracks,
+              'match_mismatches': list of (image_id, track_id, reference_crthit_id,
+                                  candidate_crthit_id), with None for no match,
+              'max_dca_deviation': largest DCA difference between tracks matched to
+                                   the same CRT hit (cm),
+              'n_dca_mismatches': number of those above dca_tolerance,
+              'max_position_deviation', 'max_direction_deviation': largest end point
+                                   differences (directions ignore their sign),
+              'endpoint_mismatches': list of (image_id, track_id) above endpoint_tolerance,
+              'reference_seconds', 'candidate_seconds', 'speedup': timing of both paths,
+              'passed': True if no mismatch of any kind was found.
+    """
+    if candidate_config is None: candidate_config = config
+    if candidate_matcher not in CANDIDATE_MATCHERS:
+        raise ValueError('Invalid candidate_matcher {:s}, must be one of {}'.format(
+            str(candidate_matcher), CANDIDATE_MATCHERS))
+
+    reference_events = copy.deepcopy(events)
+    start_time = time.perf_counter()
+    reference_results = {image_id: get_reference_matches(tracks, crthits, config)
+                         for image_id, tracks, crthits in reference_events}
+    reference_seconds = time.perf_counter() - start_time
+
+    candidate_events = copy.deepcopy(events)
+    start_time = time.perf_counter()
+    candidate_matches = get_candidate_matches(candidate_events, candidate_config, candidate_matcher)
+    candidate_seconds = time.perf_counter() - start_time
+
+    # End points are compared on fresh copies, so that the timing above
+    # includes the candidate end point estimation
+    candidate_endpoints = {image_id: get_endpoint_array(tracks, candidate_config['pca_parameters'])
+                           for image_id, tracks, _ in copy.deepcopy(events)}
+
+    report = {
+        'n_events': len(events),
+        'n_tracks': sum(len(tracks) for _, tracks, _ in events),
+        'n_reference_matches': 0,
+        'n_candidate_matches': 0,
+        'match_mismatches': [],
+        'max_dca_deviation': 0.,
+        'n_dca_mismatches': 0,
+        'max_position_deviation': 0.,
+        'max_direction_deviation': 0.,
+        'endpoint_mismatches': [],
+    }
+    for image_id, tracks, _ in events:
+        reference_matches, reference_endpoints = reference_results[image_id]
+        compare_matches(report, image_id, reference_matches, candidate_matches.get(image_id, []), dca_tolerance)
+        compare_endpoints(report, image_id, [track.id for track in tracks], reference_endpoints,
+                          candidate_endpoints[image_id], endpoint_tolerance)
+
+    report['reference_seconds'] = reference_seconds
+    report['candidate_seconds'] = candidate_seconds
+    report['speedup'] = reference_seconds / candidate_seconds if candidate_seconds > 0 else np.inf
+    report['passed'] = not (report['match_mismatches'] or report['n_dca_mismatches']
+                            or report['endpoint_mismatches'])
+
+    return report
+
+def get_reference_matches(tracks, crthits, config):
+    """
+    Original matcher: estimate end points with get_reference_endpoints and
+    loop over every CRT hit with get_closest_track_point and get_reference_dca.
+
+    Parameters:
+        tracks (list): List of matcha.Track instances to be matched.
+        crthits (list): List of matcha.CRTHit instances to be matched.
+        config (dict): Dictionary from parsing matcha config file
+
+    Returns:
+        tuple: List of best MatchCandidates (at most one per Track), and a numpy
+               array of shape (n_tracks, 2, 6) with the end point positions and directions.
+    """
+    pca_parameters = config['pca_parameters']
+    dca_parameters = dict(config['dca_parameters'], **REFERENCE_DCA_OVERRIDES)
+    threshold = dca_parameters['threshold']
+
+    best_matches, track_points = [], []
+    for track in tracks:
+        track_startpoint, track_endpoint = get_reference_endpoints(track, pca_parameters)
+        track_points.append((track_startpoint, track_endpoint))
+
+        match_candidates = []
+        for crt_hit in crthits:
+            closest_track_point = get_closest_track_point(crt_hit, track_startpoint, track_endpoint)
+            if closest_track_point.tpc_region.name not in TPC_REGION_NAMES: continue
+            dca = get_reference_dca(closest_track_point, crt_hit, dca_parameters)
+            if dca > threshold: continue
+            match_candidates.append(MatchCandidate(track.id, crt_hit.id, dca))
+        if match_candidates:
+            best_matches.append(get_track_best_match(match_candidates))
+
+    return best_matches, get_track_point_array(track_points)
+
+def get_reference_dca(track_point, crt_hit, dca_parameters):
+    """
+    Original DCA, as simple_dca was before its fast paths: the norm of the
+    cross product of the hit offsets from the shifted end point and from a
+    second point on the line, in the precision of the inputs.
+
+    Parameters:
+        track_point (matcha.TrackPoint): Closest track end point.
+        crt_hit (matcha.CRTHit): CRT hit.
+        dca_parameters (dict): Loaded DCA parameters from matcha config file
+
+    Returns:
+        float: Distance of closest approach, np.inf for a null direction.
+    """
+    isdata = dca_parameters['isdata']
+    crt_hit_time = crt_hit.get_time_in_microseconds(dca_parameters['trigger_timestamp'], isdata,
+                                                    get_ts_mode(dca_parameters))
+    shifted_x = track_point.position_x + get_drift_velocity(isdata) * crt_hit_time * track_point.drift_direction
+
+    crt_hit_position = np.array([crt_hit.position_x, crt_hit.position_y, crt_hit.position_z])
+    track_endpoint = np.array([shifted_x, track_point.position_y, track_point.position_z])
+    track_point_direction = np.array([track_point.direction_x, track_point.direction_y, track_point.direction_z])
+    point_on_line = np.array(track_endpoint + track_point_direction)
+
+    numerator = np.linalg.norm(np.cross((crt_hit_position - track_endpoint), (crt_hit_position - point_on_line)))
+    denominator = np.linalg.norm(track_point_direction)
+    if denominator == 0: return np.inf
+
+    return numerator/denominator
+
+def get_reference_endpoints(track, pca_parameters):
+    """
+    Original end point estimate, as Track.get_endpoints was before its fast
+    paths: a PCA of the full point cloud gives two candidates, each refined by
+    a local PCA within radius, the denser one being the start point, and a PCA
+    of the points within radius of each end gives its direction. Neighborhoods
+    are found with cdist. User-provided end points are used when available.
+
+    Parameters:
+        track (Track): matcha.Track instance.
+        pca_parameters (dict): Dictionary of PCA parameters from loaded matcha config file
+
+    Returns:
+        tuple: Start and end point TrackPoint instances.
+    """
+    track_points = (
+        TrackPoint(track_id=track.id, position_x=track.start_x, position_y=track.start_y, position_z=track.start_z,
+                   direction_x=track.start_dir_x, direction_y=track.start_dir_y, direction_z=track.start_dir_z),
+        TrackPoint(track_id=track.id, position_x=track.end_x, position_y=track.end_y, position_z=track.end_z,
+                   direction_x=track.end_dir_x, direction_y=track.end_dir_y, direction_z=track.end_dir_z),
+    )
+    if all(track_point.is_valid() for track_point in track_points): return track_points
+
+    from sklearn.decomposition import PCA
+    from scipy.spatial.distance import cdist
+
+    if pca_parameters['direction_method'] != 'pca':
+        raise ValueError('Invalid direction_method in Track.get_track_point_angles')
+    radius = pca_parameters['radius']
+    min_points_in_radius = pca_parameters['min_points_in_radius']
+    points, depositions = track.points, track.depositions
+    pca = PCA(n_components=2)
+
+    projection = pca.fit_transform(points)
+    candidates = np.array([points[np.argmin(projection[:, 0])], points[np.argmax(projection[:, 0])]])
+    local_density = []
+    for candidate in candidates:
+        mask = cdist([candidate], points)[0] < radius
+        if np.sum(mask) > min_points_in_radius:
+            local_projection = pca.fit_transform(points[mask])
+            local_candidates = points[mask][np.argmin(local_projection[:, 0])], \
+                               points[mask][np.argmax(local_projection[:, 0])]
+            candidate = local_candidates[np.argmin(cdist([candidate], local_candidates))]
+            mask = cdist([candidate], points)[0] < radius
+        local_density.append(np.sum(depositions[mask]))
+    if np.argmin(local_density) == 1:
+        candidates = np.flip(candidates, axis=0)
+
+    directions = []
+    for candidate in candidates:
+        mask = cdist([candidate], points)[0] < radius
+        if np.sum(mask) < min_points_in_radius:
+            directions.append(np.array([-9999.0, -9999.0, -9999.0]))
+            continue
+        primary = pca.fit(points[mask]).components_[0]
+        directions.append(primary / np.linalg.norm(primary))
+
+    return tuple(TrackPoint(track_id=track.id, position_x=position[0], position_y=position[1],
+                            position_z=position[2], direction_x=direction[0], direction_y=direction[1],
+                            direction_z=direction[2])
+                 for position, direction in zip(candidates, directions))
+
+def get_candidate_matches(events, config, candidate_matcher=EVENT_MATCHER):
+    """
+    Run the candidate matcher on a list of events.
+
+    Parameters:
+        events (list): List of (image_id, tracks, crthits) tuples.
+        config (dict): Dictionary from parsing matcha config file
+        candidate_matcher (str, optional): One of CANDIDATE_MATCHERS. Default: 'event'
+
+    Returns:
+        dict: Dictionary mapping each image_id to its list of best MatchCandidates.
+    """
+    if candidate_matcher == DATASET_MATCHER:
+        # Imported here, dataset_matcher imports match_maker like this module
+        from .dataset_matcher import get_dataset_columns, get_dataset_track_best_matches, \
+                                     get_dataset_match_candidates
+        track_columns, crthit_columns = get_dataset_columns(events, config)
+        dataset_matches = get_dataset_track_best_matches(track_columns, crthit_columns, config)
+        return get_dataset_match_candidates(dataset_matches)
+
+    return {image_id: get_track_best_matches(tracks, crthits, config) for image_id, tracks, crthits in events}
+
+def get_endpoint_array(tracks, pca_parameters):
+    """
+    Estimate (or read) the end points of tracks as the matchers do.
+
+    Parameters:
+        tracks (list): List of matcha.Track instances.
+        pca_parameters (dict): Dictionary of PCA parameters from loaded matcha config file
+
+    Returns:
+        numpy.ndarray: Array of shape (n_tracks, 2, 6), see get_track_point_array.
+    """
+    return get_track_point_array([get_track_endpoints(track, pca_parameters) for track in tracks])
+
+def get_track_point_array(track_points):
+    """
+    Stack the positions and directions of start and end TrackPoints.
+
+    Parameters:
+        track_points (list): List of (start, end) TrackPoint tuples.
+
+    Returns:
+        numpy.ndarray: Array of shape (n_tracks, 2, 6) holding the position and
+                       direction of each end point in double precision.
+    """
+    return np.array([
+        [[point.position_x, point.position_y, point.position_z,
+          point.direction_x, point.direction_y, point.direction_z] for point in points]
+        for points in track_points
+    ], dtype=np.float64).reshape(-1, 2, 6)
+
+def compare_matches(report, image_id, reference_matches, candidate_matches, dca_tolerance):
+    """
+    Add the differences between the best matches of one event to a harness report.
+
+    Parameters:
+        report (dict): Report being filled by run_harness.
+        image_id (int): Event identifier.
+        reference_matches (list): MatchCandidates from the reference path.
+        candidate_matches (list): MatchCandidates from the candidate path.
+        dca_tolerance (float): Largest DCA difference (cm) counted as agreement.
+    """
+    reference_by_track = {match.track_id: match for match in reference_matches}
+    candidate_by_track = {match.track_id: match for match in candidate_matches}
+    report['n_reference_matches'] += len(reference_by_track)
+    report['n_candidate_matches'] += len(candidate_by_track)
+
+    for track_id in sorted(reference_by_track.keys() | candidate_by_track.keys()):
+        reference = reference_by_track.get(track_id)
+        candidate = candidate_by_track.get(track_id)
+        reference_crthit_id = reference.crthit_id if reference is not None else None
+        candidate_crthit_id = candidate.crthit_id if candidate is not None else None
+        if reference_crthit_id != candidate_crthit_id:
+            report['match_mismatches'].append((image_id, track_id, reference_crthit_id, candidate_crthit_id))
+            continue
+
+        dca_deviation = abs(float(reference.distance_of_closest_approach)
+                            - float(candidate.distance_of_closest_approach))
+        report['max_dca_deviation'] = max(report['max_dca_deviation'], dca_deviation)
+        if dca_deviation > dca_tolerance: report['n_dca_mismatches'] += 1
+
+def compare_endpoints(report, image_id, track_ids, reference_endpoints, candidate_endpoints, endpoint_tolerance):
+    """
+    Add the differences between the end points of one event to a harness report.
+
+    Parameters:
+        report (dict): Report being filled by run_harness.
+        image_id (int): Event identifier.
+        track_ids (list): Track IDs, in the order of the end point arrays.
+        reference_endpoints (numpy.ndarray): Array of shape (n_tracks, 2, 6).
+        candidate_endpoints (numpy.ndarray): Array of shape (n_tracks, 2, 6).
+        endpoint_tolerance (float): Largest difference counted as agreement.
+    """
+    if len(track_ids) == 0: return
+
+    position_deviations = np.abs(reference_endpoints[:, :, :3] - candidate_endpoints[:, :, :3]).max(axis=(1, 2))
+    direction_deviations = np.minimum(
+        np.abs(reference_endpoints[:, :, 3:] - candidate_endpoints[:, :, 3:]).max(axis=2),
+        np.abs(reference_endpoints[:, :, 3:] + candidate_endpoints[:, :, 3:]).max(axis=2)
+    ).max(axis=1)
+    report['max_position_deviation'] = max(report['max_position_deviation'], float(position_deviations.max()))
+    report['max_direction_deviation'] = max(report['max_direction_deviation'], float(direction_deviations.max()))
+
+    for track_id, is_mismatch in zip(track_ids, (position_deviations > endpoint_tolerance)
+                                                | (direction_deviations > endpoint_tolerance)):
+        if is_mismatch: report['endpoint_mismatches'].append((image_id, track_id))
+
+def load_recorded_events(file_path=SAMPLE_OUTPUT_PATH, reestimate_endpoints=True):
+    """
+    Load the events of a pickle file written by write_to_file. CRT hits have
+    no image_id, so every hit of the file is attached to each of its events.
+
+    Parameters:
+        file_path (str, optional): Path to the pickle file. Default: SAMPLE_OUTPUT_PATH
+        reestimate_endpoints (bool, optional): Clear the stored track end points so that
+                                               both paths estimate them. Default: True
+
+    Returns:
+        list: List of (image_id, tracks, crthits) tuples.
+    """
+    with open(file_path, 'rb') as file:
+        output_data = pickle.load(file)
+
+    event_tracks = {}
+    for track in output_data['tracks']:
+        if reestimate_endpoints:
+            for attribute in ENDPOINT_ATTRIBUTES: setattr(track, attribute, None)
+        event_tracks.setdefault(int(track.image_id), []).append(track)
+
+    return [(image_id, tracks, output_data['crthits']) for image_id, tracks in sorted(event_tracks.items())]
+
+def generate_events(n_events, n_tracks=10, n_crthits=40, n_points=300, seed=0,
+                    geometry_path=DEFAULT_CRT_GEOMETRY_PATH):
+    """
+    Generate events of straight tracks inside the TPCs, with a rising deposition
+    profile towards one end, and CRT hits on the CRT walls. Half of the tracks
+    get an in-time CRT hit where their backward extension crosses the top of
+    the detector; the other hits are uniform on the walls with random times.
+
+    Parameters:
+        n_events (int): Number of events.
+        n_tracks (int, optional): Tracks per event. Default: 10
+        n_crthits (int, optional): Random CRT hits per event. Default: 40
+        n_points (int, optional): Points per track. Default: 300
+        seed (int, optional): Random generator seed. Default: 0
+        geometry_path (str, optional): CRT geometry csv file. Default: DEFAULT_CRT_GEOMETRY_PATH
+
+    Returns:
+        list: List of (image_id, tracks, crthits) tuples.
+    """
+    rng = np.random.default_rng(seed)
+    crt_geometry = load_crt_geometry(geometry_path)
+    wall_mins, wall_maxs = crt_geometry['mins'], crt_geometry['maxs']
+    top_y = wall_maxs[:, 1].max()
+
+    events = []
+    for image_id in range(n_events):
+        tracks, crthits = [], []
+        for track_id in range(n_tracks):
+            start = rng.uniform([-350., -180., -890.], [350., 130., 890.])
+            direction = rng.normal(size=3)
+            direction /= np.linalg.norm(direction)
+            length = rng.uniform(50., 400.)
+            steps = np.sort(rng.uniform(0., length, n_points))
+            points = start + steps[:, None] * direction + rng.normal(scale=0.3, size=(n_points, 3))
+            depositions = 1. + 10. * np.exp(-(length - steps) / 5.) + rng.exponential(0.2, n_points)
+            tracks.append(Track(track_id, image_id, track_id, points.astype(np.float32),
+                                depositions.astype(np.float32)))
+
+            if track_id % 2 == 0 and direction[1] != 0:
+                crossing = start + (top_y - start[1]) / direction[1] * direction
+                crthits.append(CRTHit(len(crthits), 0, 0., 0., *crossing.tolist()))
+
+        # Python floats, as in recorded CRT hits
+        walls = rng.integers(len(wall_mins), size=n_crthits)
+        positions = rng.uniform(wall_mins[walls], wall_maxs[walls]).tolist()
+        times = rng.uniform(-1.5e6, 1.5e6, n_crthits).tolist()
+        for position, t0_ns in zip(positions, times):
+            crthits.append(CRTHit(len(crthits), 0, t0_ns, t0_ns, *position))
+
+        events.append((image_id, tracks, crthits))
+
+    return events
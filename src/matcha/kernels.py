@@ -0,0 +1,320 @@
+import functools
+import importlib.util
+import numpy as np
+from .track import NATIVE_PRECISION
+from .track_point import get_drift_velocity
+from .dca_methods import get_crthit_columns, get_track_point_arrays
+"""
+Optional Numba-compiled kernels for the innermost matcha loops.
+
+The DCA kernel fuses, for one track and every CRT hit, the choice of the
+closest end point, the drift shift, the cross product, the norm, the
+threshold and the argmin into one pass without temporary arrays. The
+density kernel counts and sums the depositions within a radius of an end
+point candidate in one pass.
+
+Both follow the operations of the NumPy path in the same order and in the
+same floating point types, so their results agree with it to
+KERNEL_TOLERANCE cm or better. The test suite checks this on recorded and
+generated events, with the native and float32 precisions.
+
+Numba is not a dependency of matcha: the 'numpy' kernel is used when it is
+not installed. It is only imported, and the kernels only compiled, the first
+time a 'numba' kernel is used.
+"""
+
+NUMPY_KERNEL = 'numpy'
+NUMBA_KERNEL = 'numba'
+AUTO_KERNEL  = 'auto'
+KERNELS = [NUMPY_KERNEL, NUMBA_KERNEL, AUTO_KERNEL]
+# Largest difference (in cm) between Numba and NumPy DCAs and end points
+KERNEL_TOLERANCE = 1e-9
+# DCA parameters that the Numba DCA kernel does not implement
+NUMPY_ONLY_DCA_PARAMETERS = ['yz_pruning', 'top_k']
+
+@functools.lru_cache(maxsize=None)
+def is_numba_available():
+    """
+    Check whether Numba can be imported, without importing it. The result is
+    cached for the lifetime of the process.
+
+    Returns:
+        bool: True if Numba is installed.
+    """
+    return importlib.util.find_spec('numba') is not None
+
+@functools.lru_cache(maxsize=None)
+def resolve_kernel(kernel):
+    """
+    Resolve a configured kernel name to the implementation that will run.
+    Results are cached per kernel name, so get_endpoints and the DCA paths can
+    call it for every track and the fallback warning is only printed once.
+
+    Parameters:
+        kernel (str): One of KERNELS. 'auto' uses Numba when it is installed.
+
+    Returns:
+        str: NUMPY_KERNEL or NUMBA_KERNEL.
+    """
+    if kernel not in KERNELS:
+        raise ValueError('Invalid kernel {:s}, must be one of {}'.format(str(kernel), KERNELS))
+    if kernel == NUMPY_KERNEL: return NUMPY_KERNEL
+    if is_numba_available(): return NUMBA_KERNEL
+    if kernel == NUMBA_KERNEL:
+        print('WARNING: numba is not installed, falling back to the numpy kernel')
+    return NUMPY_KERNEL
+
+@functools.lru_cache(maxsize=None)
+def warn_numpy_only_dca_parameters(parameters):
+    """
+    Warn that the Numba DCA kernel is replaced by the numpy kernel because
+    parameters are set. Cached, so the warning is only printed once.
+
+    Parameters:
+        parameters (tuple): Names of the set NUMPY_ONLY_DCA_PARAMETERS.
+    """
+    print('WARNING: the numba DCA kernel does not implement {}, falling back to the numpy kernel'.format(
+        ', '.join(parameters)))
+
+@functools.lru_cache(maxsize=None)
+def get_numba_kernels():
+    """
+    Compile the Numba kernels. Compiled functions are cached for the lifetime
+    of the process.
+
+    Returns:
+        dict: Dictionary with keys 'track_dcas' and 'radius_density'.
+    """
+    import numba
+
+    @numba.njit(cache=True)
+    def track_point_dca(hit_x, hit_y, hit_z, position, direction, drift, denominator, shift, use_offsets):
+        # Drift shift and point-line distance, in the same order as simple_dca_batch
+        if drift == 0 or denominator == 0: return np.inf
+        if use_offsets:
+            # Double precision offsets of the hit from the shifted end point
+            a_x = hit_x - position[0]
+            if drift > 0:
+                a_x -= shift
+            else:
+                a_x += shift
+            a_y = hit_y - position[1]
+            a_z = hit_z - position[2]
+            cross_x = a_y*direction[2] - a_z*direction[1]
+            cross_y = a_z*direction[0] - a_x*direction[2]
+            cross_z = a_x*direction[1] - a_y*direction[0]
+        else:
+            # Two-point form, compiled separately for each end point, which
+            # may have its own floating point type
+            if drift > 0:
+                shifted_x = position[0] + shift
+            else:
+                shifted_x = position[0] - shift
+            line_x = shifted_x + direction[0]
+            line_y = position[1] + direction[1]
+            line_z = position[2] + direction[2]
+
+            a_x = hit_x - shifted_x
+            a_y = hit_y - position[1]
+            a_z = hit_z - position[2]
+            b_x = hit_x - line_x
+            b_y = hit_y - line_y
+            b_z = hit_z - line_z
+            cross_x = a_y*b_z - a_z*b_y
+            cross_y = a_z*b_x - a_x*b_z
+            cross_z = a_x*b_y - a_y*b_x
+
+        return np.sqrt(cross_x*cross_x + cross_y*cross_y + cross_z*cross_z) / denominator
+
+    @numba.njit(cache=True)
+    def track_dcas(start_position, start_direction, start_drift, start_denominator, start_shifts,
+                   end_position, end_direction, end_drift, end_denominator, end_shifts,
+                   crthit_positions, threshold, use_offsets, dcas):
+        best_index = -1
+        best_dca = np.inf
+        for i in range(crthit_positions.shape[0]):
+            hit_x = crthit_positions[i, 0]
+            hit_y = crthit_positions[i, 1]
+            hit_z = crthit_positions[i, 2]
+
+            # Closest end point, as in get_closest_track_point_mask
+            offset_x = hit_x - start_position[0]
+            offset_y = hit_y - start_position[1]
+            offset_z = hit_z - start_position[2]
+            distance_to_start = np.sqrt(offset_x*offset_x + offset_y*offset_y + offset_z*offset_z)
+            offset_x = hit_x - end_position[0]
+            offset_y = hit_y - end_position[1]
+            offset_z = hit_z - end_position[2]
+            distance_to_end = np.sqrt(offset_x*offset_x + offset_y*offset_y + offset_z*offset_z)
+
+            if distance_to_start <= distance_to_end:
+                dca = track_point_dca(hit_x, hit_y, hit_z, start_position, start_direction,
+                                      start_drift, start_denominator, start_shifts[i], use_offsets)
+            else:
+                dca = track_point_dca(hit_x, hit_y, hit_z, end_position, end_direction,
+                                      end_drift, end_denominator, end_shifts[i], use_offsets)
+
+            if dca > threshold: dca = np.inf
+            dcas[i] = dca
+            if dca < best_dca:
+                best_dca = dca
+                best_index = i
+
+        return best_index
+
+    @numba.njit(cache=True)
+    def radius_density(center, points, depositions, limit, compare_squared):
+        n_points = 0
+        density = 0.
+        for i in range(points.shape[0]):
+            offset_x = points[i, 0] - center[0]
+            offset_y = points[i, 1] - center[1]
+            offset_z = points[i, 2] - center[2]
+            distance_squared = offset_x*offset_x + offset_y*offset_y + offset_z*offset_z
+            if compare_squared:
+                is_inside = distance_squared < limit
+            else:
+                is_inside = np.sqrt(distance_squared) < limit
+            if is_inside:
+                n_points += 1
+                density += depositions[i]
+        return n_points, density
+
+    return {'track_dcas': track_dcas, 'radius_density': radius_density}
+
+def track_dcas_numba(track_startpoint, track_endpoint, crthit_positions, crthit_times,
+                     dca_parameters, threshold=np.inf):
+    """
+    Numba counterpart of get_track_crthit_dcas, with the threshold and argmin
+    fused into the same pass.
+
+    Parameters:
+        track_startpoint (TrackPoint): Track start point.
+        track_endpoint (TrackPoint): Track end point.
+        crthit_positions (numpy.ndarray): CRT hit positions of shape (N, 3).
+        crthit_times (numpy.ndarray): CRT hit times in microseconds of shape (N,).
+        dca_parameters (dict): Loaded DCA parameters from matcha config file
+        threshold (float, optional): DCAs above threshold are set to np.inf. Default: np.inf
+
+    Returns:
+        tuple: DCA values of shape (N,) and the index of the smallest one (-1 if
+               every DCA is np.inf).
+    """
+    if dca_parameters['method'] != 'simple':
+        raise ValueError('Invalid DCA method specified')
+
+    precision = dca_parameters.get('precision', NATIVE_PRECISION)
+    use_offsets = precision != NATIVE_PRECISION
+    start_position, start_direction, start_denominator = get_track_point_arrays(track_startpoint, precision)
+    end_position, end_direction, end_denominator = get_track_point_arrays(track_endpoint, precision)
+    # Outside the TPCs the drift direction is None and the kernel returns np.inf
+    start_drift = track_startpoint.drift_direction or 0
+    end_drift = track_endpoint.drift_direction or 0
+
+    # Negating the shift is exact, so the sign is applied in the kernel
+    drift_shifts = get_drift_velocity(dca_parameters['isdata']) * np.asarray(crthit_times, dtype=np.float64)
+    if use_offsets:
+        # Rounded to the configured precision, then handled in double precision
+        # as in simple_dca_batch
+        start_position, start_direction = start_position.astype(np.float64), start_direction.astype(np.float64)
+        end_position, end_direction = end_position.astype(np.float64), end_direction.astype(np.float64)
+        start_denominator, end_denominator = np.linalg.norm(start_direction), np.linalg.norm(end_direction)
+        start_shifts = end_shifts = drift_shifts
+    else:
+        # The shift is rounded to the end point precision before it is added,
+        # as in simple_dca_batch
+        start_shifts = drift_shifts.astype(start_position.dtype)
+        end_shifts = drift_shifts.astype(end_position.dtype)
+
+    dcas = np.empty(len(crthit_positions))
+    best_index = get_numba_kernels()['track_dcas'](
+        start_position, start_direction, int(start_drift), start_denominator, start_shifts,
+        end_position, end_direction, int(end_drift), end_denominator, end_shifts,
+        np.ascontiguousarray(crthit_positions), float(threshold), use_offsets, dcas
+    )
+
+    return dcas, best_index
+
+def radius_density_numba(center, points, depositions, radius):
+    """
+    Numba counterpart of counting the points selected by get_points_in_radius_mask
+    and summing their depositions, using the same distance comparison.
+
+    Parameters:
+        center (numpy.ndarray): A numpy array of shape (3,).
+        points (numpy.ndarray): A numpy array of shape (N, 3).
+        depositions (numpy.ndarray): A numpy array of shape (N,).
+        radius (float): Radius (in cm) of the neighborhood.
+
+    Returns:
+        tuple: Number of points within radius and the sum of their depositions.
+    """
+    points = np.ascontiguousarray(points)
+    if points.dtype == np.float32:
+        center = np.asarray(center, dtype=np.float32)
+        limit, compare_squared = float(np.float32(radius)**2), True
+    else:
+        center = np.asarray(center, dtype=np.float64)
+        points = points.astype(np.float64, copy=False)
+        limit, compare_squared = float(radius), False
+
+    return get_numba_kernels()['radius_density'](center, points, np.ascontiguousarray(depositions),
+                                                 limit, compare_squared)
+
+def validate_kernels(tracks, crthits, config):
+    """
+    Compare the Numba kernels with the NumPy path on a set of tracks and CRT
+    hits. End points are estimated with each kernel on copies of the tracks.
+
+    Parameters:
+        tracks (list): List of matcha.Track instances.
+        crthits (list): List of matcha.CRTHit instances.
+        config (dict): Dictionary from parsing matcha config file
+
+    Returns:
+        dict: Dictionary with keys 'max_endpoint_deviation' (cm), 'max_dca_deviation'
+              (cm, over finite DCAs), 'n_infinite_mismatches' (hits with np.inf on
+              one path only) and 'n_match_mismatches' (tracks with a different
+              best CRT hit).
+    """
+    import copy
+    from .match_maker import get_track_endpoints, get_track_crthit_dcas
+
+    if not is_numba_available():
+        raise ValueError('numba must be installed to validate the kernels')
+
+    crthit_columns = get_crthit_columns(crthits, config['dca_parameters'])
+
+    def get_kernel_results(kernel):
+        pca_parameters = dict(config['pca_parameters'], kernel=kernel)
+        dca_parameters = dict(config['dca_parameters'], kernel=kernel, yz_pruning=False, top_k=0)
+        results = []
+        for track in copy.deepcopy(tracks):
+            track_points = get_track_endpoints(track, pca_parameters)
+            dcas = get_track_crthit_dcas(*track_points, crthit_columns, dca_parameters)
+            positions = np.array([[point.position_x, point.position_y, point.position_z]
+                                  for point in track_points], dtype=np.float64)
+            results.append((positions, dcas))
+        return results
+
+    max_endpoint_deviation, max_dca_deviation = 0., 0.
+    n_infinite_mismatches, n_match_mismatches = 0, 0
+    threshold = config['dca_parameters']['threshold']
+    for (numpy_positions, numpy_dcas), (numba_positions, numba_dcas) in zip(
+            get_kernel_results(NUMPY_KERNEL), get_kernel_results(NUMBA_KERNEL)):
+        max_endpoint_deviation = max(max_endpoint_deviation, np.abs(numpy_positions - numba_positions).max())
+        is_finite = np.isfinite(numpy_dcas) & np.isfinite(numba_dcas)
+        n_infinite_mismatches += int(np.sum(np.isfinite(numpy_dcas) != np.isfinite(numba_dcas)))
+        if is_finite.any():
+            max_dca_deviation = max(max_dca_deviation, np.abs(numpy_dcas[is_finite] - numba_dcas[is_finite]).max())
+        if len(numpy_dcas) == 0: continue
+        numpy_best = np.argmin(numpy_dcas) if numpy_dcas.min() <= threshold else -1
+        numba_best = np.argmin(numba_dcas) if numba_dcas.min() <= threshold else -1
+        n_match_mismatches += int(numpy_best != numba_best)
+
+    return {
+        'max_endpoint_deviation': float(max_endpoint_deviation),
+        'max_dca_deviation': float(max_dca_deviation),
+        'n_infinite_mismatches': n_infinite_mismatches,
+        'n_match_mismatches': n_match_mismatches,
+    }
@@ -0,0 +1,45 @@
+import functools
+"""
+Pickle support for the slotted matcha data classes.
+
+Track, TrackPoint, CRTHit and MatchCandidate used to keep their attributes
+in an instance __dict__ as underscore-prefixed names behind properties, and
+pickles such as data/sample_output.pkl store that dictionary. The classes
+now use __slots__ with public attribute names; this mixin converts between
+the two, so old pickles load and new pickles keep the old layout.
+"""
+
+@functools.lru_cache(maxsize=None)
+def get_state_keys(cls):
+    """
+    Pair each slot of a class with its underscore-prefixed state key. The keys
+    are built once per class, so that pickle stores each key string only once
+    per pickle instead of once per object.
+
+    Parameters:
+        cls (type): Slotted class using LegacyStateMixin.
+
+    Returns:
+        tuple: Tuple of (slot name, state key) tuples.
+    """
+    return tuple((name, '_' + name) for name in cls.__slots__)
+
+class LegacyStateMixin:
+    """
+    Mixin giving a slotted class the pickle state of its former __dict__-based version.
+
+    Methods:
+        __getstate__(): Dictionary of the set attributes, keyed by underscore-prefixed names.
+        __setstate__(state): Restore attributes from such a dictionary (with or
+            without the underscore prefix).
+    """
+    __slots__ = ()
+
+    def __getstate__(self):
+        return {key: getattr(self, name) for name, key in get_state_keys(type(self)) if hasattr(self, name)}
+
+    def __setstate__(self, state):
+        # Pickles written by other tools may hold (None, slots) tuples
+        if isinstance(state, tuple): state = {**(state[0] or {}), **state[1]}
+        for key, value in state.items():
+            setattr(self, key[1:] if key.startswith('_') else key, value)
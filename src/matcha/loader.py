@@ -4,13 +4,16 @@ import yaml
 Module to load and validate the yaml config file.
 """
 
-def validate_config(config):
+def validate_config(config, check_paths=True):
 
     trigger_timestamp = config['dca_parameters']['trigger_timestamp']
     isdata = config['dca_parameters']['isdata']
     if trigger_timestamp is None and isdata == True:
         raise ValueError('trigger_timestamp must be specified when isdata = True')
 
+    if not check_paths:
+        return True
+
     file_save_config = config['file_save_config']
     save_file_path = file_save_config['save_file_path']
     if not os.path.exists(save_file_path):
@@ -18,12 +21,14 @@ def validate_config(config):
 
     return True
 
-def load_config(file_path):
+def load_config(file_path, check_paths=True):
     """
     Load the yaml configuration file.
 
     Parameters:
         file_path (str): Path to the yaml configuraiton file.
+        check_paths (bool, optional): Check that save_file_path exists. Disable it
+                                      when the config is used on another machine. Default: True
 
     Returns:
         dict: Dictionary containing yaml configuration.
@@ -31,7 +36,7 @@ def load_config(file_path):
     with open(file_path, 'r') as file:
         config = yaml.safe_load(file)
 
-    validate_config(config)
+    validate_config(config, check_paths)
     print('*******Running with config********\n', yaml.dump(config))
     print('**********************************')
 
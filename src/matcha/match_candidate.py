@@ -1,8 +1,9 @@
 import sys
 from .track import Track
 from .crthit import CRTHit
+from .legacy_state import LegacyStateMixin
 
-class MatchCandidate:
+class MatchCandidate(LegacyStateMixin):
     """
     Represents a candidate match between a Track object and a CRTHit object.
 
@@ -17,33 +18,14 @@ class MatchCandidate:
     Methods:
         None
     """
+    __slots__ = ('track_id', 'crthit_id', 'distance_of_closest_approach')
+
     def __init__(self, track_id, crthit_id, distance_of_closest_approach):
-        self._track_id  = track_id
-        self._crthit_id = crthit_id
-        self._distance_of_closest_approach = distance_of_closest_approach
+        self.track_id  = track_id
+        self.crthit_id = crthit_id
+        self.distance_of_closest_approach = distance_of_closest_approach
 
     def __str__(self):
         return (f"[MATCH_CANDIDATE] Track ID {self.track_id}, CRTHit ID {self.crthit_id}\n\t"
                 f"DCA {self.distance_of_closest_approach}")
 
-    @property
-    def track_id(self):
-        return self._track_id
-    @track_id.setter
-    def track_id(self, value):
-        self._track_id = value
-
-    @property
-    def crthit_id(self):
-        return self._crthit_id
-    @crthit_id.setter
-    def crthit_id(self, value):
-        self._crthit_id = value
-
-    @property
-    def distance_of_closest_approach(self):
-        return self._distance_of_closest_approach
-    @distance_of_closest_approach.setter
-    def distance_of_closest_approach(self, value):
-        self._distance_of_closest_approach = value
-
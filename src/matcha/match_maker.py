@@ -1,10 +1,20 @@
 import os
-from .track import Track
+from .track import Track, NATIVE_PRECISION
 from .track_point import TrackPoint
 from .crthit import CRTHit
+from .crthit_clustering import get_clustered_crthits
 from .match_candidate import MatchCandidate
 from .writer import write_to_file
+from .endpoint_cache import get_endpoint_cache
 from .dca_methods import calculate_distance_of_closest_approach, simple_dca
+from .dca_methods import get_crthit_columns, get_max_tile_pairs, calculate_distance_of_closest_approach_batch
+from .dca_methods import get_track_point_arrays, get_yz_pruning_mask, get_top_k, get_top_k_indices
+from .dca_methods import get_top_k_check_interval
+from .dca_methods import EVENT_DCA_BYTES_PER_PAIR
+from .crt_plane_methods import calculate_crt_plane_distance_batch
+from .crt_geometry import load_crt_geometry, get_crthit_walls, DEFAULT_CRT_GEOMETRY_PATH
+from .kernels import resolve_kernel, track_dcas_numba, warn_numpy_only_dca_parameters, NUMPY_KERNEL, NUMBA_KERNEL
+from .kernels import NUMPY_ONLY_DCA_PARAMETERS
 from matcha.loader import load_config
 import numpy as np
 
@@ -12,6 +22,10 @@ import numpy as np
 MATCHA_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 DEFAULT_CONFIG_PATH = "{:s}/config/default.yaml".format(MATCHA_DIR)
 
+# Regions in which a TrackPoint can be drift-shifted
+TPC_REGION_NAMES = ['EE', 'EW', 'WE', 'WW']
+MATCHING_METHODS = ['dca', 'crt_plane']
+
 """
 Main functions for performing CRT-TPC matching.
 """
@@ -33,12 +47,7 @@ def get_track_crthit_matches(tracks, crthits, config_path=DEFAULT_CONFIG_PATH):
 
     config = load_config(config_path)
 
-    track_best_matches = []
-    for track in tracks:
-        track_match_candidates = get_track_match_candidates(track, crthits, config)
-        if not track_match_candidates: continue
-        track_best_match = get_track_best_match(track_match_candidates)
-        track_best_matches.append(track_best_match)
+    track_best_matches = get_track_best_matches(tracks, crthits, config)
 
     # TODO This is deprecated but kept here for compatibility. Should
     # be removed at some point.
@@ -61,25 +70,231 @@ def get_track_crthit_matches(tracks, crthits, config_path=DEFAULT_CONFIG_PATH):
 
     return best_matches
 
-def get_track_match_candidates(track, crthits, config):
+def get_track_best_matches(tracks, crthits, config, stats=None):
     """
-    Given a Track, loop over CRT hits and calculate DCA for each. If DCA falls
-    below threshold, create a MatchCandidate instance. 
+    Find the best MatchCandidate for each Track given an already-loaded config.
+    Unlike get_track_crthit_matches, nothing is written to disk.
+
+    Parameters:
+        tracks (list): List of matcha.Track instances to be matched.
+        crthits (list): List of matcha.CRTHit instances to be matched.
+        config (dict): Dictionary from parsing matcha config file
+        stats (dict, optional): If provided, pruning counters and the peak working
+                                set are added to it, see get_track_crthit_dcas, as
+                                well as CRT hit clustering counters, see
+                                matcha.crthit_clustering, and top_k check counters,
+                                see check_top_k_match. Default: None
+
+    Returns:
+        list: List of MatchCandidates, at most one per Track.
+    """
+    crthits = get_clustered_crthits(crthits, config, stats)
+    crthit_columns = get_event_crthit_columns(crthits, config)
+    endpoint_cache = get_endpoint_cache(config)
+    use_fused_kernel = get_matching_method(config) == 'dca' \
+        and get_dca_kernel(config['dca_parameters']) == NUMBA_KERNEL
+    check_top_k = stats is not None and get_matching_method(config) == 'dca' \
+        and get_top_k(config['dca_parameters']) > 0 and get_top_k_check_interval(config['dca_parameters']) > 0
+
+    track_best_matches = []
+    for track in tracks:
+        if use_fused_kernel:
+            track_best_match = get_track_fused_best_match(track, config, crthit_columns, endpoint_cache)
+            if track_best_match is not None: track_best_matches.append(track_best_match)
+            continue
+        track_match_candidates = get_track_match_candidates(track, crthits, config, 
+                                                            crthit_columns, endpoint_cache, stats)
+        if check_top_k:
+            check_top_k_match(track, track_match_candidates, crthits, config, crthit_columns, endpoint_cache, stats)
+        if not track_match_candidates: continue
+        track_best_match = get_track_best_match(track_match_candidates)
+        track_best_matches.append(track_best_match)
+
+    return track_best_matches
+
+def check_top_k_match(track, track_match_candidates, crthits, config, crthit_columns, endpoint_cache, stats):
+    """
+    Count the best matches lost to dca_parameters.top_k while matching. One
+    track in dca_parameters.top_k_check_interval is matched again with every
+    CRT hit, and is missed if its best match differs from the top_k one.
+
+    Parameters:
+        track (Track): matcha.Track instance matched with top_k.
+        track_match_candidates (list): Output of get_track_match_candidates with top_k.
+        crthits (list): List of matcha.CRTHit instances to be matched.
+        config (dict): Dictionary from parsing matcha config file
+        crthit_columns (dict): Output of get_event_crthit_columns.
+        endpoint_cache (EndpointCache): On-disk cache of estimated end points, or None.
+        stats (dict): 'n_top_k_tracks', 'n_top_k_checked_tracks' and
+                      'n_top_k_missed_tracks' are incremented.
+    """
+    n_top_k_tracks = stats.get('n_top_k_tracks', 0)
+    stats['n_top_k_tracks'] = n_top_k_tracks + 1
+    if n_top_k_tracks % get_top_k_check_interval(config['dca_parameters']): return
+
+    full_config = dict(config, dca_parameters=dict(config['dca_parameters'], top_k=0))
+    full_match_candidates = get_track_match_candidates(track, crthits, full_config, crthit_columns, endpoint_cache)
+    best_matches = []
+    for match_candidates in (track_match_candidates, full_match_candidates):
+        best_match = get_track_best_match(match_candidates) if match_candidates else None
+        best_matches.append(None if best_match is None else
+                            (best_match.crthit_id, best_match.distance_of_closest_approach))
+
+    stats['n_top_k_checked_tracks'] = stats.get('n_top_k_checked_tracks', 0) + 1
+    stats['n_top_k_missed_tracks'] = stats.get('n_top_k_missed_tracks', 0) + int(best_matches[0] != best_matches[1])
+
+def get_track_match_candidates(track, crthits, config, crthit_columns=None, endpoint_cache=None, stats=None):
+    """
+    Given a Track, calculate the DCA (or CRT-plane distance, depending on the
+    matching_method) to every CRT hit. If it falls below threshold, create a 
+    MatchCandidate instance. 
 
     Parameters:
         track (Track): matcha.Track instances to be matched.
         crthits (list): List of matcha.CRTHit instances to be matched.
         config (dict): Dictionary from parsing matcha config file
+        crthit_columns (dict, optional): Output of get_event_crthit_columns(crthits, config). 
+                                         Built here if not provided. Default: None
+        endpoint_cache (EndpointCache, optional): On-disk cache of estimated end points.
+                                                  Default: None (no caching)
+        stats (dict, optional): If provided, pruning counters are added to it,
+                                see get_track_crthit_dcas. Default: None
 
     Returns: 
-        list: list of MatchCandidates with DCA below approach_distance_threshold.
+        list: list of MatchCandidates with distance below approach_distance_threshold.
     """
 
+    pca_parameters = config['pca_parameters']
+    approach_distance_threshold = get_matching_threshold(config)
+
+    if crthit_columns is None:
+        crthit_columns = get_event_crthit_columns(crthits, config)
+
+    track_startpoint, track_endpoint = get_track_endpoints(track, pca_parameters, endpoint_cache)
+
+    dcas = get_track_crthit_distances(track_startpoint, track_endpoint, crthit_columns, config, stats)
+
     match_candidates = []
+    for crthit_index in np.flatnonzero(dcas <= approach_distance_threshold):
+        match_candidate = MatchCandidate(track.id, crthit_columns['ids'][crthit_index].item(), dcas[crthit_index])
+        match_candidates.append(match_candidate)
+
+    return match_candidates
+
+def get_track_fused_best_match(track, config, crthit_columns, endpoint_cache=None):
+    """
+    Find the best MatchCandidate of a Track with the Numba DCA kernel, which
+    applies the threshold and finds the minimum in the same pass as the DCA.
+    Gives the same result as get_track_best_match(get_track_match_candidates(...)).
+
+    Parameters:
+        track (Track): matcha.Track instance to be matched.
+        config (dict): Dictionary from parsing matcha config file
+        crthit_columns (dict): Output of get_event_crthit_columns.
+        endpoint_cache (EndpointCache, optional): On-disk cache of estimated end points.
+                                                  Default: None (no caching)
+
+    Returns:
+        MatchCandidate: Best MatchCandidate, or None if no DCA is below threshold.
+    """
     dca_parameters = config['dca_parameters']
-    pca_parameters = config['pca_parameters']
-    approach_distance_threshold = dca_parameters['threshold']
+    track_startpoint, track_endpoint = get_track_endpoints(track, config['pca_parameters'], endpoint_cache)
+    dcas, best_index = track_dcas_numba(track_startpoint, track_endpoint, crthit_columns['positions'],
+                                        crthit_columns['times'], dca_parameters, dca_parameters['threshold'])
+    if best_index < 0: return None
+
+    return MatchCandidate(track.id, crthit_columns['ids'][best_index].item(), dcas[best_index])
+
+def get_dca_kernel(dca_parameters):
+    """
+    Get the kernel that calculates DCAs, see matcha.kernels. The Numba kernel
+    does not implement NUMPY_ONLY_DCA_PARAMETERS (yz_pruning and top_k), so the
+    numpy kernel is used, with a warning, when any of them is set.
+
+    Parameters:
+        dca_parameters (dict): Loaded DCA parameters from matcha config file
+
+    Returns:
+        str: NUMPY_KERNEL or NUMBA_KERNEL.
+    """
+    kernel = resolve_kernel(dca_parameters.get('kernel', NUMPY_KERNEL))
+    if kernel == NUMBA_KERNEL:
+        numpy_only_parameters = tuple(key for key in NUMPY_ONLY_DCA_PARAMETERS if dca_parameters.get(key))
+        if numpy_only_parameters:
+            warn_numpy_only_dca_parameters(numpy_only_parameters)
+            return NUMPY_KERNEL
+    return kernel
+
+def get_matching_method(config):
+    """
+    Get the configured matching method.
+
+    Parameters:
+        config (dict): Dictionary from parsing matcha config file
+
+    Returns:
+        str: One of MATCHING_METHODS.
+    """
+    matching_method = config['match_making_parameters']['matching_method']
+    if matching_method not in MATCHING_METHODS:
+        raise ValueError('Invalid matching_method {:s}, must be one of {}'.format(
+            str(matching_method), MATCHING_METHODS))
+    return matching_method
+
+def get_matching_threshold(config):
+    """
+    Get the distance threshold (in cm) of the configured matching method.
+
+    Parameters:
+        config (dict): Dictionary from parsing matcha config file
+
+    Returns:
+        float: Distance threshold below which a MatchCandidate is created.
+    """
+    if get_matching_method(config) == 'crt_plane':
+        return config['crt_plane_parameters']['threshold']
+    return config['dca_parameters']['threshold']
+
+def get_event_crthit_columns(crthits, config):
+    """
+    Build the CRT hit columns needed by the configured matching method. For
+    the crt_plane method, the wall index of each hit ('walls'), the CRT 
+    geometry ('crt_geometry') and the wall tolerance ('wall_tolerance') are
+    added to the output of get_crthit_columns.
+
+    Parameters:
+        crthits (list): List of matcha.CRTHit instances.
+        config (dict): Dictionary from parsing matcha config file
+
+    Returns:
+        dict: CRT hit columns.
+    """
+    crthit_columns = get_crthit_columns(crthits, config['dca_parameters'])
+    if get_matching_method(config) == 'crt_plane':
+        crt_plane_parameters = config['crt_plane_parameters']
+        geometry_path = crt_plane_parameters.get('geometry_path') or DEFAULT_CRT_GEOMETRY_PATH
+        crt_geometry = load_crt_geometry(geometry_path)
+        crthit_columns['walls'] = get_crthit_walls(crthit_columns['positions'], crt_geometry,
+                                                   crt_plane_parameters['wall_tolerance'])
+        crthit_columns['crt_geometry'] = crt_geometry
+        crthit_columns['wall_tolerance'] = crt_plane_parameters['wall_tolerance']
+
+    return crthit_columns
+
+def get_track_endpoints(track, pca_parameters, endpoint_cache=None):
+    """
+    Build the start and end TrackPoints of a Track. User-provided positions and
+    directions are used when available, otherwise they are estimated with PCA.
 
+    Parameters:
+        track (Track): matcha.Track instance.
+        pca_parameters (dict): Dictionary of PCA parameters from loaded matcha config file
+        endpoint_cache (EndpointCache, optional): On-disk cache of estimated end points.
+                                                  Default: None (no caching)
+
+    Returns:
+        tuple: Start and end point TrackPoint instances.
+    """
     # Initialize start and end points with user-provided information.
     track_startpoint = TrackPoint(track_id=track.id, 
         position_x=track.start_x, position_y=track.start_y, position_z=track.start_z,
@@ -92,21 +307,190 @@ def get_track_match_candidates(track, crthits, config):
 
     # If start and end point posistions and directions are not provided, estimate them. 
     if not track_startpoint.is_valid() or not track_endpoint.is_valid():
-        track_startpoint, track_endpoint = track.get_endpoints(pca_parameters)
-
-    # Loop all CRTHits and determine which are considered match candidates.
-    # TODO I think we'll need to factorize the matching method for more than just DCA.
-    for crt_hit in crthits:
-        closest_track_point = get_closest_track_point(crt_hit, track_startpoint, track_endpoint)
-        if closest_track_point.tpc_region.name not in ['EE', 'EW', 'WE', 'WW']: continue
-        dca = calculate_distance_of_closest_approach(
-            closest_track_point, crt_hit, dca_parameters
+        # The estimate uses cast copies of the points; the caller's arrays are put back
+        points, depositions = track.points, track.depositions
+        track.set_precision(pca_parameters.get('precision', NATIVE_PRECISION))
+        try:
+            if endpoint_cache is not None:
+                track_startpoint, track_endpoint = endpoint_cache.get_endpoints(track, pca_parameters)
+            else:
+                track_startpoint, track_endpoint = track.get_endpoints(pca_parameters)
+        finally:
+            track.points, track.depositions = points, depositions
+
+    return track_startpoint, track_endpoint
+
+def get_track_crthit_distances(track_startpoint, track_endpoint, crthit_columns, config, stats=None):
+    """
+    Calculate the distance used by the configured matching method between a 
+    Track and every CRT hit, without applying the threshold.
+
+    Parameters:
+        track_startpoint (TrackPoint): Track start point.
+        track_endpoint (TrackPoint): Track end point.
+        crthit_columns (dict): Output of get_event_crthit_columns.
+        config (dict): Dictionary from parsing matcha config file
+        stats (dict, optional): If provided, pruning counters are added to it,
+                                see get_track_crthit_dcas. Default: None
+
+    Returns:
+        numpy.ndarray: Distances of shape (N,), one per CRT hit.
+    """
+    dca_parameters = config['dca_parameters']
+    if get_matching_method(config) == 'crt_plane':
+        return get_track_crthit_plane_distances(track_startpoint, track_endpoint, 
+                                                crthit_columns, dca_parameters)
+    return get_track_crthit_dcas(track_startpoint, track_endpoint, crthit_columns, dca_parameters, stats)
+
+def get_track_crthit_dcas(track_startpoint, track_endpoint, crthit_columns, dca_parameters, stats=None):
+    """
+    Calculate the DCA between a Track and every CRT hit, without applying the 
+    threshold. Each hit is compared with whichever end point is closest to it, 
+    as in get_closest_track_point, and hits whose closest end point lies outside 
+    the TPCs are given a DCA of np.inf. With the numpy kernel, hits are evaluated
+    in tiles of at most get_max_tile_pairs(dca_parameters) hits.
+
+    If dca_parameters['yz_pruning'] is set, hits whose y-z lower bound (see
+    get_yz_lower_bounds) exceeds the threshold are given a DCA of np.inf
+    without shifting the end point, so DCAs above threshold are no longer
+    exact.
+
+    If dca_parameters['top_k'] is non-zero, the DCA is only calculated for the
+    top_k hits nearest to the line through each end point before it is
+    shifted (after pruning), see get_top_k_indices. The other hits are given
+    a DCA of np.inf, so a best match outside the top_k is missed;
+    parameter_scan.scan_top_k measures how often this happens, and
+    dca_parameters.top_k_check_interval samples it while matching. Both
+    options select the numpy kernel, see get_dca_kernel.
+
+    Parameters:
+        track_startpoint (TrackPoint): Track start point.
+        track_endpoint (TrackPoint): Track end point.
+        crthit_columns (dict): Output of get_crthit_columns.
+        dca_parameters (dict): Loaded DCA parameters from matcha config file
+        stats (dict, optional): If provided, 'peak_working_set_bytes' is raised to the
+                                estimated working set of the largest tile, see
+                                EVENT_DCA_BYTES_PER_PAIR (numpy kernel only).
+                                If pruning is enabled, 'n_pairs' and 'n_pruned_pairs'
+                                are incremented by the number of end point/CRT hit
+                                pairs considered and pruned, and with top_k,
+                                'n_top_k_skipped_pairs' by the number of pairs left
+                                out of the top_k. Default: None
+
+    Returns:
+        numpy.ndarray: DCA values of shape (N,), one per CRT hit.
+    """
+    crthit_positions = crthit_columns['positions']
+    crthit_times = crthit_columns['times']
+    if get_dca_kernel(dca_parameters) == NUMBA_KERNEL:
+        dcas, _ = track_dcas_numba(track_startpoint, track_endpoint, crthit_positions, crthit_times, dca_parameters)
+        return dcas
+
+    dcas = np.full(len(crthit_positions), np.inf)
+    max_tile_pairs = get_max_tile_pairs(dca_parameters)
+    use_yz_pruning = dca_parameters.get('yz_pruning', False)
+    top_k = get_top_k(dca_parameters)
+
+    for track_point, hit_mask in get_shiftable_track_point_masks(crthit_positions, track_startpoint, track_endpoint):
+        # Evaluate the hits in tiles to stay within dca_parameters.memory_budget_mb
+        hit_indices = np.flatnonzero(hit_mask)
+        if use_yz_pruning:
+            n_pairs = len(hit_indices)
+            position, direction, _ = get_track_point_arrays(track_point)
+            hit_indices = hit_indices[get_yz_pruning_mask(position, direction, crthit_positions[hit_indices],
+                                                          dca_parameters['threshold'])]
+            if stats is not None:
+                stats['n_pairs'] = stats.get('n_pairs', 0) + n_pairs
+                stats['n_pruned_pairs'] = stats.get('n_pruned_pairs', 0) + n_pairs - len(hit_indices)
+            if not len(hit_indices): continue
+        if top_k and len(hit_indices) > top_k:
+            if stats is not None:
+                stats['n_top_k_skipped_pairs'] = stats.get('n_top_k_skipped_pairs', 0) + len(hit_indices) - top_k
+            position, direction, _ = get_track_point_arrays(track_point)
+            hit_indices = hit_indices[get_top_k_indices(position, direction, crthit_positions[hit_indices], top_k)]
+        tile_size = max_tile_pairs or len(hit_indices)
+        for first_hit in range(0, len(hit_indices), tile_size):
+            tile_indices = hit_indices[first_hit:first_hit + tile_size]
+            dcas[tile_indices] = calculate_distance_of_closest_approach_batch(
+                track_point, crthit_positions[tile_indices], crthit_times[tile_indices], dca_parameters
+            )
+            if stats is not None:
+                stats['peak_working_set_bytes'] = max(stats.get('peak_working_set_bytes', 0),
+                                                      len(tile_indices) * EVENT_DCA_BYTES_PER_PAIR)
+
+    return dcas
+
+def get_track_crthit_plane_distances(track_startpoint, track_endpoint, crthit_columns, dca_parameters):
+    """
+    Calculate the CRT-plane distance between a Track and every CRT hit, without 
+    applying the threshold. End points are chosen per hit as in get_track_crthit_dcas.
+
+    Parameters:
+        track_startpoint (TrackPoint): Track start point.
+        track_endpoint (TrackPoint): Track end point.
+        crthit_columns (dict): Output of get_event_crthit_columns for the crt_plane method.
+        dca_parameters (dict): Loaded DCA parameters from matcha config file
+
+    Returns:
+        numpy.ndarray: In-plane distances of shape (N,), one per CRT hit.
+    """
+    crthit_positions = crthit_columns['positions']
+    distances = np.full(len(crthit_positions), np.inf)
+
+    for track_point, hit_mask in get_shiftable_track_point_masks(crthit_positions, track_startpoint, track_endpoint):
+        distances[hit_mask] = calculate_crt_plane_distance_batch(
+            track_point, crthit_positions[hit_mask], crthit_columns['times'][hit_mask],
+            crthit_columns['walls'][hit_mask], crthit_columns['crt_geometry'], dca_parameters,
+            crthit_columns['wall_tolerance']
         )
-        if dca > approach_distance_threshold: continue
-        match_candidate = MatchCandidate(track.id, crt_hit.id, dca)
-        match_candidates.append(match_candidate)
 
-    return match_candidates
+    return distances
+
+def get_shiftable_track_point_masks(crthit_positions, track_startpoint, track_endpoint):
+    """
+    Split the CRT hits between the track end points closest to them, keeping
+    only end points inside a TPC drift region.
+
+    Parameters:
+        crthit_positions (numpy.ndarray): CRT hit positions of shape (N, 3).
+        track_startpoint (TrackPoint): Track start point.
+        track_endpoint (TrackPoint): Track end point.
+
+    Returns:
+        list: List of (TrackPoint, hit_mask) tuples, where hit_mask is a boolean
+              array of shape (N,) selecting the hits closest to that TrackPoint.
+    """
+    is_closest_to_start = get_closest_track_point_mask(crthit_positions, track_startpoint, track_endpoint)
+
+    track_point_masks = []
+    for track_point, hit_mask in ((track_startpoint, is_closest_to_start), 
+                                  (track_endpoint, ~is_closest_to_start)):
+        if track_point.tpc_region.name not in TPC_REGION_NAMES: continue
+        if not hit_mask.any(): continue
+        track_point_masks.append((track_point, hit_mask))
+
+    return track_point_masks
+
+def get_closest_track_point_mask(crthit_positions, track_startpoint, track_endpoint):
+    """
+    Vectorized counterpart of get_closest_track_point.
+
+    Parameters:
+        crthit_positions (numpy.ndarray): CRT hit positions of shape (N, 3).
+        track_startpoint (TrackPoint): Track start point.
+        track_endpoint (TrackPoint): Track end point.
+
+    Returns:
+        numpy.ndarray: Boolean array of shape (N,), True where the start point 
+                       is at least as close to the CRT hit as the end point.
+    """
+    startpoint = np.array([track_startpoint.position_x, track_startpoint.position_y, track_startpoint.position_z])
+    endpoint   = np.array([track_endpoint.position_x, track_endpoint.position_y, track_endpoint.position_z])
+
+    distance_to_start = np.linalg.norm(crthit_positions - startpoint, axis=1)
+    distance_to_end   = np.linalg.norm(crthit_positions - endpoint, axis=1)
+
+    return distance_to_start <= distance_to_end
 
 def get_closest_track_point(crt_hit, track_startpoint, track_endpoint):
     """
@@ -166,16 +550,3 @@ def get_crthit_best_matches(track_best_matches):
     Deprecated, should be removed.
     """
     return track_best_matches
-
-        
-
-
-
-
-
-
-
-
-
-
-
@@ -0,0 +1,203 @@
+import copy
+import numpy as np
+from .match_candidate import MatchCandidate
+from .endpoint_cache import get_endpoint_cache
+from .dca_methods import get_track_point_arrays, get_unshifted_distance_ranks, get_yz_pruning_mask
+from .match_maker import get_track_endpoints, get_track_crthit_distances, get_event_crthit_columns
+from .match_maker import get_track_crthit_dcas, get_shiftable_track_point_masks
+"""
+Functions for scanning the DCA threshold and PCA radius without re-running
+the full matcher for every value.
+
+End points only depend on the PCA parameters and the raw DCAs only depend on
+the end points, so both are computed once per radius. The threshold is the
+final cut of the matcher, so the best match, efficiency and purity at every
+threshold are read off the per-track minimum DCAs after a single sort.
+Likewise, the rank of each best match by its distance to the unshifted
+track line gives the matches lost by every dca_parameters.top_k at once.
+"""
+
+def scan_matching_parameters(tracks, crthits, config, thresholds, radii=None, true_matches=None):
+    """
+    Scan over DCA thresholds and PCA radii.
+
+    Parameters:
+        tracks (list): List of matcha.Track instances to be matched.
+        crthits (list): List of matcha.CRTHit instances to be matched.
+        config (dict): Dictionary from parsing matcha config file
+        thresholds (list): DCA (or CRT-plane distance) thresholds in cm to scan.
+        radii (list, optional): PCA radii (in cm) to scan. Default: None,
+                                which uses pca_parameters['radius'] from config.
+        true_matches (dict, optional): Dictionary mapping true Track IDs to CRTHit
+                                       IDs used to calculate efficiency and purity.
+                                       Default: None (not calculated).
+
+    Returns:
+        list: One dictionary per (radius, threshold) pair with keys 'radius',
+              'threshold', 'n_matches', 'efficiency', 'purity' and 'best_matches',
+              the latter being the MatchCandidates that get_track_best_matches
+              would return with those parameters, ordered by DCA.
+    """
+    if radii is None:
+        radii = [config['pca_parameters']['radius']]
+
+    crthit_columns = get_event_crthit_columns(crthits, config)
+
+    scan_results = []
+    for radius in radii:
+        scan_config = copy.deepcopy(config)
+        scan_config['pca_parameters']['radius'] = radius
+        # Pruning is relative to the configured threshold, not the scanned ones
+        scan_config['dca_parameters']['yz_pruning'] = False
+        track_min_dcas = get_track_min_dcas(tracks, crthit_columns, scan_config)
+        radius_results = scan_thresholds(track_min_dcas, thresholds, true_matches)
+        for result in radius_results:
+            result['radius'] = radius
+        scan_results.extend(radius_results)
+
+    return scan_results
+
+def get_track_min_dcas(tracks, crthit_columns, config):
+    """
+    Calculate the minimum DCA of each Track and the CRT hit it belongs to.
+    These do not depend on the DCA threshold.
+
+    Parameters:
+        tracks (list): List of matcha.Track instances to be matched.
+        crthit_columns (dict): Output of get_event_crthit_columns.
+        config (dict): Dictionary from parsing matcha config file
+
+    Returns:
+        dict: Dictionary with keys 'track_ids', 'crthit_ids' and 'dcas', each of
+              shape (n_tracks,), sorted by increasing DCA. Tracks without any
+              valid DCA have a DCA of np.inf.
+    """
+    n_tracks = len(tracks)
+    endpoint_cache = get_endpoint_cache(config)
+    track_ids = np.array([track.id for track in tracks])
+    crthit_ids = np.full(n_tracks, -1, dtype=np.asarray(crthit_columns['ids']).dtype)
+    min_dcas = np.full(n_tracks, np.inf)
+
+    if len(crthit_columns['ids']) > 0:
+        for track_index, track in enumerate(tracks):
+            track_startpoint, track_endpoint = get_track_endpoints(track, config['pca_parameters'], endpoint_cache)
+            dcas = get_track_crthit_distances(track_startpoint, track_endpoint,
+                                              crthit_columns, config)
+            # argmin picks the first minimum, like get_track_best_match
+            best_index = np.argmin(dcas)
+            min_dcas[track_index] = dcas[best_index]
+            crthit_ids[track_index] = crthit_columns['ids'][best_index]
+
+    order = np.argsort(min_dcas, kind='stable')
+
+    return {'track_ids': track_ids[order], 'crthit_ids': crthit_ids[order], 'dcas': min_dcas[order]}
+
+def scan_thresholds(track_min_dcas, thresholds, true_matches=None):
+    """
+    Derive the best matches, efficiency and purity at each threshold from the
+    sorted per-track minimum DCAs.
+
+    Efficiency is the fraction of true matches that are selected, and purity
+    is the fraction of selected matches that are true.
+
+    Parameters:
+        track_min_dcas (dict): Output of get_track_min_dcas.
+        thresholds (list): DCA thresholds (in cm) to scan.
+        true_matches (dict, optional): Dictionary mapping true Track IDs to CRTHit
+                                       IDs. Default: None (not calculated).
+
+    Returns:
+        list: One dictionary per threshold. See scan_matching_parameters.
+    """
+    track_ids  = track_min_dcas['track_ids']
+    crthit_ids = track_min_dcas['crthit_ids']
+    dcas       = track_min_dcas['dcas']
+
+    # Tracks are sorted by DCA, so the matches passing a threshold are a prefix
+    n_matches_per_threshold = np.searchsorted(dcas, thresholds, side='right')
+
+    n_correct_cumulative = None
+    if true_matches is not None:
+        is_correct = np.array([true_matches.get(track_id) == crthit_id
+                               for track_id, crthit_id in zip(track_ids, crthit_ids)], dtype=bool)
+        n_correct_cumulative = np.concatenate([[0], np.cumsum(is_correct)])
+
+    scan_results = []
+    for threshold, n_matches in zip(thresholds, n_matches_per_threshold):
+        best_matches = [MatchCandidate(track_id, crthit_id, dca) for track_id, crthit_id, dca
+                        in zip(track_ids[:n_matches].tolist(), crthit_ids[:n_matches].tolist(), dcas[:n_matches])]
+        efficiency, purity = None, None
+        if n_correct_cumulative is not None:
+            n_correct = n_correct_cumulative[n_matches]
+            efficiency = n_correct / len(true_matches) if len(true_matches) > 0 else np.nan
+            purity = n_correct / n_matches if n_matches > 0 else np.nan
+        scan_results.append({
+            'threshold': threshold,
+            'n_matches': int(n_matches),
+            'efficiency': efficiency,
+            'purity': purity,
+            'best_matches': best_matches,
+        })
+
+    return scan_results
+
+def scan_top_k(tracks, crthits, config, top_k_values):
+    """
+    Measure how often the best match of a Track falls outside the top_k CRT
+    hits nearest to its unshifted line (see dca_parameters.top_k), i.e. how
+    many matches each top_k would lose. Every DCA is calculated once, and the
+    rank of each best match by unshifted distance is compared with every
+    top_k. As when matching, hits removed by y-z pruning (if
+    dca_parameters.yz_pruning is set) are not ranked.
+
+    Parameters:
+        tracks (list): List of matcha.Track instances to be matched.
+        crthits (list): List of matcha.CRTHit instances to be matched.
+        config (dict): Dictionary from parsing matcha config file
+        top_k_values (list): Values of top_k to scan (0 keeps every hit).
+
+    Returns:
+        list: One dictionary per top_k with keys 'top_k', 'n_matches' (tracks
+              with a DCA below threshold), 'n_misses' (best matches outside the
+              top_k) and 'miss_rate'.
+    """
+    use_yz_pruning = config['dca_parameters'].get('yz_pruning', False)
+    dca_parameters = dict(config['dca_parameters'], yz_pruning=False, top_k=0)
+    threshold = dca_parameters['threshold']
+    crthit_columns = get_event_crthit_columns(crthits, config)
+    crthit_positions = crthit_columns['positions']
+    endpoint_cache = get_endpoint_cache(config)
+
+    best_match_ranks = []
+    if len(crthit_positions) > 0:
+        for track in tracks:
+            track_startpoint, track_endpoint = get_track_endpoints(track, config['pca_parameters'], endpoint_cache)
+            dcas = get_track_crthit_dcas(track_startpoint, track_endpoint, crthit_columns, dca_parameters)
+            # argmin picks the first minimum, like get_track_best_match
+            best_index = np.argmin(dcas)
+            if not dcas[best_index] <= threshold: continue
+            for track_point, hit_mask in get_shiftable_track_point_masks(crthit_positions, track_startpoint,
+                                                                         track_endpoint):
+                if not hit_mask[best_index]: continue
+                hit_indices = np.flatnonzero(hit_mask)
+                position, direction, _ = get_track_point_arrays(track_point)
+                if use_yz_pruning:
+                    # Pruning never removes a hit below threshold, so the best match is kept
+                    hit_indices = hit_indices[get_yz_pruning_mask(position, direction,
+                                                                  crthit_positions[hit_indices], threshold)]
+                ranks = get_unshifted_distance_ranks(position, direction, crthit_positions[hit_indices])
+                best_match_ranks.append(ranks[np.searchsorted(hit_indices, best_index)])
+
+    best_match_ranks = np.array(best_match_ranks, dtype=np.int64)
+    n_matches = len(best_match_ranks)
+    scan_results = []
+    for top_k in top_k_values:
+        n_misses = int(np.sum(best_match_ranks >= top_k)) if top_k > 0 else 0
+        scan_results.append({
+            'top_k': top_k,
+            'n_matches': n_matches,
+            'n_misses': n_misses,
+            'miss_rate': n_misses / n_matches if n_matches > 0 else np.nan,
+        })
+
+    return scan_results
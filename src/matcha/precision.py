@@ -0,0 +1,111 @@
+import copy
+import numpy as np
+from .dca_methods import get_crthit_columns
+from .match_maker import get_track_endpoints, get_track_crthit_dcas
+"""
+Validation of reduced-precision matching against double precision.
+"""
+
+REFERENCE_PRECISION = 'float64'
+
+def validate_precision(tracks, crthits, config, precision='float32'):
+    """
+    Run end point estimation and DCA calculation once in double precision and
+    once with the given precision, and report how much the results differ.
+    The input tracks are not modified.
+
+    Parameters:
+        tracks (list): List of matcha.Track instances to be matched.
+        crthits (list): List of matcha.CRTHit instances to be matched.
+        config (dict): Dictionary from parsing matcha config file
+        precision (str, optional): numpy dtype name to validate. Default: 'float32'
+
+    Returns:
+        dict: Dictionary with keys
+              'max_position_deviation': largest end point position difference (cm),
+              'max_direction_deviation': largest end point direction difference,
+                                         ignoring the sign of the direction,
+              'max_dca_deviation': largest difference between finite DCAs (cm),
+              'n_tracks': number of tracks compared,
+              'n_match_disagreements': number of tracks whose best match (or lack
+                                       of one) differs between the two precisions,
+              'match_agreement': fraction of tracks with the same best match.
+    """
+    reference_results = get_precision_results(tracks, crthits, config, REFERENCE_PRECISION)
+    candidate_results = get_precision_results(tracks, crthits, config, precision)
+
+    max_position_deviation = 0.
+    max_direction_deviation = 0.
+    max_dca_deviation = 0.
+    n_match_disagreements = 0
+    for reference, candidate in zip(reference_results, candidate_results):
+        position_deviation = np.abs(reference['positions'] - candidate['positions']).max()
+        direction_deviation = np.minimum(
+            np.abs(reference['directions'] - candidate['directions']).max(axis=1),
+            np.abs(reference['directions'] + candidate['directions']).max(axis=1)
+        ).max()
+        max_position_deviation = max(max_position_deviation, position_deviation)
+        max_direction_deviation = max(max_direction_deviation, direction_deviation)
+
+        both_finite = np.isfinite(reference['dcas']) & np.isfinite(candidate['dcas'])
+        if both_finite.any():
+            dca_deviation = np.abs(reference['dcas'][both_finite] - candidate['dcas'][both_finite]).max()
+            max_dca_deviation = max(max_dca_deviation, dca_deviation)
+
+        if reference['best_crthit_index'] != candidate['best_crthit_index']:
+            n_match_disagreements += 1
+
+    n_tracks = len(reference_results)
+    match_agreement = 1. - n_match_disagreements / n_tracks if n_tracks > 0 else 1.
+
+    return {
+        'max_position_deviation': float(max_position_deviation),
+        'max_direction_deviation': float(max_direction_deviation),
+        'max_dca_deviation': float(max_dca_deviation),
+        'n_tracks': n_tracks,
+        'n_match_disagreements': n_match_disagreements,
+        'match_agreement': match_agreement,
+    }
+
+def get_precision_results(tracks, crthits, config, precision):
+    """
+    Calculate end points, DCAs and best matches for copies of the tracks
+    with pca_parameters and dca_parameters set to the given precision.
+
+    Parameters:
+        tracks (list): List of matcha.Track instances to be matched.
+        crthits (list): List of matcha.CRTHit instances to be matched.
+        config (dict): Dictionary from parsing matcha config file
+        precision (str): numpy dtype name.
+
+    Returns:
+        list: One dictionary per track with keys 'positions' and 'directions'
+              (each of shape (2, 3)), 'dcas' (shape (n_crthits,)) and
+              'best_crthit_index' (None if there is no match below threshold).
+    """
+    precision_config = copy.deepcopy(config)
+    precision_config['pca_parameters']['precision'] = precision
+    precision_config['dca_parameters']['precision'] = precision
+    precision_config['dca_parameters']['yz_pruning'] = False
+    precision_config['dca_parameters']['top_k'] = 0
+    dca_parameters = precision_config['dca_parameters']
+    threshold = dca_parameters['threshold']
+
+    crthit_columns = get_crthit_columns(crthits, dca_parameters)
+    precision_results = []
+    for track in copy.deepcopy(tracks):
+        track_points = get_track_endpoints(track, precision_config['pca_parameters'])
+        dcas = get_track_crthit_dcas(*track_points, crthit_columns, dca_parameters)
+        best_crthit_index = None
+        if len(dcas) > 0 and dcas.min() <= threshold:
+            best_crthit_index = int(np.argmin(dcas))
+        precision_results.append({
+            'positions': np.array([[point.position_x, point.position_y, point.position_z]
+                                   for point in track_points], dtype=np.float64),
+            'directions': np.array([[point.direction_x, point.direction_y, point.direction_z]
+                                    for point in track_points], dtype=np.float64),
+            'dcas': dcas,
+            'best_crthit_index': best_crthit_index,
+        })
+
+    return precision_results
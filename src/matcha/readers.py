@@ -0,0 +1,707 @@
+import numpy as np
+from .track import Track, NATIVE_PRECISION
+from .crthit import get_ts_mode, T1_TS_MODE
+"""
+Bulk readers for reconstruction output stored as HDF5 (tracks) and Parquet
+(CRT hits).
+
+Files are read column by column into flat numpy buffers instead of Track and
+CRTHit objects. Track point clouds are stored back to back in one 'points'
+array, with 'point_offsets' giving the first point of each track, and both
+tracks and hits carry an 'image_ids' column. get_track_columns_from_buffers and
+get_crthit_columns_from_buffers turn the buffers into the columns used by
+matcha.dataset_matcher; CRT hit buffers are clustered beforehand with
+matcha.crthit_clustering.get_clustered_crthit_buffers. write_hdf5_tracks and write_parquet_crthits write
+buffers in the layout the readers expect, and validate_readers checks that
+events survive the round trip. h5py and pyarrow are only imported by the
+functions that read or write files; install them with the optional 'io' extra.
+"""
+
+# Dataset names in the track HDF5 file. Per-track datasets have one row per
+# track, 'points' and 'depositions' one row per point. Endpoint datasets are
+# optional and hold shape (n_tracks, 3) arrays.
+DEFAULT_TRACK_DATASET_NAMES = {
+    'ids': 'track_id',
+    'image_ids': 'image_id',
+    'interaction_ids': 'interaction_id',
+    'point_counts': 'point_count',
+    'points': 'points',
+    'depositions': 'depositions',
+    'start_positions': 'start_position',
+    'start_directions': 'start_direction',
+    'end_positions': 'end_position',
+    'end_directions': 'end_direction',
+}
+TRACK_ENDPOINT_KEYS = ['start_positions', 'start_directions', 'end_positions', 'end_directions']
+
+# Column names in the CRT hit Parquet file. 'total_pe' and 'plane' are optional.
+DEFAULT_CRTHIT_COLUMN_NAMES = {
+    'ids': 'id',
+    'image_ids': 'image_id',
+    't0_sec': 't0_sec',
+    't0_ns': 't0_ns',
+    't1_ns': 't1_ns',
+    'position_x': 'position_x',
+    'position_y': 'position_y',
+    'position_z': 'position_z',
+    'total_pe': 'total_pe',
+    'plane': 'plane',
+}
+OPTIONAL_CRTHIT_KEYS = ['total_pe', 'plane']
+POSITION_KEYS = ['position_x', 'position_y', 'position_z']
+
+# Tracks per chunk when reading HDF5 files in chunks
+DEFAULT_TRACK_CHUNK_SIZE = 10_000
+# CRT hits per chunk when reading Parquet files in chunks
+DEFAULT_CRTHIT_CHUNK_SIZE = 1_000_000
+
+def read_hdf5_tracks(file_path, dataset_names=None, group=None):
+    """
+    Read every track of an HDF5 file into flat buffers.
+
+    Parameters:
+        file_path (str): Path to the HDF5 file.
+        dataset_names (dict, optional): Overrides of DEFAULT_TRACK_DATASET_NAMES. Default: None
+        group (str, optional): HDF5 group holding the datasets. Default: None (file root)
+
+    Returns:
+        dict: Track buffers, see get_track_buffers.
+    """
+    for track_buffers in iter_hdf5_track_chunks(file_path, chunk_size=None,
+                                                dataset_names=dataset_names, group=group):
+        return track_buffers
+
+def iter_hdf5_track_chunks(file_path, chunk_size=DEFAULT_TRACK_CHUNK_SIZE, dataset_names=None, group=None):
+    """
+    Read the tracks of an HDF5 file in chunks, so that files larger than memory
+    can be processed. Chunks end on an image_id change, so that every event
+    lies in a single chunk, provided tracks are stored grouped by event.
+
+    Parameters:
+        file_path (str): Path to the HDF5 file.
+        chunk_size (int, optional): Approximate number of tracks per chunk, or None
+                                    to read the whole file. Default: DEFAULT_TRACK_CHUNK_SIZE
+        dataset_names (dict, optional): Overrides of DEFAULT_TRACK_DATASET_NAMES. Default: None
+        group (str, optional): HDF5 group holding the datasets. Default: None (file root)
+
+    Yields:
+        dict: Track buffers of each chunk, see get_track_buffers.
+    """
+    import h5py
+
+    dataset_names = dict(DEFAULT_TRACK_DATASET_NAMES, **(dataset_names or {}))
+    with h5py.File(file_path, 'r') as file:
+        datasets = file[group] if group else file
+        # Per-track columns are small, read them at once to plan the chunks
+        image_ids = datasets[dataset_names['image_ids']][()]
+        point_offsets = get_offsets(datasets[dataset_names['point_counts']][()])
+        has_endpoints = all(dataset_names[key] in datasets for key in TRACK_ENDPOINT_KEYS)
+        has_interaction_ids = dataset_names['interaction_ids'] in datasets
+
+        for first_track, last_track in get_event_chunks(image_ids, chunk_size):
+            first_point, last_point = point_offsets[first_track], point_offsets[last_track]
+            chunk = {
+                'ids': datasets[dataset_names['ids']][first_track:last_track],
+                'image_ids': image_ids[first_track:last_track],
+                'points': datasets[dataset_names['points']][first_point:last_point],
+                'depositions': datasets[dataset_names['depositions']][first_point:last_point],
+                'point_offsets': point_offsets[first_track:last_track + 1] - first_point,
+            }
+            if has_interaction_ids:
+                chunk['interaction_ids'] = datasets[dataset_names['interaction_ids']][first_track:last_track]
+            if has_endpoints:
+                for key in TRACK_ENDPOINT_KEYS:
+                    chunk[key] = datasets[dataset_names[key]][first_track:last_track]
+            yield get_track_buffers(**chunk)
+
+def get_track_buffers(ids, image_ids, points, depositions, point_offsets, interaction_ids=None,
+                      start_positions=None, start_directions=None, end_positions=None, end_directions=None):
+    """
+    Assemble and check track buffers.
+
+    Parameters:
+        ids (numpy.ndarray): Track IDs, shape (n_tracks,).
+        image_ids (numpy.ndarray): Event of each track, shape (n_tracks,).
+        points (numpy.ndarray): Points of all tracks, back to back, shape (n_points, 3).
+        depositions (numpy.ndarray): Deposition of each point, shape (n_points,).
+        point_offsets (numpy.ndarray): Index of the first point of each track, followed
+                                       by n_points, shape (n_tracks + 1,).
+        interaction_ids (numpy.ndarray, optional): Shape (n_tracks,). Default: None (-1)
+        start_positions, start_directions, end_positions, end_directions (numpy.ndarray,
+            optional): Known end points, shape (n_tracks, 3). Rows with a non-finite
+            value are estimated with PCA. Default: None (all estimated)
+
+    Returns:
+        dict: Dictionary with the above keys, and 'event_image_ids' and 'event_offsets'
+              from get_event_offsets.
+    """
+    ids = np.asarray(ids)
+    n_tracks = len(ids)
+    point_offsets = np.asarray(point_offsets, dtype=np.int64)
+    if len(point_offsets) != n_tracks + 1 or point_offsets[-1] != len(points):
+        raise ValueError('point_offsets must have one entry per track followed by the number of points')
+    if len(depositions) != len(points):
+        raise ValueError('points and depositions must have the same length')
+
+    track_buffers = {
+        'ids': ids,
+        'image_ids': np.asarray(image_ids, dtype=np.int64),
+        'interaction_ids': np.full(n_tracks, -1, dtype=np.int64) if interaction_ids is None
+                           else np.asarray(interaction_ids),
+        'points': np.asarray(points).reshape(-1, 3),
+        'depositions': np.asarray(depositions),
+        'point_offsets': point_offsets,
+    }
+    endpoints = [start_positions, start_directions, end_positions, end_directions]
+    if any(endpoint is not None for endpoint in endpoints):
+        for key, endpoint in zip(TRACK_ENDPOINT_KEYS, endpoints):
+            track_buffers[key] = np.full((n_tracks, 3), np.nan) if endpoint is None \
+                                 else np.asarray(endpoint).reshape(-1, 3)
+
+    track_buffers['event_image_ids'], track_buffers['event_offsets'] = get_event_offsets(track_buffers['image_ids'])
+    return track_buffers
+
+def read_parquet_crthits(file_path, column_names=None):
+    """
+    Read every CRT hit of a Parquet file into flat buffers.
+
+    Parameters:
+        file_path (str): Path to the Parquet file.
+        column_names (dict, optional): Overrides of DEFAULT_CRTHIT_COLUMN_NAMES. Default: None
+
+    Returns:
+        dict: CRT hit buffers, see get_crthit_buffers.
+    """
+    import pyarrow.parquet as pq
+
+    column_names = dict(DEFAULT_CRTHIT_COLUMN_NAMES, **(column_names or {}))
+    parquet_file = pq.ParquetFile(file_path)
+    table = parquet_file.read(columns=get_parquet_columns(parquet_file, column_names))
+    return get_crthit_buffers_from_table(table, column_names)
+
+def iter_parquet_crthit_chunks(file_path, chunk_size=DEFAULT_CRTHIT_CHUNK_SIZE, column_names=None):
+    """
+    Read the CRT hits of a Parquet file in chunks of record batches, so that
+    files larger than memory can be processed. Chunks end on an image_id
+    change: the hits of the last event of a batch are held back and yielded
+    with the next batch, so that every event lies in a single chunk, provided
+    hits are stored grouped by event.
+
+    Parameters:
+        file_path (str): Path to the Parquet file.
+        chunk_size (int, optional): Approximate number of CRT hits per chunk. Default: DEFAULT_CRTHIT_CHUNK_SIZE
+        column_names (dict, optional): Overrides of DEFAULT_CRTHIT_COLUMN_NAMES. Default: None
+
+    Yields:
+        dict: CRT hit buffers of each chunk, see get_crthit_buffers.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    column_names = dict(DEFAULT_CRTHIT_COLUMN_NAMES, **(column_names or {}))
+    parquet_file = pq.ParquetFile(file_path)
+    columns = get_parquet_columns(parquet_file, column_names)
+    pending = None
+    for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns):
+        table = pa.Table.from_batches([batch])
+        if pending is not None:
+            # The last event of the pending hits may go on in this batch
+            _, event_offsets = get_event_offsets(pending.column(column_names['image_ids']).to_numpy())
+            last_event_start = int(event_offsets[-2])
+            if last_event_start > 0:
+                yield get_crthit_buffers_from_table(pending.slice(0, last_event_start), column_names)
+            table = pa.concat_tables([pending.slice(last_event_start), table])
+        pending = table
+
+    if pending is not None:
+        yield get_crthit_buffers_from_table(pending, column_names)
+
+def iter_event_chunks(track_path, crthit_path, chunk_size=DEFAULT_TRACK_CHUNK_SIZE, dataset_names=None,
+                      group=None, column_names=None, crthit_chunk_size=DEFAULT_CRTHIT_CHUNK_SIZE):
+    """
+    Read tracks from HDF5 and CRT hits from Parquet in chunks that hold the
+    same events, so that each chunk can be matched on its own. Both files must
+    be sorted by image_id. The CRT hits of events without tracks are skipped.
+
+    Parameters:
+        track_path (str): Path to the HDF5 file of tracks.
+        crthit_path (str): Path to the Parquet file of CRT hits.
+        chunk_size (int, optional): Approximate number of tracks per chunk. Default: DEFAULT_TRACK_CHUNK_SIZE
+        dataset_names (dict, optional): Overrides of DEFAULT_TRACK_DATASET_NAMES. Default: None
+        group (str, optional): HDF5 group holding the datasets. Default: None (file root)
+        column_names (dict, optional): Overrides of DEFAULT_CRTHIT_COLUMN_NAMES. Default: None
+        crthit_chunk_size (int, optional): Number of CRT hits read at a time. Default: DEFAULT_CRTHIT_CHUNK_SIZE
+
+    Yields:
+        tuple: Track buffers (see get_track_buffers) and CRT hit buffers (see
+               get_crthit_buffers) of the same events.
+
+    Raises:
+        ValueError: If a file is not sorted by image_id.
+    """
+    crthit_chunks = iter_parquet_crthit_chunks(crthit_path, crthit_chunk_size, column_names)
+    pending_crthits = None
+    last_track_image_id, last_crthit_image_id = None, None
+    for track_buffers in iter_hdf5_track_chunks(track_path, chunk_size, dataset_names, group):
+        image_ids = track_buffers['image_ids']
+        if len(image_ids) == 0: continue
+        check_sorted_image_ids(image_ids, last_track_image_id, track_path)
+        last_track_image_id = image_ids[-1]
+
+        # Take the pending hits up to the last event of the track chunk
+        chunk_crthits = []
+        while True:
+            if pending_crthits is None:
+                pending_crthits = next(crthit_chunks, None)
+                if pending_crthits is None: break
+                check_sorted_image_ids(pending_crthits['image_ids'], last_crthit_image_id, crthit_path)
+                last_crthit_image_id = pending_crthits['image_ids'][-1]
+            n_taken = np.searchsorted(pending_crthits['image_ids'], last_track_image_id, side='right')
+            chunk_crthits.append({key: values[:n_taken] for key, values in pending_crthits.items()})
+            if n_taken < len(pending_crthits['image_ids']):
+                pending_crthits = {key: values[n_taken:] for key, values in pending_crthits.items()}
+                break
+            pending_crthits = None
+
+        if chunk_crthits:
+            crthit_buffers = {key: np.concatenate([chunk[key] for chunk in chunk_crthits])
+                              for key in chunk_crthits[0]}
+        else:
+            crthit_buffers = get_crthit_buffers([], [], [], [], [], np.empty((0, 3)))
+        is_tracked = np.isin(crthit_buffers['image_ids'], image_ids)
+        yield track_buffers, {key: values[is_tracked] for key, values in crthit_buffers.items()}
+
+def check_sorted_image_ids(image_ids, previous_image_id, file_path):
+    """
+    Check that a chunk of image_ids is sorted and follows the previous chunk.
+
+    Parameters:
+        image_ids (numpy.ndarray): image_id of each row of the chunk, shape (n,).
+        previous_image_id (int): Last image_id of the previous chunk, or None.
+        file_path (str): Path of the file, for the error message.
+
+    Raises:
+        ValueError: If the image_ids decrease.
+    """
+    if np.any(np.diff(image_ids) < 0) or (previous_image_id is not None and image_ids[0] < previous_image_id):
+        raise ValueError('{:s} must be sorted by image_id to be read in event chunks'.format(file_path))
+
+def write_hdf5_tracks(file_path, track_buffers, dataset_names=None, group=None):
+    """
+    Write track buffers to an HDF5 file readable by read_hdf5_tracks. End
+    point datasets are only written if the buffers have them.
+
+    Parameters:
+        file_path (str): Path to the HDF5 file, overwritten if it exists.
+        track_buffers (dict): Track buffers, see get_track_buffers.
+        dataset_names (dict, optional): Overrides of DEFAULT_TRACK_DATASET_NAMES. Default: None
+        group (str, optional): HDF5 group holding the datasets. Default: None (file root)
+    """
+    import h5py
+
+    dataset_names = dict(DEFAULT_TRACK_DATASET_NAMES, **(dataset_names or {}))
+    columns = {key: track_buffers[key] for key in ['ids', 'image_ids', 'interaction_ids', 'points', 'depositions']}
+    columns['point_counts'] = np.diff(track_buffers['point_offsets'])
+    columns.update({key: track_buffers[key] for key in TRACK_ENDPOINT_KEYS if key in track_buffers})
+    with h5py.File(file_path, 'w') as file:
+        datasets = file.require_group(group) if group else file
+        for key, values in columns.items():
+            datasets.create_dataset(dataset_names[key], data=values)
+
+def write_parquet_crthits(file_path, crthit_buffers, column_names=None):
+    """
+    Write CRT hit buffers to a Parquet file readable by read_parquet_crthits.
+
+    Parameters:
+        file_path (str): Path to the Parquet file, overwritten if it exists.
+        crthit_buffers (dict): CRT hit buffers, see get_crthit_buffers.
+        column_names (dict, optional): Overrides of DEFAULT_CRTHIT_COLUMN_NAMES. Default: None
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    column_names = dict(DEFAULT_CRTHIT_COLUMN_NAMES, **(column_names or {}))
+    columns = {key: crthit_buffers[key] for key in ['ids', 'image_ids', 't0_sec', 't0_ns', 't1_ns']
+                                                   + OPTIONAL_CRTHIT_KEYS}
+    columns.update({key: crthit_buffers['positions'][:, axis] for axis, key in enumerate(POSITION_KEYS)})
+    pq.write_table(pa.table({column_names[key]: np.asarray(values) for key, values in columns.items()}), file_path)
+
+def get_parquet_columns(parquet_file, column_names):
+    """
+    List the Parquet columns to read, skipping optional columns absent from the file.
+
+    Parameters:
+        parquet_file (pyarrow.parquet.ParquetFile): Open Parquet file.
+        column_names (dict): Mapping from buffer keys to column names.
+
+    Returns:
+        list: Column names to read.
+    """
+    file_columns = set(parquet_file.schema_arrow.names)
+    return [column for key, column in column_names.items()
+            if key not in OPTIONAL_CRTHIT_KEYS or column in file_columns]
+
+def get_crthit_buffers_from_table(table, column_names):
+    """
+    Convert a pyarrow Table or RecordBatch of CRT hits to CRT hit buffers.
+
+    Parameters:
+        table (pyarrow.Table or pyarrow.RecordBatch): CRT hit columns.
+        column_names (dict): Mapping from buffer keys to column names.
+
+    Returns:
+        dict: CRT hit buffers, see get_crthit_buffers.
+    """
+    table_columns = set(table.schema.names)
+    def get_column(key):
+        return table.column(column_names[key]).to_numpy()
+
+    positions = np.column_stack([get_column(key) for key in POSITION_KEYS])
+    optional_columns = {key: get_column(key) for key in OPTIONAL_CRTHIT_KEYS
+                        if column_names[key] in table_columns}
+    return get_crthit_buffers(get_column('ids'), get_column('image_ids'), get_column('t0_sec'),
+                              get_column('t0_ns'), get_column('t1_ns'), positions, **optional_columns)
+
+def get_crthit_buffers(ids, image_ids, t0_sec, t0_ns, t1_ns, positions, total_pe=None, plane=None):
+    """
+    Assemble and check CRT hit buffers.
+
+    Parameters:
+        ids (numpy.ndarray): CRT hit IDs, shape (n_hits,).
+        image_ids (numpy.ndarray): Event of each hit, shape (n_hits,).
+        t0_sec, t0_ns, t1_ns (numpy.ndarray): Timestamps as in CRTHit, shape (n_hits,).
+        positions (numpy.ndarray): Hit positions, shape (n_hits, 3).
+        total_pe (numpy.ndarray, optional): Shape (n_hits,). Default: None (-1)
+        plane (numpy.ndarray, optional): Shape (n_hits,). Default: None (-1)
+
+    Returns:
+        dict: Dictionary with the above keys.
+    """
+    ids = np.asarray(ids)
+    n_hits = len(ids)
+    positions = np.asarray(positions).reshape(-1, 3)
+    if len(positions) != n_hits:
+        raise ValueError('CRT hit columns must all have one row per hit')
+
+    return {
+        'ids': ids,
+        'image_ids': np.asarray(image_ids, dtype=np.int64),
+        't0_sec': np.asarray(t0_sec),
+        't0_ns': np.asarray(t0_ns),
+        't1_ns': np.asarray(t1_ns),
+        'positions': positions,
+        'total_pe': np.full(n_hits, -1.) if total_pe is None else np.asarray(total_pe),
+        'plane': np.full(n_hits, -1, dtype=np.int64) if plane is None else np.asarray(plane),
+    }
+
+def get_crthit_columns_from_buffers(crthit_buffers, dca_params):
+    """
+    Columnar counterpart of get_crthit_columns, without CRTHit objects. The
+    'image_ids' column needed by the dataset-wide matcher is included.
+
+    Parameters:
+        crthit_buffers (dict): Output of read_parquet_crthits or get_crthit_buffers.
+        dca_params (dict): Loaded DCA parameters from matcha config file
+
+    Returns:
+        dict: Dictionary with keys 'ids', 'image_ids', 'positions' and 'times'.
+    """
+    precision = dca_params.get('precision', NATIVE_PRECISION)
+    position_dtype = float if precision == NATIVE_PRECISION else precision
+
+    return {
+        'ids': crthit_buffers['ids'],
+        'image_ids': crthit_buffers['image_ids'],
+        'positions': np.asarray(crthit_buffers['positions'], dtype=position_dtype),
+        'times': get_crthit_times(crthit_buffers['t0_ns'], dca_params, crthit_buffers['t1_ns']),
+    }
+
+def get_crthit_times(t0_ns, dca_params, t1_ns=None):
+    """
+    Vectorized counterpart of CRTHit.get_time_in_microseconds, including the
+    dca_params['ts_mode'] of data.
+
+    Parameters:
+        t0_ns (numpy.ndarray): CRT hit t0_ns timestamps, shape (n_hits,).
+        dca_params (dict): Loaded DCA parameters from matcha config file
+        t1_ns (numpy.ndarray, optional): CRT hit t1_ns timestamps, shape (n_hits,).
+                                         Needed for data with ts_mode 1. Default: None
+
+    Returns:
+        numpy.ndarray: CRT hit times in microseconds, shape (n_hits,).
+    """
+    t0_ns = np.asarray(t0_ns, dtype=np.float64)
+    if not dca_params['isdata']:
+        return t0_ns / 1e3
+
+    trigger_timestamp = dca_params['trigger_timestamp']
+    if not trigger_timestamp or trigger_timestamp == 'None':
+        raise ValueError('If isdata=True, you need to provide a trigger_timestamp')
+    if get_ts_mode(dca_params) == T1_TS_MODE:
+        if t1_ns is None:
+            raise ValueError('ts_mode {} takes CRT hit times from t1_ns, which were not provided'.format(T1_TS_MODE))
+        # Truncated to whole nanoseconds, as int(t1_ns) in CRTHit
+        return np.trunc(np.asarray(t1_ns, dtype=np.float64)) * 1e-3
+    crt_times = (t0_ns - (trigger_timestamp % 1_000_000_000)) / 1e3
+    crt_times[crt_times < -0.5e6] += 1e6
+    crt_times[crt_times >= 0.5e6] -= 1e6
+    return crt_times
+
+def get_track_columns_from_buffers(track_buffers, pca_parameters, endpoint_cache=None):
+    """
+    Columnar counterpart of get_track_columns. Known end points are used as
+    they are; only tracks without them are wrapped in a Track (whose points
+    are views of the buffers) to estimate their end points with PCA.
+
+    Parameters:
+        track_buffers (dict): Output of read_hdf5_tracks or get_track_buffers.
+        pca_parameters (dict): Dictionary of PCA parameters from loaded matcha config file
+        endpoint_cache (EndpointCache, optional): On-disk cache of estimated end points.
+                                                  Default: None (no caching)
+
+    Returns:
+        dict: Track columns as returned by matcha.dataset_matcher.get_track_columns.
+    """
+    # Imported here, so that reading files does not import the matchers
+    from .dataset_matcher import get_track_columns, TRACK_PRECISION_KEYS
+
+    n_tracks = len(track_buffers['ids'])
+    track_columns = {
+        'ids': track_buffers['ids'],
+        'image_ids': track_buffers['image_ids'],
+    }
+    known_columns = {}
+    is_known = np.zeros(n_tracks, dtype=bool)
+    if 'start_positions' in track_buffers:
+        known_columns = {key: np.asarray(track_buffers[key]) for key in TRACK_ENDPOINT_KEYS}
+        is_known = np.all([np.isfinite(known_columns[key]).all(axis=1) for key in TRACK_ENDPOINT_KEYS], axis=0)
+
+    if known_columns and is_known.all():
+        track_columns.update(known_columns)
+        return track_columns
+
+    estimated_indices = np.flatnonzero(~is_known)
+    estimated_columns = get_track_columns(get_buffer_tracks(track_buffers, estimated_indices),
+                                          pca_parameters, endpoint_cache)
+    for key in TRACK_ENDPOINT_KEYS:
+        if not is_known.any():
+            track_columns[key] = estimated_columns[key]
+            continue
+        known, estimated = known_columns[key], estimated_columns[key]
+        column = np.empty(known.shape, dtype=np.result_type(known, estimated))
+        column[is_known] = known[is_known]
+        column[estimated_indices] = estimated
+        track_columns[key] = column
+    # Known end points are flagged by the type of their columns instead
+    for key in TRACK_PRECISION_KEYS:
+        column = np.zeros(n_tracks, dtype=bool)
+        column[estimated_indices] = estimated_columns[key]
+        track_columns[key] = column
+
+    return track_columns
+
+def get_event_buffers(events):
+    """
+    Build track and CRT hit buffers from Track and CRTHit instances.
+
+    Parameters:
+        events (iterable): Iterable of (image_id, tracks, crthits) tuples.
+
+    Returns:
+        tuple: Track buffers and CRT hit buffers, see get_track_buffers and get_crthit_buffers.
+    """
+    # Imported here, columnar_store imports this module
+    from .columnar_store import TRACK_ENDPOINT_ATTRIBUTES
+
+    tracks, crthits, crthit_image_ids = [], [], []
+    for image_id, event_tracks, event_crthits in events:
+        tracks.extend(event_tracks)
+        crthits.extend(event_crthits)
+        crthit_image_ids.extend([image_id] * len(event_crthits))
+
+    point_counts = [len(track.points) for track in tracks]
+    endpoints = {}
+    if any(track.start_x is not None for track in tracks):
+        for key, attributes in TRACK_ENDPOINT_ATTRIBUTES.items():
+            endpoints[key] = np.array([[np.nan if getattr(track, attribute) is None else getattr(track, attribute)
+                                        for attribute in attributes] for track in tracks], dtype=np.float64)
+
+    track_buffers = get_track_buffers(
+        [track.id for track in tracks], [track.image_id for track in tracks],
+        np.concatenate([track.points for track in tracks]) if tracks else np.empty((0, 3)),
+        np.concatenate([track.depositions for track in tracks]) if tracks else np.empty(0),
+        np.concatenate([[0], np.cumsum(point_counts)]), [track.interaction_id for track in tracks], **endpoints
+    )
+    crthit_buffers = get_crthit_buffers(
+        [crthit.id for crthit in crthits], crthit_image_ids,
+        [crthit.t0_sec for crthit in crthits], [crthit.t0_ns for crthit in crthits],
+        [crthit.t1_ns for crthit in crthits],
+        [[crthit.position_x, crthit.position_y, crthit.position_z] for crthit in crthits],
+        [crthit.total_pe for crthit in crthits], [crthit.plane for crthit in crthits]
+    )
+
+    return track_buffers, crthit_buffers
+
+def get_buffer_tracks(track_buffers, track_indices=None):
+    """
+    Build Track instances whose points and depositions are views of the buffers.
+
+    Parameters:
+        track_buffers (dict): Output of read_hdf5_tracks or get_track_buffers.
+        track_indices (numpy.ndarray, optional): Tracks to build. Default: None (all)
+
+    Returns:
+        list: List of matcha.Track instances.
+    """
+    if track_indices is None: track_indices = range(len(track_buffers['ids']))
+    point_offsets = track_buffers['point_offsets']
+
+    tracks = []
+    for index in track_indices:
+        point_slice = slice(point_offsets[index], point_offsets[index + 1])
+        tracks.append(Track(track_buffers['ids'][index].item(), track_buffers['image_ids'][index].item(),
+                            track_buffers['interaction_ids'][index].item(),
+                            track_buffers['points'][point_slice], track_buffers['depositions'][point_slice]))
+    return tracks
+
+def get_offsets(counts):
+    """
+    Convert per-row counts to offsets.
+
+    Parameters:
+        counts (numpy.ndarray): Number of elements of each row, shape (n,).
+
+    Returns:
+        numpy.ndarray: Index of the first element of each row, followed by the
+                       total number of elements, shape (n + 1,).
+    """
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+def get_event_offsets(image_ids):
+    """
+    Find the rows of each event in a column grouped by image_id.
+
+    Parameters:
+        image_ids (numpy.ndarray): image_id of each row, shape (n,).
+
+    Returns:
+        tuple: image_id of each event, shape (n_events,), and index of its first
+               row followed by n, shape (n_events + 1,). Events split over
+               several runs of rows appear once per run.
+    """
+    image_ids = np.asarray(image_ids)
+    run_starts = np.flatnonzero(np.diff(image_ids)) + 1 if len(image_ids) else np.zeros(0, dtype=np.int64)
+    event_offsets = np.concatenate([[0], run_starts, [len(image_ids)]]).astype(np.int64) \
+                    if len(image_ids) else np.zeros(1, dtype=np.int64)
+    return image_ids[event_offsets[:-1]], event_offsets
+
+def get_event_chunks(image_ids, chunk_size):
+    """
+    Split rows grouped by image_id into chunks of about chunk_size rows that
+    end on an image_id change.
+
+    Parameters:
+        image_ids (numpy.ndarray): image_id of each row, shape (n,).
+        chunk_size (int): Approximate number of rows per chunk, or None for one chunk.
+
+    Returns:
+        list: List of (first_row, last_row) tuples, last_row excluded.
+    """
+    n_rows = len(image_ids)
+    if chunk_size is None or n_rows == 0: return [(0, n_rows)]
+
+    _, event_offsets = get_event_offsets(image_ids)
+    chunks = []
+    first_row = 0
+    while first_row < n_rows:
+        # First event boundary at or after first_row + chunk_size
+        boundary = np.searchsorted(event_offsets, first_row + max(chunk_size, 1), side='left')
+        last_row = int(event_offsets[min(boundary, len(event_offsets) - 1)])
+        chunks.append((first_row, last_row))
+        first_row = last_row
+    return chunks
+
+def validate_readers(events, config, directory, chunk_size=None):
+    """
+    Write events to an HDF5 track file and a Parquet CRT hit file, read them
+    back (whole and in chunks) and check that the buffers and the dataset-wide
+    matches are unchanged, also when each chunk of iter_event_chunks is matched
+    on its own. Needs h5py and pyarrow.
+
+    Parameters:
+        events (list): List of (image_id, tracks, crthits) tuples, e.g. from
+                       matcha.harness.generate_events.
+        config (dict): Dictionary from parsing matcha config file
+        directory (str): Directory where the two files are written.
+        chunk_size (int, optional): Tracks and CRT hits per chunk for the chunked
+                                    reads. Default: None (a tenth of each)
+
+    Returns:
+        dict: Dictionary with keys 'track_mismatches' and 'crthit_mismatches' (buffer
+              keys whose values changed in the whole-file read), 'chunk_mismatches'
+              (same for the concatenated chunked reads), 'n_track_chunks',
+              'n_crthit_chunks', 'n_event_chunks', 'n_match_mismatches' (tracks
+              whose best CRT hit or distance changed), 'n_event_chunk_match_mismatches'
+              (same when matching event chunks) and 'passed'.
+    """
+    import os
+    # Imported here, so that reading files does not import the matchers
+    from .dataset_matcher import get_dataset_track_best_matches
+    from .crthit_clustering import get_clustered_crthit_buffers
+
+    track_buffers, crthit_buffers = get_event_buffers(events)
+    track_path = os.path.join(directory, 'tracks.h5')
+    crthit_path = os.path.join(directory, 'crthits.parquet')
+    write_hdf5_tracks(track_path, track_buffers)
+    write_parquet_crthits(crthit_path, crthit_buffers)
+
+    def get_mismatches(expected_buffers, buffers):
+        return [key for key, values in expected_buffers.items()
+                if key not in buffers or not np.array_equal(values, buffers[key], equal_nan=True)]
+
+    read_track_buffers, read_crthit_buffers = read_hdf5_tracks(track_path), read_parquet_crthits(crthit_path)
+    track_chunk_size = chunk_size or max(len(track_buffers['ids']) // 10, 1)
+    crthit_chunk_size = chunk_size or max(len(crthit_buffers['ids']) // 10, 1)
+    track_chunks = list(iter_hdf5_track_chunks(track_path, track_chunk_size))
+    crthit_chunks = list(iter_parquet_crthit_chunks(crthit_path, crthit_chunk_size))
+    chunked_tracks = {key: np.concatenate([chunk[key] for chunk in track_chunks])
+                      for key in ['ids', 'image_ids', 'points', 'depositions'] + TRACK_ENDPOINT_KEYS
+                      if key in track_buffers}
+    chunked_crthits = {key: np.concatenate([chunk[key] for chunk in crthit_chunks]) for key in crthit_buffers}
+
+    def get_matches(track_buffers, crthit_buffers):
+        track_columns = get_track_columns_from_buffers(track_buffers, config['pca_parameters'])
+        crthit_buffers = get_clustered_crthit_buffers(crthit_buffers, config)
+        crthit_columns = get_crthit_columns_from_buffers(crthit_buffers, config['dca_parameters'])
+        return get_dataset_track_best_matches(track_columns, crthit_columns, config)
+
+    matches = get_matches(track_buffers, crthit_buffers)
+    read_matches = get_matches(read_track_buffers, read_crthit_buffers)
+    is_match_mismatch = (matches['crthit_ids'] != read_matches['crthit_ids']) \
+                      | (matches['distances'] != read_matches['distances'])
+    event_chunk_matches = [get_matches(*event_chunk) for event_chunk in
+                           iter_event_chunks(track_path, crthit_path, track_chunk_size,
+                                             crthit_chunk_size=crthit_chunk_size)]
+    is_event_chunk_mismatch = np.concatenate([chunk_matches['crthit_ids'] for chunk_matches in event_chunk_matches]) \
+                              != matches['crthit_ids']
+    is_event_chunk_mismatch |= np.concatenate([chunk_matches['distances'] for chunk_matches in event_chunk_matches]) \
+                               != matches['distances']
+
+    report = {
+        'track_mismatches': get_mismatches(track_buffers, read_track_buffers),
+        'crthit_mismatches': get_mismatches(crthit_buffers, read_crthit_buffers),
+        'chunk_mismatches': get_mismatches({key: track_buffers[key] for key in chunked_tracks}, chunked_tracks)
+                          + get_mismatches(crthit_buffers, chunked_crthits),
+        'n_track_chunks': len(track_chunks),
+        'n_crthit_chunks': len(crthit_chunks),
+        'n_event_chunks': len(event_chunk_matches),
+        'n_match_mismatches': int(is_match_mismatch.sum()),
+        'n_event_chunk_match_mismatches': int(is_event_chunk_mismatch.sum()),
+    }
+    report['passed'] = not (report['track_mismatches'] or report['crthit_mismatches']
+                            or report['chunk_mismatches'] or report['n_match_mismatches']
+                            or report['n_event_chunk_match_mismatches'])
+
+    return report
@@ -0,0 +1,367 @@
+import os
+import json
+import time
+import signal
+import socket
+import struct
+import threading
+import socketserver
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from .readers import get_event_buffers, get_track_columns_from_buffers, get_crthit_columns_from_buffers, \
+                     TRACK_ENDPOINT_KEYS
+from .match_maker import get_matching_method
+"""
+Long-lived local matching service, to amortize start-up over many small jobs.
+
+`matcha serve` loads the config once and starts a pool of worker processes
+that import sklearn and scipy, open the end point cache and compile the
+Numba kernels (if configured) before the first request. It then listens on
+a Unix socket and handles each client connection in its own thread, sending
+every request to the worker pool.
+
+Messages are framed as two big-endian uint32 lengths, a JSON header and a
+binary payload. The header lists the arrays packed back to back in the
+payload with their name, dtype, shape and byte offset. A match request
+carries readers-style track and CRT hit buffers ('tracks/<key>' and
+'crthits/<key>', see matcha.readers.get_track_buffers and get_crthit_buffers)
+and the reply carries the arrays of get_dataset_track_best_matches. Only the
+dca matching_method is served, so no CRT geometry is loaded; dca_parameters
+such as yz_pruning and top_k apply as in the dataset-wide matcher.
+"""
+
+DEFAULT_SOCKET_PATH = '/tmp/matcha.sock'
+MESSAGE_PREFIX = struct.Struct('!II')
+# Largest accepted header, in bytes
+MAX_HEADER_BYTES = 1 << 24
+
+# Buffer keys sent with a match request; end point keys are optional
+TRACK_BUFFER_KEYS = ['ids', 'image_ids', 'interaction_ids', 'points', 'depositions', 'point_offsets']
+CRTHIT_BUFFER_KEYS = ['ids', 'image_ids', 't0_sec', 't0_ns', 't1_ns', 'positions', 'total_pe', 'plane']
+
+# State of each worker process, set by initialize_worker
+_worker_state = {}
+
+def send_message(connection, header, arrays=None):
+    """
+    Send a header and numpy arrays over a socket.
+
+    Parameters:
+        connection (socket.socket): Connected socket.
+        header (dict): JSON-serializable header.
+        arrays (dict, optional): Dictionary of numpy arrays. Default: None
+
+    Returns: None
+        This function does not return any value.
+    """
+    array_specs, payload, offset = [], [], 0
+    for name, array in (arrays or {}).items():
+        array = np.ascontiguousarray(array)
+        array_specs.append({'name': name, 'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset})
+        if array.nbytes: payload.append(memoryview(array).cast('B'))
+        offset += array.nbytes
+
+    header_bytes = json.dumps(dict(header, arrays=array_specs)).encode()
+    connection.sendall(MESSAGE_PREFIX.pack(len(header_bytes), offset) + header_bytes)
+    for array_bytes in payload:
+        connection.sendall(array_bytes)
+
+def receive_message(connection):
+    """
+    Receive a header and numpy arrays sent by send_message.
+
+    Parameters:
+        connection (socket.socket): Connected socket.
+
+    Returns:
+        tuple: Header dictionary and dictionary of numpy arrays, or (None, None)
+               if the peer closed the connection before a new message.
+    """
+    prefix = receive_exactly(connection, MESSAGE_PREFIX.size, allow_eof=True)
+    if prefix is None: return None, None
+    header_size, payload_size = MESSAGE_PREFIX.unpack(prefix)
+    if header_size > MAX_HEADER_BYTES:
+        raise ValueError('Message header of {} bytes exceeds {} bytes'.format(header_size, MAX_HEADER_BYTES))
+
+    header = json.loads(receive_exactly(connection, header_size).decode())
+    payload = receive_exactly(connection, payload_size)
+    arrays = {}
+    for spec in header.pop('arrays'):
+        dtype = np.dtype(spec['dtype'])
+        count = int(np.prod(spec['shape'], dtype=np.int64))
+        arrays[spec['name']] = np.frombuffer(payload, dtype=dtype, count=count,
+                                             offset=spec['offset']).reshape(spec['shape'])
+
+    return header, arrays
+
+def receive_exactly(connection, n_bytes, allow_eof=False):
+    """
+    Receive a fixed number of bytes.
+
+    Parameters:
+        connection (socket.socket): Connected socket.
+        n_bytes (int): Number of bytes.
+        allow_eof (bool, optional): Return None if the connection is closed before
+                                    the first byte. Default: False
+
+    Returns:
+        bytearray: Received bytes.
+    """
+    buffer = bytearray(n_bytes)
+    view = memoryview(buffer)
+    n_received = 0
+    while n_received < n_bytes:
+        n_chunk = connection.recv_into(view[n_received:])
+        if n_chunk == 0:
+            if allow_eof and n_received == 0: return None
+            raise ConnectionError('Connection closed after {} of {} bytes'.format(n_received, n_bytes))
+        n_received += n_chunk
+    return buffer
+
+def initialize_worker(config):
+    """
+    Load everything a match request needs, once per worker process.
+
+    Parameters:
+        config (dict): Dictionary from parsing matcha config file
+
+    Returns: None
+        This function does not return any value.
+    """
+    # Imported here so that clients do not pay for them
+    import sklearn.decomposition
+    import scipy.spatial.distance
+    from .endpoint_cache import get_endpoint_cache
+    from .kernels import resolve_kernel, get_numba_kernels, NUMBA_KERNEL
+
+    if NUMBA_KERNEL in (resolve_kernel(config['dca_parameters'].get('kernel', 'numpy')),
+                        resolve_kernel(config['pca_parameters'].get('kernel', 'numpy'))):
+        get_numba_kernels()
+
+    _worker_state['config'] = config
+    _worker_state['endpoint_cache'] = get_endpoint_cache(config)
+
+def match_buffers(track_buffers, crthit_buffers):
+    """
+    Match track and CRT hit buffers with the dataset-wide matcher, in a worker
+    process set up by initialize_worker. CRT hits are first clustered as
+    configured, see matcha.crthit_clustering.cluster_crthit_buffers.
+
+    Parameters:
+        track_buffers (dict): Track buffers, see matcha.readers.get_track_buffers.
+        crthit_buffers (dict): CRT hit buffers, see matcha.readers.get_crthit_buffers.
+
+    Returns:
+        tuple: Output of get_dataset_track_best_matches, and its stats with the
+               clustering counters and the matching time in 'seconds'.
+    """
+    from .dataset_matcher import get_dataset_track_best_matches
+    from .crthit_clustering import get_clustered_crthit_buffers
+
+    start_time = time.perf_counter()
+    config = _worker_state['config']
+    track_columns = get_track_columns_from_buffers(track_buffers, config['pca_parameters'],
+                                                   _worker_state['endpoint_cache'])
+    stats = {}
+    crthit_buffers = get_clustered_crthit_buffers(crthit_buffers, config, stats)
+    crthit_columns = get_crthit_columns_from_buffers(crthit_buffers, config['dca_parameters'])
+    dataset_matches = get_dataset_track_best_matches(track_columns, crthit_columns, config, stats)
+    stats['seconds'] = time.perf_counter() - start_time
+
+    return dataset_matches, stats
+
+class MatchRequestHandler(socketserver.BaseRequestHandler):
+    """
+    Serve the requests of one client connection until it is closed.
+    """
+    def handle(self):
+        while True:
+            try:
+                header, arrays = receive_message(self.request)
+            except (ConnectionError, ValueError):
+                return
+            if header is None: return
+
+            try:
+                reply_header, reply_arrays = self.server.handle_request_message(header, arrays)
+            except Exception as error:
+                reply_header, reply_arrays = {'status': 'error', 'message': repr(error)}, None
+            try:
+                send_message(self.request, reply_header, reply_arrays)
+            except OSError:
+                return
+
+class MatchServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Unix socket server dispatching match requests to a pool of warm worker processes.
+
+    Attributes:
+        config (dict): Dictionary from parsing matcha config file
+        executor (ProcessPoolExecutor): Worker pool.
+        n_requests (int): Number of requests served.
+
+    Methods:
+        handle_request_message(header, arrays): Reply header and arrays for a request.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, config, n_workers=None):
+        if get_matching_method(config) != 'dca':
+            raise ValueError('The matching service only supports the dca matching_method')
+
+        self.config = config
+        self.n_requests = 0
+        # Connections are handled in concurrent threads
+        self._n_requests_lock = threading.Lock()
+        n_workers = n_workers or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(max_workers=n_workers, initializer=initialize_worker,
+                                            initargs=(config,))
+        # Start every worker now so that the first requests find them warm
+        for future in [self.executor.submit(time.sleep, 0) for _ in range(n_workers)]:
+            future.result()
+
+        if os.path.exists(socket_path): os.remove(socket_path)
+        super().__init__(socket_path, MatchRequestHandler)
+
+    def handle_request_message(self, header, arrays):
+        """
+        Handle one request.
+
+        Parameters:
+            header (dict): Request header, with 'op' set to 'ping' or 'match'.
+            arrays (dict): Request arrays.
+
+        Returns:
+            tuple: Reply header and dictionary of reply arrays.
+        """
+        with self._n_requests_lock:
+            self.n_requests += 1
+            n_requests = self.n_requests
+        operation = header.get('op')
+        if operation == 'ping':
+            return {'status': 'ok', 'pid': os.getpid(), 'n_requests': n_requests}, None
+        if operation != 'match':
+            raise ValueError('Invalid operation {}'.format(operation))
+
+        track_buffers = {key[len('tracks/'):]: value for key, value in arrays.items() if key.startswith('tracks/')}
+        crthit_buffers = {key[len('crthits/'):]: value for key, value in arrays.items() if key.startswith('crthits/')}
+        dataset_matches, stats = self.executor.submit(match_buffers, track_buffers, crthit_buffers).result()
+        return {'status': 'ok', 'stats': stats}, dataset_matches
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False)
+        if os.path.exists(self.server_address): os.remove(self.server_address)
+
+def serve(config, socket_path=DEFAULT_SOCKET_PATH, n_workers=None):
+    """
+    Run the matching service until interrupted (SIGINT or SIGTERM), then stop
+    the workers and remove the socket.
+
+    Parameters:
+        config (dict): Dictionary from parsing matcha config file
+        socket_path (str, optional): Path of the Unix socket. Default: DEFAULT_SOCKET_PATH
+        n_workers (int, optional): Number of worker processes. Default: None (CPU count)
+
+    Returns: None
+        This function does not return any value.
+    """
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    with MatchServer(socket_path, config, n_workers) as server:
+        print('matcha service listening on', socket_path)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+class MatchClient:
+    """
+    Client of the matching service. One connection is kept open and reused
+    for every request.
+
+    Attributes:
+        socket_path (str): Path of the service Unix socket.
+
+    Methods:
+        ping(): Check that the service is up.
+        match(track_buffers, crthit_buffers): Best match of every track.
+        match_events(events): Best match of every track of (image_id, tracks, crthits) events.
+        close(): Close the connection.
+    """
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH, timeout=None):
+        self.socket_path = socket_path
+        self._connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._connection.settimeout(timeout)
+        self._connection.connect(socket_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception_info):
+        self.close()
+
+    def close(self):
+        self._connection.close()
+
+    def request(self, header, arrays=None):
+        """
+        Send a request and wait for its reply.
+
+        Parameters:
+            header (dict): Request header.
+            arrays (dict, optional): Request arrays. Default: None
+
+        Returns:
+            tuple: Reply header and dictionary of reply arrays.
+        """
+        send_message(self._connection, header, arrays)
+        reply_header, reply_arrays = receive_message(self._connection)
+        if reply_header is None:
+            raise ConnectionError('matcha service closed the connection')
+        if reply_header.get('status') != 'ok':
+            raise RuntimeError('matcha service error: {}'.format(reply_header.get('message')))
+        return reply_header, reply_arrays
+
+    def ping(self):
+        """
+        Check that the service is up.
+
+        Returns:
+            dict: Reply header, with the service 'pid' and 'n_requests'.
+        """
+        return self.request({'op': 'ping'})[0]
+
+    def match(self, track_buffers, crthit_buffers, stats=None):
+        """
+        Find the best CRT hit of every track. Each track is only compared with
+        the CRT hits sharing its image_id.
+
+        Parameters:
+            track_buffers (dict): Track buffers, see matcha.readers.get_track_buffers.
+            crthit_buffers (dict): CRT hit buffers, see matcha.readers.get_crthit_buffers.
+            stats (dict, optional): If provided, filled with the matching stats of the
+                                    service. Default: None
+
+        Returns:
+            dict: Dictionary with keys 'track_ids', 'image_ids', 'crthit_ids' and
+                  'distances', as returned by get_dataset_track_best_matches.
+        """
+        arrays = {'tracks/' + key: track_buffers[key] for key in TRACK_BUFFER_KEYS}
+        arrays.update({'tracks/' + key: track_buffers[key] for key in TRACK_ENDPOINT_KEYS if key in track_buffers})
+        arrays.update({'crthits/' + key: crthit_buffers[key] for key in CRTHIT_BUFFER_KEYS})
+        reply_header, reply_arrays = self.request({'op': 'match'}, arrays)
+        if stats is not None: stats.update(reply_header['stats'])
+        return reply_arrays
+
+    def match_events(self, events, stats=None):
+        """
+        Find the best CRT hit of every track of a list of events.
+
+        Parameters:
+            events (iterable): Iterable of (image_id, tracks, crthits) tuples.
+            stats (dict, optional): See match. Default: None
+
+        Returns:
+            dict: See match.
+        """
+        return self.match(*get_event_buffers(events), stats=stats)
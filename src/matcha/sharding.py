@@ -0,0 +1,435 @@
+import os
+import sys
+import json
+import time
+import pickle
+import hashlib
+import tempfile
+import subprocess
+from .loader import load_config
+from .writer import write_to_file
+from .match_maker import get_track_best_matches
+"""
+Sharded execution of the matcher over many pickle files, for batch nodes.
+
+A manifest assigns the input files written by write_to_file, or the events
+within them, to N shards and embeds the config, so that it is all a node
+needs besides the inputs. Each shard runs the matcher on its own and writes
+shard_<index>_<hash>.pkl, whose header records the manifest hash and shard
+index. The merge reads every shard output of the manifest, checks that no
+shard is missing or duplicated and that every event appears exactly once,
+and writes one output in manifest order: files in the order given to
+build_manifest, events by image_id within a file.
+
+Locally, run_local starts one `python -m matcha.cli run-shard` process per
+shard as the nodes, and only re-runs the shards without a valid output. The
+processes use the running interpreter, sys.executable, which must be able to
+import matcha: install it there, e.g. with `pip install -e .`.
+"""
+
+MANIFEST_VERSION = 1
+
+FILE_SHARDING  = 'file'
+EVENT_SHARDING = 'event'
+SHARDING_MODES = [FILE_SHARDING, EVENT_SHARDING]
+
+SHARD_FILE_PREFIX = 'shard_'
+
+def build_manifest(input_files, n_shards, config_path, manifest_path, mode=FILE_SHARDING):
+    """
+    Assign input files, or the events within them, to shards and write the manifest.
+
+    The config is embedded as it is: its save_file_path is not checked, since
+    the manifest is usually built on another machine than the nodes, and shard
+    outputs go to the output_dir of run_shard anyway.
+
+    Units are assigned largest first to the shard with the smallest load, which
+    is the file size in file mode and the number of tracks in event mode. Ties
+    are broken by unit order, so the same inputs always give the same manifest.
+
+    Parameters:
+        input_files (list): Paths to pickle files written by write_to_file.
+        n_shards (int): Number of shards.
+        config_path (str): Path to the matcha config file, embedded in the manifest.
+        manifest_path (str): Path of the manifest json file to write.
+        mode (str, optional): One of SHARDING_MODES. Default: 'file'
+
+    Returns:
+        dict: The manifest, with its hash under 'manifest_hash'.
+    """
+    if mode not in SHARDING_MODES:
+        raise ValueError('Invalid sharding mode {:s}, must be one of {}'.format(str(mode), SHARDING_MODES))
+    if n_shards < 1:
+        raise ValueError('n_shards must be at least 1, got {}'.format(n_shards))
+
+    input_files = [os.path.abspath(file_path) for file_path in input_files]
+    if len(set(input_files)) != len(input_files):
+        raise ValueError('Input files must not be repeated')
+
+    units, weights = [], []
+    for file_index, file_path in enumerate(input_files):
+        if mode == FILE_SHARDING:
+            units.append({'file_index': file_index, 'image_ids': None})
+            weights.append(os.path.getsize(file_path))
+            continue
+        event_n_tracks = get_file_event_n_tracks(file_path)
+        for image_id, n_tracks in sorted(event_n_tracks.items()):
+            units.append({'file_index': file_index, 'image_ids': [image_id]})
+            weights.append(n_tracks)
+
+    shards = [[] for _ in range(n_shards)]
+    shard_loads = [0] * n_shards
+    for unit_index in sorted(range(len(units)), key=lambda i: (-weights[i], i)):
+        shard_index = min(range(n_shards), key=lambda i: (shard_loads[i], i))
+        shards[shard_index].append(unit_index)
+        shard_loads[shard_index] += weights[unit_index]
+
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'mode': mode,
+        'n_shards': n_shards,
+        'input_files': input_files,
+        'config': load_config(config_path, check_paths=False),
+        'units': units,
+        'shards': [sorted(shard) for shard in shards],
+    }
+    manifest['manifest_hash'] = get_manifest_hash(manifest)
+
+    write_atomically(manifest_path, json.dumps(manifest, indent=1).encode())
+    print('Manifest with', n_shards, 'shards over', len(units), 'units saved to', manifest_path)
+
+    return manifest
+
+def get_file_event_n_tracks(file_path):
+    """
+    Count the tracks of each event in a pickle file written by write_to_file.
+
+    Parameters:
+        file_path (str): Path to the pickle file.
+
+    Returns:
+        dict: Dictionary mapping image_id to the number of tracks.
+    """
+    with open(file_path, 'rb') as file:
+        output_data = pickle.load(file)
+
+    event_n_tracks = {}
+    for track in output_data['tracks']:
+        image_id = int(track.image_id)
+        event_n_tracks[image_id] = event_n_tracks.get(image_id, 0) + 1
+
+    return event_n_tracks
+
+def get_manifest_hash(manifest):
+    """
+    Hash the content of a manifest, excluding the hash itself.
+
+    Parameters:
+        manifest (dict): Manifest dictionary.
+
+    Returns:
+        str: Hexadecimal sha256 digest.
+    """
+    content = {key: value for key, value in manifest.items() if key != 'manifest_hash'}
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+def load_manifest(manifest_path):
+    """
+    Load a manifest and check its hash.
+
+    Parameters:
+        manifest_path (str): Path of the manifest json file.
+
+    Returns:
+        dict: The manifest.
+    """
+    with open(manifest_path, 'r') as file:
+        manifest = json.load(file)
+
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError('Unsupported manifest version {}'.format(manifest.get('version')))
+    if get_manifest_hash(manifest) != manifest['manifest_hash']:
+        raise ValueError('Manifest {:s} does not match its hash'.format(manifest_path))
+
+    return manifest
+
+def get_shard_file_name(manifest, shard_index):
+    """
+    Name of the output file of a shard.
+
+    Parameters:
+        manifest (dict): Manifest dictionary.
+        shard_index (int): Index of the shard.
+
+    Returns:
+        str: File name, unique to the shard and the manifest.
+    """
+    return '{:s}{:05d}_{:s}.pkl'.format(SHARD_FILE_PREFIX, shard_index, manifest['manifest_hash'][:16])
+
+def run_shard(manifest_path, shard_index, output_dir):
+    """
+    Run the matcher on the units of one shard and write the shard output.
+
+    The output holds two pickled objects: a header with the manifest hash,
+    shard index and event keys, then the events. It is written to a temporary
+    file and renamed, so a failed or killed shard leaves no output behind.
+
+    Parameters:
+        manifest_path (str): Path of the manifest json file.
+        shard_index (int): Index of the shard to run.
+        output_dir (str): Directory of the shard outputs.
+
+    Returns:
+        str: Path of the shard output.
+    """
+    manifest = load_manifest(manifest_path)
+    if not 0 <= shard_index < manifest['n_shards']:
+        raise ValueError('Shard index {} out of range for {} shards'.format(shard_index, manifest['n_shards']))
+
+    start_time = time.time()
+    config = manifest['config']
+    unit_indices = manifest['shards'][shard_index]
+    file_units = {}
+    for unit_index in unit_indices:
+        unit = manifest['units'][unit_index]
+        file_units.setdefault(unit['file_index'], []).append(unit['image_ids'])
+
+    events, file_crthits = [], {}
+    for file_index, unit_image_ids in sorted(file_units.items()):
+        with open(manifest['input_files'][file_index], 'rb') as file:
+            output_data = pickle.load(file)
+
+        # CRT hits have no image_id: every hit of the file goes with each of its events
+        crthits = output_data['crthits']
+        file_crthits[file_index] = crthits
+        selected_image_ids = None if None in unit_image_ids else \
+                             {image_id for image_ids in unit_image_ids for image_id in image_ids}
+
+        event_tracks = {}
+        for track in output_data['tracks']:
+            image_id = int(track.image_id)
+            if selected_image_ids is None or image_id in selected_image_ids:
+                event_tracks.setdefault(image_id, []).append(track)
+
+        for image_id, tracks in sorted(event_tracks.items()):
+            match_candidates = get_track_best_matches(tracks, crthits, config)
+            events.append({'file_index': file_index, 'image_id': image_id,
+                           'tracks': tracks, 'match_candidates': match_candidates})
+
+    header = {
+        'manifest_hash': manifest['manifest_hash'],
+        'shard_index': shard_index,
+        'event_keys': [(event['file_index'], event['image_id']) for event in events],
+        'n_matches': sum(len(event['match_candidates']) for event in events),
+        'run_time': time.time() - start_time,
+    }
+    shard_path = os.path.join(output_dir, get_shard_file_name(manifest, shard_index))
+    write_atomically(shard_path, pickle.dumps(header) + pickle.dumps({'events': events, 'crthits': file_crthits}))
+    print('Shard', shard_index, 'with', len(events), 'events saved to', shard_path)
+
+    return shard_path
+
+def write_atomically(file_path, data):
+    """
+    Write bytes to a temporary file in the target directory, then rename it.
+
+    Parameters:
+        file_path (str): Path of the file to write.
+        data (bytes): Content of the file.
+
+    Returns: None
+        This function does not return any value.
+    """
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_path)),
+                                                       suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'wb') as file:
+            file.write(data)
+        os.replace(temporary_path, file_path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+def read_shard_header(shard_path):
+    """
+    Read the header of a shard output without loading its events.
+
+    Parameters:
+        shard_path (str): Path of the shard output.
+
+    Returns:
+        dict: Header dictionary.
+    """
+    with open(shard_path, 'rb') as file:
+        return pickle.load(file)
+
+def get_shard_status(manifest, output_dir):
+    """
+    Find the shard outputs of a manifest in a directory.
+
+    Outputs of other manifests are ignored. An output whose events differ from
+    its shard's units, or which cannot be read, counts as failed.
+
+    Parameters:
+        manifest (dict): Manifest dictionary.
+        output_dir (str): Directory of the shard outputs.
+
+    Returns:
+        dict: Dictionary with keys 'completed' (shard index to list of output
+              paths), 'missing' (shard indices without output), 'duplicated'
+              (shard indices with several outputs) and 'failed' (paths of
+              unreadable or inconsistent outputs).
+    """
+    expected_keys = get_expected_event_keys(manifest)
+    completed, failed = {}, []
+    file_names = sorted(os.listdir(output_dir)) if os.path.isdir(output_dir) else []
+    for file_name in file_names:
+        if not (file_name.startswith(SHARD_FILE_PREFIX) and file_name.endswith('.pkl')): continue
+        shard_path = os.path.join(output_dir, file_name)
+        try:
+            header = read_shard_header(shard_path)
+        except Exception:
+            failed.append(shard_path)
+            continue
+        if header.get('manifest_hash') != manifest['manifest_hash']: continue
+        shard_index = header['shard_index']
+        event_keys = [tuple(key) for key in header['event_keys']]
+        if expected_keys[shard_index] is None:
+            shard_file_indices = {manifest['units'][i]['file_index'] for i in manifest['shards'][shard_index]}
+            is_consistent = {file_index for file_index, _ in event_keys} <= shard_file_indices
+        else:
+            is_consistent = event_keys == expected_keys[shard_index]
+        if not is_consistent:
+            failed.append(shard_path)
+            continue
+        completed.setdefault(shard_index, []).append(shard_path)
+
+    return {
+        'completed': completed,
+        'missing': [i for i in range(manifest['n_shards']) if i not in completed],
+        'duplicated': sorted(i for i, paths in completed.items() if len(paths) > 1),
+        'failed': failed,
+    }
+
+def get_expected_event_keys(manifest):
+    """
+    Event keys each shard is expected to produce, in the order run_shard writes them.
+    In file mode the image_ids are not known from the manifest, so only the
+    file indices are checked.
+
+    Parameters:
+        manifest (dict): Manifest dictionary.
+
+    Returns:
+        list: One list of (file_index, image_id) tuples per shard, or None per
+              shard in file mode.
+    """
+    if manifest['mode'] == FILE_SHARDING:
+        return [None] * manifest['n_shards']
+
+    expected_keys = []
+    for unit_indices in manifest['shards']:
+        keys = [(manifest['units'][i]['file_index'], image_id)
+                for i in unit_indices for image_id in manifest['units'][i]['image_ids']]
+        expected_keys.append(sorted(keys))
+
+    return expected_keys
+
+def merge_shards(manifest_path, output_dir, file_path='./', file_name='matcha_output.pkl'):
+    """
+    Concatenate the shard outputs of a manifest into one write_to_file output.
+
+    Events are ordered by file (in manifest order) and by image_id within a
+    file, whatever the shard assignment. CRT hits are written once per input
+    file, in the same order.
+
+    Parameters:
+        manifest_path (str): Path of the manifest json file.
+        output_dir (str): Directory of the shard outputs.
+        file_path (str, optional): Directory to store the merged file. Default: './' (cwd)
+        file_name (str, optional): Name of the merged file. Default: 'matcha_output.pkl'
+
+    Returns:
+        dict: Dictionary with keys 'n_events', 'n_tracks', 'n_crthits' and 'n_matches'.
+    """
+    manifest = load_manifest(manifest_path)
+    status = get_shard_status(manifest, output_dir)
+    if status['missing'] or status['duplicated']:
+        raise ValueError('Cannot merge: missing shards {}, duplicated shards {}'.format(
+            status['missing'], status['duplicated']))
+
+    events, file_crthits = {}, {}
+    for shard_index in range(manifest['n_shards']):
+        with open(status['completed'][shard_index][0], 'rb') as file:
+            pickle.load(file)
+            shard_data = pickle.load(file)
+        for event in shard_data['events']:
+            event_key = (event['file_index'], event['image_id'])
+            if event_key in events:
+                raise ValueError('Event {} appears in more than one shard'.format(event_key))
+            events[event_key] = event
+        for file_index, crthits in shard_data['crthits'].items():
+            file_crthits.setdefault(file_index, crthits)
+
+    file_indices = {file_index for file_index, _ in events}
+    missing_files = [i for i in range(len(manifest['input_files'])) if i not in file_indices]
+    if missing_files:
+        print('WARNING: no events in input files', [manifest['input_files'][i] for i in missing_files])
+
+    tracks, crthits, match_candidates = [], [], []
+    for event_key in sorted(events):
+        tracks.extend(events[event_key]['tracks'])
+        match_candidates.extend(events[event_key]['match_candidates'])
+    for file_index in sorted(file_crthits):
+        crthits.extend(file_crthits[file_index])
+
+    write_to_file(tracks, crthits, match_candidates=match_candidates, file_path=file_path, file_name=file_name)
+
+    return {
+        'n_events': len(events),
+        'n_tracks': len(tracks),
+        'n_crthits': len(crthits),
+        'n_matches': len(match_candidates),
+    }
+
+def run_local(manifest_path, output_dir, n_processes=None, shard_indices=None):
+    """
+    Run shards as separate local processes, standing in for batch nodes. Each
+    process runs `matcha.cli run-shard` with sys.executable, so matcha must be
+    installed in the interpreter running this function.
+
+    Parameters:
+        manifest_path (str): Path of the manifest json file.
+        output_dir (str): Directory of the shard outputs.
+        n_processes (int, optional): Number of concurrent processes. Default: None (CPU count)
+        shard_indices (list, optional): Shards to run. Default: None, which runs the
+                                        shards that are missing from output_dir.
+
+    Returns:
+        dict: Dictionary mapping each shard index run to its process return code.
+    """
+    manifest = load_manifest(manifest_path)
+    os.makedirs(output_dir, exist_ok=True)
+    if shard_indices is None:
+        shard_indices = get_shard_status(manifest, output_dir)['missing']
+    n_processes = n_processes or os.cpu_count() or 1
+
+    return_codes, processes = {}, {}
+    pending = list(shard_indices)
+    while pending or processes:
+        while pending and len(processes) < n_processes:
+            shard_index = pending.pop(0)
+            command = [sys.executable, '-m', 'matcha.cli', 'run-shard', manifest_path,
+                       str(shard_index), output_dir]
+            processes[shard_index] = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+        for shard_index, process in list(processes.items()):
+            if process.poll() is None: continue
+            return_codes[shard_index] = process.returncode
+            del processes[shard_index]
+        if processes: time.sleep(0.05)
+
+    failed = sorted(i for i, return_code in return_codes.items() if return_code != 0)
+    if failed:
+        print('WARNING: shards', failed, 'failed, run again to re-run only these')
+
+    return return_codes
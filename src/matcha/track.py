@@ -1,12 +1,108 @@
+import time
 import numpy as np
-from sklearn.decomposition import PCA
-from scipy.spatial.distance import cdist
 from .track_point import TrackPoint
+from .legacy_state import LegacyStateMixin
 
 # TODO list:
 #   - What does "rescaled ADC units mean? (from Particle class)
 
-class Track:
+# Precision of the point clouds is left as provided by the caller
+NATIVE_PRECISION = 'native'
+# Half-width of the end point windows along the track axis, in units of the
+# PCA radius: two radii plus a margin for rounding in the projection
+ENDPOINT_WINDOW_SCALE = 2.5
+# Values of Track.endpoint_fallback when get_endpoints exceeds its budget:
+# more points than pca_params['max_points'], or longer than pca_params['max_seconds']
+POINT_BUDGET_FALLBACK = 'subsampled'
+TIME_BUDGET_FALLBACK = 'global_pca'
+# Fewest points a two-component PCA can be fitted on
+MIN_PCA_POINTS = 2
+# With pca_params['max_seconds'], the global PCA of tracks with at least
+# GLOBAL_PCA_PROBE_MIN_POINTS points is first fitted on every
+# GLOBAL_PCA_PROBE_STRIDE-th point to predict the time of the full fit
+GLOBAL_PCA_PROBE_STRIDE = 8
+GLOBAL_PCA_PROBE_MIN_POINTS = 10_000
+
+def get_points_in_radius_mask(center, points, radius):
+    """
+    Find the points lying within a radius of a center point. Single-precision 
+    point clouds are searched in single precision; cdist otherwise promotes
+    everything to double precision.
+
+    Parameters:
+        center (numpy.ndarray): A numpy array of shape (3,).
+        points (numpy.ndarray): A numpy array of shape (N, 3).
+        radius (float): Radius (in cm) of the neighborhood.
+
+    Returns:
+        numpy.ndarray: Boolean array of shape (N,), True for points within radius.
+    """
+    if points.dtype == np.float32:
+        offsets = points - np.asarray(center, dtype=np.float32)
+        return np.einsum('ij,ij->i', offsets, offsets) < np.float32(radius)**2
+
+    from scipy.spatial.distance import cdist
+    return cdist([center], points)[0] < radius
+
+def get_subsample_indices(n_points, max_points):
+    """
+    Select evenly strided points, in their original order.
+
+    Parameters:
+        n_points (int): Number of points.
+        max_points (int): Number of points to keep.
+
+    Returns:
+        numpy.ndarray: Indices of the kept points, shape (min(n_points, max_points),).
+    """
+    if n_points <= max_points: return np.arange(n_points)
+    return np.linspace(0, n_points - 1, max_points).astype(np.int64)
+
+def get_voxel_centroids(points, voxel_pitch):
+    """
+    Downsample a point cloud onto the centroids of a regular grid of cubic voxels.
+
+    Parameters:
+        points (numpy.ndarray): A numpy array of shape (N, 3).
+        voxel_pitch (float): Voxel side length in cm.
+
+    Returns:
+        tuple: A numpy array of shape (M, 3) with the centroid of the points in
+               each occupied voxel, and a numpy array of shape (N,) with the
+               voxel index of each point.
+    """
+    voxel_indices = np.floor(points / voxel_pitch).astype(np.int64)
+    voxel_indices -= voxel_indices.min(axis=0)
+    grid_shape = voxel_indices.max(axis=0) + 1
+    voxel_keys = np.ravel_multi_index(voxel_indices.T, grid_shape)
+    _, voxel_inverse, voxel_counts = np.unique(voxel_keys, return_inverse=True, return_counts=True)
+    voxel_inverse = voxel_inverse.reshape(-1)
+
+    voxel_centroids = np.stack([np.bincount(voxel_inverse, weights=points[:, axis]) 
+                                for axis in range(3)], axis=1) / voxel_counts[:, None]
+
+    return voxel_centroids.astype(points.dtype), voxel_inverse
+
+def voxelize_points(points, depositions, voxel_pitch):
+    """
+    Downsample a point cloud and its depositions onto a regular grid of cubic voxels.
+
+    Parameters:
+        points (numpy.ndarray): A numpy array of shape (N, 3).
+        depositions (numpy.ndarray): A numpy array of shape (N,).
+        voxel_pitch (float): Voxel side length in cm.
+
+    Returns:
+        tuple: A numpy array of shape (M, 3) with the centroid of the points in
+               each occupied voxel, and a numpy array of shape (M,) with the
+               summed depositions of each voxel.
+    """
+    voxel_centroids, voxel_inverse = get_voxel_centroids(points, voxel_pitch)
+    voxel_depositions = np.bincount(voxel_inverse, weights=depositions, minlength=len(voxel_centroids))
+
+    return voxel_centroids, voxel_depositions.astype(depositions.dtype)
+
+class Track(LegacyStateMixin):
     """
     Class for storing TPC track information. The stored tracks are
     assumed to be muon candidates for CRT-TPC matching.
@@ -30,6 +126,9 @@ class Track:
         end_dir_x (float, optional): x-direction of the first track point. Default: None.
         end_dir_y (float, optional): y-direction of the first track point. Default: None.
         end_dir_z (float, optional): z-direction of the first track point. Default: None.
+        endpoint_fallback (str): Set by get_endpoints if the track exceeded its compute
+                                 budget: POINT_BUDGET_FALLBACK or TIME_BUDGET_FALLBACK.
+                                 Default: None.
 
     Methods:
         get_endpoints(points, depositions, radius=20):
@@ -38,6 +137,10 @@ class Track:
             Returns: list of two TrackPoint instances containing the start
             and end point positions and unit vectors.
     """
+    __slots__ = ('id', 'image_id', 'interaction_id', 'start_x', 'start_y', 'start_z', 'start_dir_x',
+                 'start_dir_y', 'start_dir_z', 'end_x', 'end_y', 'end_z', 'end_dir_x', 'end_dir_y',
+                 'end_dir_z', 'points', 'depositions', 'endpoint_fallback')
+
     def __init__(self, id, image_id, interaction_id, 
                  points, depositions,
                  start_x=None, start_y=None, start_z=None, 
@@ -45,154 +148,63 @@ class Track:
                  end_x=None, end_y=None, end_z=None,
                  end_dir_x=None, end_dir_y=None, end_dir_z=None):
 
-        self._id = id
-        self._image_id       = image_id
-        self._interaction_id = interaction_id
-        self._points = points
-        self._depositions = depositions
-        self._start_x = start_x
-        self._start_y = start_y
-        self._start_z = start_z
-        self._start_dir_x = start_dir_x
-        self._start_dir_y = start_dir_y
-        self._start_dir_z = start_dir_z
-        self._end_x = end_x
-        self._end_y = end_y
-        self._end_z = end_z
-        self._end_dir_x = end_dir_x
-        self._end_dir_y = end_dir_y
-        self._end_dir_z = end_dir_z
+        self.id = id
+        self.image_id       = image_id
+        self.interaction_id = interaction_id
+        self.points = points
+        self.depositions = depositions
+        self.start_x = start_x
+        self.start_y = start_y
+        self.start_z = start_z
+        self.start_dir_x = start_dir_x
+        self.start_dir_y = start_dir_y
+        self.start_dir_z = start_dir_z
+        self.end_x = end_x
+        self.end_y = end_y
+        self.end_z = end_z
+        self.end_dir_x = end_dir_x
+        self.end_dir_y = end_dir_y
+        self.end_dir_z = end_dir_z
+        self.endpoint_fallback = None
+
+    def __setstate__(self, state):
+        # Pickles written before endpoint_fallback existed do not set it
+        self.endpoint_fallback = None
+        super().__setstate__(state)
 
     def __str__(self):
         return (f"[Track] ID {self.id}, image_id {self.image_id}, interaction_id {self.interaction_id}\n\t"
                 f"start xyz: ({self.start_x}, {self.start_y}, {self.start_z})\n\t"
                 f"end xyz: ({self.end_x}, {self.end_y}, {self.end_z})")
 
-    ### Getters and setters ###
-    @property
-    def id(self):
-        return self._id
-    @id.setter
-    def id(self, value):
-        self._id = value
-
-    @property
-    def image_id(self):
-        return self._image_id
-    @image_id.setter
-    def image_id(self, value):
-        self._image_id = value
-
-    @property
-    def interaction_id(self):
-        return self._interaction_id
-    @interaction_id.setter
-    def interaction_id(self, value):
-        self._interaction_id = value
-
-    @property
-    def start_x(self):
-        return self._start_x
-    @start_x.setter
-    def start_x(self, value):
-        self._start_x = value
-
-    @property
-    def start_y(self):
-        return self._start_y
-    @start_y.setter
-    def start_y(self, value):
-        self._start_y = value
-
-    @property
-    def start_z(self):
-        return self._start_z
-    @start_z.setter
-    def start_z(self, value):
-        self._start_z = value
-
-    @property
-    def start_dir_x(self):
-        return self._start_dir_x
-    @start_dir_x.setter
-    def start_dir_x(self, value):
-        self._start_dir_x = value
-
-    @property
-    def start_dir_y(self):
-        return self._start_dir_y
-    @start_dir_y.setter
-    def start_dir_y(self, value):
-        self._start_dir_y = value
-
-    @property
-    def start_dir_z(self):
-        return self._start_dir_z
-    @start_dir_z.setter
-    def start_dir_z(self, value):
-        self._start_dir_z = value
-
-    @property
-    def end_x(self):
-        return self._end_x
-    @end_x.setter
-    def end_x(self, value):
-        self._end_x = value
-
-    @property
-    def end_y(self):
-        return self._end_y
-    @end_y.setter
-    def end_y(self, value):
-        self._end_y = value
-
-    @property
-    def end_z(self):
-        return self._end_z
-    @end_z.setter
-    def end_z(self, value):
-        self._end_z = value
-
-    @property
-    def end_dir_x(self):
-        return self._end_dir_x
-    @end_dir_x.setter
-    def end_dir_x(self, value):
-        self._end_dir_x = value
-
-    @property
-    def end_dir_y(self):
-        return self._end_dir_y
-    @end_dir_y.setter
-    def end_dir_y(self, value):
-        self._end_dir_y = value
-
-    @property
-    def end_dir_z(self):
-        return self._end_dir_z
-    @end_dir_z.setter
-    def end_dir_z(self, value):
-        self._end_dir_z = value
-
-    @property
-    def points(self):
-        return self._points
-    @points.setter
-    def points(self, value):
-        self._points = value
-
-    @property 
-    def depositions(self):
-        return self._depositions
-    @depositions.setter
-    def depositions(self, value):
-        self._depositions = value
+    def set_precision(self, precision):
+        """
+        Store the track points and depositions with the given floating point
+        precision, e.g. 'float32' to halve their memory footprint. The arrays
+        are replaced by cast copies; the arrays passed in are not modified.
+
+        Parameters:
+            precision (str): numpy dtype name, or 'native' to leave the arrays as they are.
+        """
+        if precision == NATIVE_PRECISION: return
+        self.points = np.asarray(self.points, dtype=precision)
+        self.depositions = np.asarray(self.depositions, dtype=precision)
 
     def get_endpoints(self, pca_params):
         """
         Calculates the start/end points of the track using local charge
         density to guess at the Bragg peak.
 
+        With pca_params['max_points'], the global PCA of tracks with more points
+        is fitted on an evenly strided subsample, and the local PCAs and density
+        sums only search the points in the two end windows, as with voxel_pitch.
+        With pca_params['max_seconds'], large tracks keep the global PCA of a
+        strided subsample if the full fit is predicted to exceed the budget, and
+        a track still running after its global PCA skips the remaining local
+        PCAs: the global PCA extrema are kept as candidates and the principal
+        axis is used as the direction of both ends. Either way endpoint_fallback
+        is set.
+
 		Parameters:
             pca_params (dict): Dictionary of PCA parameters from loaded matcha config file
 
@@ -200,14 +212,25 @@ class Track:
             list: A list containing two numpy arrays of shape (3,), representing 
                   the start and end points of the track, respectively.
         """
+        # Imported here to keep sklearn and scipy out of the package import time
+        from sklearn.decomposition import PCA
+        from scipy.spatial.distance import cdist
+
         if not self.points.any():
             raise ValueError('Track points attribute must be filled before calling get_endpoints')
         if not self.depositions.any():
             raise ValueError('Track depositions attribute must be filled before calling get_endpoints')
 
+        start_time = time.perf_counter()
         radius = pca_params['radius']
         min_points_in_radius = pca_params['min_points_in_radius']
         direction_method = pca_params['direction_method']
+        voxel_pitch = pca_params.get('voxel_pitch', 0)
+        max_points = pca_params.get('max_points', 0) or 0
+        max_seconds = pca_params.get('max_seconds', 0) or 0
+        # Imported here, kernels depends on this module
+        from .kernels import resolve_kernel, radius_density_numba, NUMPY_KERNEL, NUMBA_KERNEL
+        use_density_kernel = resolve_kernel(pca_params.get('kernel', NUMPY_KERNEL)) == NUMBA_KERNEL
 
         def get_local_density(candidates, points, depositions, radius, min_points_in_radius):
             """
@@ -234,23 +257,72 @@ class Track:
             """
             local_density = []
             for candidate in candidates:
-                mask = cdist([candidate], points)[0] < radius
-                if np.sum(mask) > min_points_in_radius:
+                if use_density_kernel:
+                    # Count and sum in one pass, the mask is only needed for the local PCA
+                    n_points_in_radius, density = radius_density_numba(candidate, points, depositions, radius)
+                    if n_points_in_radius <= min_points_in_radius:
+                        local_density.append(density)
+                        continue
+                mask = get_points_in_radius_mask(candidate, points, radius)
+                if np.sum(mask) > min_points_in_radius and np.sum(mask) >= MIN_PCA_POINTS:
                     local_projection = pca.fit_transform(points[mask])
                     local_candidates = points[mask][np.argmin(local_projection[:, 0])], \
                                        points[mask][np.argmax(local_projection[:, 0])]
                     candidate = local_candidates[np.argmin(cdist([candidate], local_candidates))]
-                    mask = cdist([candidate], points)[0] < radius
+                    if use_density_kernel:
+                        local_density.append(radius_density_numba(candidate, points, depositions, radius)[1])
+                        continue
+                    mask = get_points_in_radius_mask(candidate, points, radius)
                 local_density.append(np.sum(depositions[mask]))
             return local_density
 
         points = self.points
         depositions = self.depositions
+        self.endpoint_fallback = None
+        # The primary axis only depends on the coarse track geometry
+        fit_points = get_voxel_centroids(points, voxel_pitch)[0] if voxel_pitch > 0 else points
+        is_subsampled = bool(max_points) and len(fit_points) > max_points
+        if is_subsampled:
+            fit_points = fit_points[get_subsample_indices(len(fit_points), max_points)]
+            self.endpoint_fallback = POINT_BUDGET_FALLBACK
+
         pca = PCA(n_components=2)
-        projection = pca.fit_transform(points)
-        candidates = np.array([points[np.argmin(projection[:, 0])], 
-                               points[np.argmax(projection[:, 0])]])
-        local_density = get_local_density(candidates, points, depositions, radius, min_points_in_radius)
+        is_over_time_budget = False
+        if max_seconds > 0 and len(fit_points) >= GLOBAL_PCA_PROBE_MIN_POINTS:
+            # Fit a strided subsample first, and only fit every point if that is
+            # predicted to stay within the time budget
+            probe_start_time = time.perf_counter()
+            pca.fit(fit_points[::GLOBAL_PCA_PROBE_STRIDE])
+            probe_end_time = time.perf_counter()
+            predicted_seconds = GLOBAL_PCA_PROBE_STRIDE * (probe_end_time - probe_start_time)
+            is_over_time_budget = probe_end_time - start_time + predicted_seconds > max_seconds
+        if voxel_pitch > 0 or is_subsampled or is_over_time_budget:
+            if not is_over_time_budget: pca.fit(fit_points)
+            primary_projection = (points - pca.mean_) @ pca.components_[0]
+        else:
+            primary_projection = pca.fit_transform(points)[:, 0]
+        candidates = np.array([points[np.argmin(primary_projection)], 
+                               points[np.argmax(primary_projection)]])
+
+        if voxel_pitch > 0 or is_subsampled:
+            # Every point used below lies within two radii of a candidate (one
+            # for the local refinement, one for the density sum), so only points
+            # in those end windows along the primary axis are searched. The
+            # local PCAs then see fewer points near the windows' inner edges
+            window = ENDPOINT_WINDOW_SCALE * radius
+            in_end_windows = (primary_projection <= primary_projection.min() + window) \
+                           | (primary_projection >= primary_projection.max() - window)
+            points = points[in_end_windows]
+            depositions = depositions[in_end_windows]
+
+        is_over_time_budget = is_over_time_budget or \
+                              (max_seconds > 0 and time.perf_counter() - start_time > max_seconds)
+        if is_over_time_budget:
+            # Density around the global extrema, without local refinement
+            local_density = [np.sum(depositions[get_points_in_radius_mask(candidate, points, radius)])
+                             for candidate in candidates]
+        else:
+            local_density = get_local_density(candidates, points, depositions, radius, min_points_in_radius)
 
         # If the second point (assumed to be the end point) has lower charge
         # density, flip the candidates
@@ -258,10 +330,15 @@ class Track:
             candidates = np.flip(candidates, axis=0)
 
         start_point, end_point = candidates[0], candidates[1]
-        angles = self.get_track_point_angles(start_point, end_point, points, 
-                                             radius, min_points_in_radius, direction_method)
-
-        start_direction, end_direction = angles[0], angles[1]
+        is_over_time_budget = is_over_time_budget or \
+                              (max_seconds > 0 and time.perf_counter() - start_time > max_seconds)
+        if is_over_time_budget:
+            start_direction = end_direction = pca.components_[0]
+            self.endpoint_fallback = TIME_BUDGET_FALLBACK
+        else:
+            angles = self.get_track_point_angles(start_point, end_point, points, 
+                                                 radius, min_points_in_radius, direction_method)
+            start_direction, end_direction = angles[0], angles[1]
 
         # Update parent track attributes
         self.start_x, self.start_y, self.start_z = start_point[0], start_point[1], start_point[2]
@@ -347,11 +424,12 @@ class Track:
             numpy.ndarray: A numpy array of shape (2, 3) where each row corresponds 
                            to the start and end point directions, respectively.
         """
+        from sklearn.decomposition import PCA
         pca = PCA(n_components=2)
         directions = []
         for point in (start_point, end_point):
-            mask = cdist([point], points)[0] < radius
-            if np.sum(mask) < min_points_in_radius:
+            mask = get_points_in_radius_mask(point, points, radius)
+            if np.sum(mask) < max(min_points_in_radius, MIN_PCA_POINTS):
                 directions.append(np.array([-9999.0, -9999.0, -9999.0]))
                 continue
             # The first component of the PCA will be the direction
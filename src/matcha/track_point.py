@@ -1,11 +1,30 @@
 import numpy as np
 from .crthit import CRTHit
+from .legacy_state import LegacyStateMixin
 
 DRIFT_VELOCITY = 0.1571 # MC 
 #DRIFT_VELOCITY = 0.157565 # DATA
 TPC_X_BOUNDS = [358.49, 210.215, 61.94, -61.94, -210.215, -358.49]
 from enum import Enum
 
+def get_drift_velocity(isdata=False):
+    """
+    Get the drift velocity used to shift track points, switching the module-level
+    DRIFT_VELOCITY to the data value if running on data.
+
+    Parameters:
+        isdata (bool, optional): Flag indicating whether the code is running on data
+                                 (True) or simulation (False). Default: False
+
+    Returns:
+        float: Drift velocity in cm/us.
+    """
+    global DRIFT_VELOCITY
+    if isdata:
+        DRIFT_VELOCITY = 0.157565
+
+    return DRIFT_VELOCITY
+
 class TPCRegion(Enum):
     """
     Class for determining which TPC or region a track endpoint lies in.
@@ -27,7 +46,23 @@ class TPCRegion(Enum):
     EE          = 5
     EastOfEE    = 6
 
-class TrackPoint:
+# Drift direction of each TPCRegion value, with 0 outside the TPCs
+REGION_DRIFT_DIRECTIONS = np.array([0, 1, -1, 0, 1, -1, 0])
+
+def get_drift_directions(positions_x):
+    """
+    Vectorized counterpart of TrackPoint._get_tpc_region and 
+    TrackPoint._get_drift_direction.
+
+    Parameters:
+        positions_x (numpy.ndarray): x-coordinates of the points in cm.
+
+    Returns:
+        numpy.ndarray: +1 or -1 for points inside an active TPC volume, else 0.
+    """
+    return REGION_DRIFT_DIRECTIONS[np.digitize(positions_x, TPC_X_BOUNDS)]
+
+class TrackPoint(LegacyStateMixin):
     """
     Class for storing and managing track point information, particularly
     start and end points and their directions.
@@ -50,20 +85,22 @@ class TrackPoint:
         shift_position_x(t0, isdata):
             Shifts the point position_x based on t0 and drift velocity.
     """
+    __slots__ = ('track_id', 'position_x', 'position_y', 'position_z', 'direction_x', 'direction_y',
+                 'direction_z', 'drift_direction', 'tpc_region')
 
     def __init__(self, track_id,
                  position_x, position_y, position_z,
                  direction_x, direction_y, direction_z):
-        self._track_id    = track_id
-        self._position_x  = position_x
-        self._position_y  = position_y
-        self._position_z  = position_z
-        self._direction_x = direction_x
-        self._direction_y = direction_y
-        self._direction_z = direction_z
+        self.track_id    = track_id
+        self.position_x  = position_x
+        self.position_y  = position_y
+        self.position_z  = position_z
+        self.direction_x = direction_x
+        self.direction_y = direction_y
+        self.direction_z = direction_z
         if self.position_x is not None:
-            self._tpc_region  = self._get_tpc_region(self.position_x)
-            self._drift_direction = self._get_drift_direction(self.tpc_region)
+            self.tpc_region  = self._get_tpc_region(self.position_x)
+            self.drift_direction = self._get_drift_direction(self.tpc_region)
 
     def __str__(self):
         return (f"[TrackPoint]: track_id {self.track_id}\n\t"
@@ -71,70 +108,6 @@ class TrackPoint:
                 f"dir: ({self.direction_x}, {self.direction_y}, {self.direction_z})\n\t"
                 f"TPC region: {self.tpc_region}, drift direction: {self.drift_direction}")
 
-    ### Getters and setters ###
-    @property
-    def track_id(self):
-        return self._track_id
-    @track_id.setter
-    def track_id(self, value):
-        self._track_id = value
-
-    @property
-    def position_x(self):
-        return self._position_x
-    @position_x.setter
-    def position_x(self, value):
-        self._position_x = value
-
-    @property
-    def position_y(self):
-        return self._position_y
-    @position_y.setter
-    def position_y(self, value):
-        self._position_y = value
-
-    @property
-    def position_z(self):
-        return self._position_z
-    @position_z.setter
-    def position_z(self, value):
-        self._position_z = value
-
-    @property
-    def direction_x(self):
-        return self._direction_x
-    @direction_x.setter
-    def direction_x(self, value):
-        self._direction_x = value
-
-    @property
-    def direction_y(self):
-        return self._direction_y
-    @direction_y.setter
-    def direction_y(self, value):
-        self._direction_y = value
-
-    @property
-    def direction_z(self):
-        return self._direction_z
-    @direction_z.setter
-    def direction_z(self, value):
-        self._direction_z = value
-
-    @property
-    def drift_direction(self):
-        return self._drift_direction
-    @drift_direction.setter
-    def drift_direction(self, value):
-        self._drift_direction = value
-
-    @property
-    def tpc_region(self):
-        return self._tpc_region
-    @tpc_region.setter
-    def tpc_region(self, value):
-        self._tpc_region = value
-
     def is_valid(self):
         """
         Check if TrackPoint position and direction attributes are filled. Used to determine
@@ -207,14 +180,12 @@ class TrackPoint:
         Returns:
             float: Shifted x-position of the track endpoint.
         """
-        global DRIFT_VELOCITY
-        if isdata:
-            DRIFT_VELOCITY = 0.157565
+        drift_velocity = get_drift_velocity(isdata)
 
         position_x = self.position_x
         drift_direction = self.drift_direction
 
-        shifted_x = position_x + DRIFT_VELOCITY * t0 * drift_direction
+        shifted_x = position_x + drift_velocity * t0 * drift_direction
 
         return shifted_x
 
@@ -0,0 +1,321 @@
+import json
+import pickle
+import functools
+import numpy as np
+from .track import voxelize_points
+from .match_candidate import MatchCandidate
+from .crt_geometry import load_crt_geometry, DEFAULT_CRT_GEOMETRY_PATH
+"""
+Level-of-detail helpers for visualizing matcha output in visualizer.ipynb.
+
+Track points are decimated onto voxels sized for the current view and a
+per-event point budget, so the browser never receives every raw space point.
+Events are loaded from matcha output pickles, which are unpickled whole, or
+from a matcha.columnar_store, which only reads the rows of the requested
+events. plotly is only imported by the functions that build traces; install it with
+the optional 'viz' extra.
+"""
+
+# Points sent to the browser per event by default
+DEFAULT_POINT_BUDGET = 50_000
+# Finest voxel pitch (in cm) used when decimating track points
+MIN_VOXEL_PITCH = 0.3
+# Length (in cm) of the end point direction glyphs
+DIRECTION_GLYPH_LENGTH = 50.
+INVALID_DIRECTION = -9999.
+
+# Vertex offsets and triangles of a box, for plotly Mesh3d
+BOX_CORNERS = np.array([[0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0],
+                        [0, 0, 1], [1, 0, 1], [1, 1, 1], [0, 1, 1]])
+BOX_TRIANGLES = np.array([[0, 1, 2], [0, 2, 3], [4, 5, 6], [4, 6, 7],
+                          [0, 1, 5], [0, 5, 4], [2, 3, 7], [2, 7, 6],
+                          [1, 2, 6], [1, 6, 5], [0, 3, 7], [0, 7, 4]])
+
+def decimate_points(points, depositions, point_budget, view_bounds=None, min_voxel_pitch=MIN_VOXEL_PITCH):
+    """
+    Downsample a point cloud to at most point_budget voxel centroids, summing
+    the depositions in each voxel. The voxel pitch starts at min_voxel_pitch
+    and is doubled until the budget is met.
+
+    Parameters:
+        points (numpy.ndarray): A numpy array of shape (N, 3).
+        depositions (numpy.ndarray): A numpy array of shape (N,).
+        point_budget (int): Largest number of points to return.
+        view_bounds (numpy.ndarray, optional): Array of shape (2, 3) with the lower
+                                               and upper corner of the view. Points
+                                               outside are dropped. Default: None
+        min_voxel_pitch (float, optional): Finest voxel pitch in cm. Default: MIN_VOXEL_PITCH
+
+    Returns:
+        tuple: Decimated points of shape (M, 3) and depositions of shape (M,).
+    """
+    points = np.asarray(points)
+    depositions = np.asarray(depositions)
+    if view_bounds is not None:
+        in_view = np.all((points >= view_bounds[0]) & (points <= view_bounds[1]), axis=1)
+        points, depositions = points[in_view], depositions[in_view]
+
+    if len(points) <= point_budget: return points, depositions
+    if point_budget <= 0: return points[:0], depositions[:0]
+
+    voxel_pitch = min_voxel_pitch
+    while True:
+        voxel_points, voxel_depositions = voxelize_points(points, depositions, voxel_pitch)
+        if len(voxel_points) <= point_budget: return voxel_points, voxel_depositions
+        voxel_pitch *= 2
+
+def get_track_point_budgets(tracks, point_budget):
+    """
+    Split an event point budget between tracks in proportion to their number
+    of points. Tracks below their share keep all of their points and the rest
+    of the budget is shared among the others.
+
+    Parameters:
+        tracks (list): List of matcha.Track instances.
+        point_budget (int): Total number of points for the event.
+
+    Returns:
+        numpy.ndarray: Point budget of each track, shape (n_tracks,).
+    """
+    n_points = np.array([len(track.points) for track in tracks], dtype=np.int64)
+    budgets = np.zeros(len(tracks), dtype=np.int64)
+    remaining_budget = point_budget
+    remaining = np.ones(len(tracks), dtype=bool)
+    while remaining.any():
+        share = remaining_budget * n_points[remaining] / max(n_points[remaining].sum(), 1)
+        fits = remaining.copy()
+        fits[remaining] = n_points[remaining] <= share
+        if not fits.any():
+            budgets[remaining] = np.floor(share).astype(np.int64)
+            break
+        budgets[fits] = n_points[fits]
+        remaining_budget -= n_points[fits].sum()
+        remaining &= ~fits
+
+    return budgets
+
+def decimate_tracks(tracks, point_budget=DEFAULT_POINT_BUDGET, view_bounds=None):
+    """
+    Decimate the points of every track in an event to fit an event point budget.
+
+    Parameters:
+        tracks (list): List of matcha.Track instances.
+        point_budget (int, optional): Total number of points for the event.
+                                      Default: DEFAULT_POINT_BUDGET
+        view_bounds (numpy.ndarray, optional): See decimate_points. Default: None
+
+    Returns:
+        list: One (points, depositions) tuple per track.
+    """
+    track_budgets = get_track_point_budgets(tracks, point_budget)
+    return [decimate_points(track.points, track.depositions, track_budget, view_bounds)
+            for track, track_budget in zip(tracks, track_budgets)]
+
+def get_endpoint_glyphs(track_points, glyph_length=DIRECTION_GLYPH_LENGTH):
+    """
+    Build line segments showing the position and direction of track end points.
+
+    Parameters:
+        track_points (list): List of matcha.TrackPoint instances.
+        glyph_length (float, optional): Segment length in cm. Default: DIRECTION_GLYPH_LENGTH
+
+    Returns:
+        numpy.ndarray: Array of shape (n_valid_points, 2, 3) with the first and
+                       last point of each segment. Points without a direction
+                       estimate are skipped.
+    """
+    glyphs = []
+    for track_point in track_points:
+        if not track_point.is_valid(): continue
+        direction = np.array([track_point.direction_x, track_point.direction_y, track_point.direction_z], dtype=float)
+        if np.all(direction == INVALID_DIRECTION): continue
+        position = np.array([track_point.position_x, track_point.position_y, track_point.position_z], dtype=float)
+        glyphs.append([position, position + glyph_length * direction / np.linalg.norm(direction)])
+
+    return np.array(glyphs, dtype=float).reshape(-1, 2, 3)
+
+@functools.lru_cache(maxsize=None)
+def get_crt_wall_meshes(file_path=DEFAULT_CRT_GEOMETRY_PATH):
+    """
+    Build box meshes of the CRT walls. Results are cached per file path.
+
+    Parameters:
+        file_path (str, optional): Path to the CRT geometry csv file.
+                                   Default: DEFAULT_CRT_GEOMETRY_PATH
+
+    Returns:
+        list: One dictionary per wall with keys 'name', 'vertices' (shape (8, 3))
+              and 'triangles' (shape (12, 3)).
+    """
+    crt_geometry = load_crt_geometry(file_path)
+    wall_meshes = []
+    for name, mins, maxs in zip(crt_geometry['region_names'], crt_geometry['mins'], crt_geometry['maxs']):
+        wall_meshes.append({
+            'name': name,
+            'vertices': mins + BOX_CORNERS * (maxs - mins),
+            'triangles': BOX_TRIANGLES,
+        })
+    return wall_meshes
+
+def build_event_index(file_paths, index_path=None):
+    """
+    Record which image_ids each matcha output file contains, so that later
+    loads only unpickle the files holding the requested events.
+
+    Parameters:
+        file_paths (list): Paths to pickle files written by write_to_file.
+        index_path (str, optional): Where to save the index as json. Default: None
+                                    (not saved).
+
+    Returns:
+        dict: Dictionary mapping each file path to its sorted list of image_ids.
+    """
+    event_index = {}
+    for file_path in file_paths:
+        with open(file_path, 'rb') as file:
+            output_data = pickle.load(file)
+        event_index[file_path] = sorted({int(track.image_id) for track in output_data['tracks']})
+
+    if index_path is not None:
+        with open(index_path, 'w') as file:
+            json.dump(event_index, file)
+
+    return event_index
+
+def load_events(file_paths, image_ids, event_index=None):
+    """
+    Load the tracks, CRT hits and match candidates of the requested events.
+    Each opened file is unpickled whole; convert large outputs to a columnar
+    store and use load_store_events to only read the requested events.
+
+    Parameters:
+        file_paths (list): Paths to pickle files written by write_to_file.
+        image_ids (list): image_ids of the events to load.
+        event_index (dict or str, optional): Output of build_event_index, or the
+                                             path to its json file. Files not
+                                             listing a requested event are not
+                                             opened. Default: None (open all files).
+
+    Returns:
+        dict: Dictionary mapping each found image_id to a dictionary with keys
+              'tracks', 'crthits' and 'match_candidates'. CRT hits have no
+              image_id, so all hits of a file are attached to its events.
+    """
+    if isinstance(event_index, str):
+        with open(event_index, 'r') as file:
+            event_index = json.load(file)
+
+    requested_ids = set(int(image_id) for image_id in image_ids)
+    events = {}
+    for file_path in file_paths:
+        if event_index is not None and not requested_ids.intersection(event_index.get(file_path, [])):
+            continue
+        with open(file_path, 'rb') as file:
+            output_data = pickle.load(file)
+
+        file_tracks = {}
+        for track in output_data['tracks']:
+            image_id = int(track.image_id)
+            if image_id not in requested_ids: continue
+            file_tracks.setdefault(image_id, []).append(track)
+
+        for image_id, event_tracks in file_tracks.items():
+            event = events.setdefault(image_id, {'tracks': [], 'crthits': [], 'match_candidates': []})
+            track_ids = {track.id for track in event_tracks}
+            event['tracks'].extend(event_tracks)
+            event['crthits'].extend(output_data['crthits'])
+            event['match_candidates'].extend(match for match in output_data['match_candidates']
+                                             if match.track_id in track_ids)
+
+    return events
+
+def load_store_events(store_dir, image_ids):
+    """
+    Columnar store counterpart of load_events: only the track, point and
+    match rows of the requested events (and the CRT hits of their chunks) are
+    read from the memory-mapped columns.
+
+    Parameters:
+        store_dir (str): Directory of a store written by matcha.columnar_store.convert_to_store.
+        image_ids (list): image_ids of the events to load.
+
+    Returns:
+        dict: Same as load_events.
+    """
+    # Imported here, event_dataset is only needed for stores
+    from .event_dataset import EventDataset
+
+    event_dataset = EventDataset(store_dir)
+    requested_ids = set(int(image_id) for image_id in image_ids)
+    event_dataset = event_dataset.subset(np.flatnonzero(np.isin(event_dataset.event_image_ids,
+                                                                list(requested_ids))))
+
+    events = {}
+    for chunk_index, (image_id, tracks, crthits) in zip(event_dataset.event_chunks.tolist(), event_dataset):
+        match_image_ids = event_dataset.get_column(chunk_index, 'matches', 'image_ids')
+        match_rows = np.flatnonzero(match_image_ids == image_id)
+
+        def get_match_values(column):
+            return np.asarray(event_dataset.get_column(chunk_index, 'matches', column)[match_rows]).tolist()
+
+        event = events.setdefault(image_id, {'tracks': [], 'crthits': [], 'match_candidates': []})
+        event['tracks'].extend(tracks)
+        event['crthits'].extend(crthits)
+        event['match_candidates'].extend(MatchCandidate(track_id, crthit_id, dca) for track_id, crthit_id, dca
+                                         in zip(get_match_values('track_ids'), get_match_values('crthit_ids'),
+                                                get_match_values('dcas')))
+
+    return events
+
+def make_event_traces(tracks, crthits, match_candidates, point_budget=DEFAULT_POINT_BUDGET,
+                      view_bounds=None, track_points=None, geometry_path=DEFAULT_CRT_GEOMETRY_PATH):
+    """
+    Build decimated plotly traces for one event. As in visualizer.ipynb, the y
+    and z axes are swapped so that plotly shows the long detector axis as z.
+
+    Parameters:
+        tracks (list): List of matcha.Track instances.
+        crthits (list): List of matcha.CRTHit instances.
+        match_candidates (list): List of matcha.MatchCandidate instances.
+        point_budget (int, optional): Total number of track points. Default: DEFAULT_POINT_BUDGET
+        view_bounds (numpy.ndarray, optional): See decimate_points. Default: None
+        track_points (list, optional): TrackPoints to draw direction glyphs for, e.g. from
+                                       match_maker.get_track_endpoints (outputs only store
+                                       the end point positions). Default: None
+        geometry_path (str, optional): CRT geometry csv file. Default: DEFAULT_CRT_GEOMETRY_PATH
+
+    Returns:
+        list: List of plotly graph objects.
+    """
+    import plotly.graph_objs as go
+
+    matched_track_ids  = {match.track_id for match in match_candidates}
+    matched_crthit_ids = {match.crthit_id for match in match_candidates}
+
+    traces = []
+    for track, (points, depositions) in zip(tracks, decimate_tracks(tracks, point_budget, view_bounds)):
+        color = 'red' if track.id in matched_track_ids else 'lightslategrey'
+        traces.append(go.Scatter3d(x=points[:, 0], y=points[:, 2], z=points[:, 1], mode='markers',
+                                   marker=dict(size=1, color=color), name=f'Track ID {track.id}',
+                                   showlegend=False))
+
+    if crthits:
+        crthit_positions = np.array([[crthit.position_x, crthit.position_y, crthit.position_z] for crthit in crthits])
+        colors = ['red' if crthit.id in matched_crthit_ids else 'lightslategrey' for crthit in crthits]
+        traces.append(go.Scatter3d(x=crthit_positions[:, 0], y=crthit_positions[:, 2], z=crthit_positions[:, 1],
+                                   mode='markers', marker=dict(size=2, color=colors),
+                                   text=[f'CRT Hit ID {crthit.id}' for crthit in crthits], showlegend=False))
+
+    if track_points:
+        for glyph in get_endpoint_glyphs(track_points):
+            traces.append(go.Scatter3d(x=glyph[:, 0], y=glyph[:, 2], z=glyph[:, 1], mode='lines',
+                                       line=dict(color='black', width=4), showlegend=False))
+
+    for wall_mesh in get_crt_wall_meshes(geometry_path):
+        vertices, triangles = wall_mesh['vertices'], wall_mesh['triangles']
+        traces.append(go.Mesh3d(x=vertices[:, 0], y=vertices[:, 2], z=vertices[:, 1],
+                                i=triangles[:, 0], j=triangles[:, 1], k=triangles[:, 2],
+                                opacity=0.2, color='rgb(224, 255, 255)', hoverinfo='none',
+                                name=wall_mesh['name']))
+
+    return traces
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# Run the tests against the source tree when matcha is not installed
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+if SOURCE_DIR not in sys.path:
+    sys.path.insert(0, SOURCE_DIR)
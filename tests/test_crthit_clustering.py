@@ -0,0 +1,45 @@
+import numpy as np
+from matcha.crthit import CRTHit
+from matcha.harness import generate_events
+from matcha.readers import get_event_buffers
+from matcha.crthit_clustering import cluster_crthits, cluster_crthit_buffers
+"""
+Check that CRT hit buffers are clustered like CRTHit objects.
+"""
+
+N_EVENTS = 4
+MAX_DUPLICATES = 3
+
+def get_duplicated_events(seed=0):
+    random = np.random.default_rng(seed)
+    events = []
+    for image_id, tracks, crthits in generate_events(N_EVENTS, seed=seed):
+        duplicated_crthits = list(crthits)
+        for crthit in crthits:
+            for copy_index in range(random.integers(MAX_DUPLICATES)):
+                duplicated_crthits.append(CRTHit(
+                    crthit.id + 10_000*(copy_index + 1), crthit.t0_sec + random.integers(2),
+                    crthit.t0_ns + random.uniform(-5, 5), crthit.t1_ns,
+                    crthit.position_x + random.uniform(-3, 3), crthit.position_y + random.uniform(-3, 3),
+                    crthit.position_z, total_pe=float(random.choice([-1, 3, 5])), plane=crthit.plane
+                ))
+        random.shuffle(duplicated_crthits)
+        events.append((image_id, tracks, duplicated_crthits))
+    return events
+
+def test_buffers_clustered_like_objects():
+    events = get_duplicated_events()
+    object_stats, buffer_stats = {}, {}
+    clustered_events = [(image_id, tracks, cluster_crthits(crthits, stats=object_stats))
+                        for image_id, tracks, crthits in events]
+    expected_buffers = get_event_buffers(clustered_events)[1]
+    clustered_buffers = cluster_crthit_buffers(get_event_buffers(events)[1], stats=buffer_stats)
+
+    assert object_stats['n_crthit_clusters'] < object_stats['n_crthits']
+    assert buffer_stats == object_stats
+    for key, values in expected_buffers.items():
+        np.testing.assert_array_equal(clustered_buffers[key], values, err_msg=key)
+
+def test_different_seconds_not_clustered():
+    crthits = [CRTHit(0, 100, 500, 0, 0, 0, 0), CRTHit(1, 101, 505, 0, 0, 0, 0), CRTHit(2, 100, 510, 0, 0, 0, 0)]
+    assert [crthit.id for crthit in cluster_crthits(crthits)] == [0, 1]
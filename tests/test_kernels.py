@@ -0,0 +1,61 @@
+import copy
+import numpy as np
+import pytest
+from matcha.loader import load_config
+from matcha.crt_geometry import MATCHA_DIR
+from matcha.harness import load_recorded_events, generate_events
+from matcha.track import get_points_in_radius_mask
+from matcha.kernels import (is_numba_available, validate_kernels, radius_density_numba,
+                            KERNEL_TOLERANCE)
+"""
+Compare the Numba kernels with the NumPy path they replace.
+"""
+
+CONFIG_PATH = '{:s}/config/default.yaml'.format(MATCHA_DIR)
+
+pytestmark = pytest.mark.skipif(not is_numba_available(), reason='numba is not installed')
+
+PRECISIONS = ['native', 'float32']
+N_GENERATED_EVENTS = 5
+N_DENSITY_CENTERS = 20
+DENSITY_RADII = [1., 10., 50.]
+# Relative tolerance on the deposition sums, which numpy adds pairwise in the
+# deposition dtype while the kernel adds them one by one in double precision
+DENSITY_RTOL = {np.dtype(np.float64): 1e-12, np.dtype(np.float32): 1e-5}
+
+@pytest.fixture(scope='module', params=['recorded', 'generated'])
+def events(request):
+    if request.param == 'recorded':
+        return load_recorded_events()
+    return generate_events(N_GENERATED_EVENTS, seed=1)
+
+def get_config(precision):
+    config = copy.deepcopy(load_config(CONFIG_PATH, check_paths=False))
+    config['dca_parameters']['precision'] = precision
+    config['pca_parameters']['precision'] = precision
+    return config
+
+@pytest.mark.parametrize('precision', PRECISIONS)
+def test_dca_kernels_agree(events, precision):
+    config = get_config(precision)
+    for _, tracks, crthits in events:
+        results = validate_kernels(tracks, crthits, config)
+        assert results['max_endpoint_deviation'] <= KERNEL_TOLERANCE
+        assert results['max_dca_deviation'] <= KERNEL_TOLERANCE
+        assert results['n_infinite_mismatches'] == 0
+        assert results['n_match_mismatches'] == 0
+
+@pytest.mark.parametrize('precision', PRECISIONS)
+def test_radius_density_kernels_agree(events, precision):
+    random = np.random.default_rng(0)
+    for _, tracks, _ in events:
+        for track in copy.deepcopy(tracks):
+            track.set_precision(precision)
+            points, depositions = track.points, track.depositions
+            if len(points) == 0: continue
+            for center in points[random.integers(len(points), size=N_DENSITY_CENTERS)]:
+                for radius in DENSITY_RADII:
+                    mask = get_points_in_radius_mask(center, points, radius)
+                    n_points_in_radius, density = radius_density_numba(center, points, depositions, radius)
+                    assert n_points_in_radius == np.sum(mask)
+                    assert density == pytest.approx(np.sum(depositions[mask]), rel=DENSITY_RTOL[depositions.dtype])
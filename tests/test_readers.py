@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+from matcha import readers
+from matcha.harness import generate_events
+from matcha.loader import load_config
+from matcha.crt_geometry import MATCHA_DIR
+"""
+Check that chunked reads keep every event in a single chunk.
+"""
+
+pytest.importorskip('h5py')
+pytest.importorskip('pyarrow')
+
+CONFIG_PATH = '{:s}/config/default.yaml'.format(MATCHA_DIR)
+N_EVENTS = 12
+CHUNK_SIZES = [1, 5, 33, 1000]
+
+@pytest.fixture(scope='module')
+def event_files(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('readers')
+    events = generate_events(N_EVENTS, n_tracks=4, n_crthits=15, n_points=50, seed=2)
+    # An event without tracks, whose CRT hits are never yielded with tracks
+    events[3] = (events[3][0], [], events[3][2])
+    track_buffers, crthit_buffers = readers.get_event_buffers(events)
+    readers.write_hdf5_tracks(str(directory / 'tracks.h5'), track_buffers)
+    readers.write_parquet_crthits(str(directory / 'crthits.parquet'), crthit_buffers)
+    return events, str(directory / 'tracks.h5'), str(directory / 'crthits.parquet')
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+def test_crthit_chunks_end_on_events(event_files, chunk_size):
+    _, _, crthit_path = event_files
+    chunks = list(readers.iter_parquet_crthit_chunks(crthit_path, chunk_size))
+    chunk_image_ids = [set(chunk['image_ids'].tolist()) for chunk in chunks]
+    assert sum(len(image_ids) for image_ids in chunk_image_ids) == len(set.union(*chunk_image_ids))
+    assert sum(len(chunk['ids']) for chunk in chunks) == len(readers.read_parquet_crthits(crthit_path)['ids'])
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+def test_event_chunks_pair_tracks_and_hits(event_files, chunk_size):
+    events, track_path, crthit_path = event_files
+    n_crthits = {image_id: len(crthits) for image_id, tracks, crthits in events if tracks}
+    chunk_n_crthits = {}
+    for track_buffers, crthit_buffers in readers.iter_event_chunks(track_path, crthit_path, chunk_size,
+                                                                   crthit_chunk_size=chunk_size):
+        assert set(crthit_buffers['image_ids'].tolist()) <= set(track_buffers['image_ids'].tolist())
+        for image_id in set(track_buffers['image_ids'].tolist()):
+            assert image_id not in chunk_n_crthits
+            chunk_n_crthits[image_id] = int(np.sum(crthit_buffers['image_ids'] == image_id))
+    assert chunk_n_crthits == n_crthits
+
+def test_event_chunks_need_sorted_files(event_files, tmp_path):
+    events, track_path, _ = event_files
+    crthit_buffers = readers.get_event_buffers(events[::-1])[1]
+    crthit_path = str(tmp_path / 'reversed.parquet')
+    readers.write_parquet_crthits(crthit_path, crthit_buffers)
+    with pytest.raises(ValueError):
+        list(readers.iter_event_chunks(track_path, crthit_path, crthit_chunk_size=5))
+
+def test_validate_readers(event_files, tmp_path):
+    events, _, _ = event_files
+    report = readers.validate_readers(events, load_config(CONFIG_PATH, check_paths=False), str(tmp_path), 5)
+    assert report['passed'], report
+    assert report['n_event_chunks'] > 1
@@ -0,0 +1,82 @@
+import os
+import shutil
+import pickle
+import pytest
+from matcha import cli
+from matcha.crt_geometry import MATCHA_DIR
+from matcha.harness import generate_events
+from matcha.writer import write_to_file
+from matcha.sharding import load_manifest, get_shard_status, get_shard_file_name, merge_shards
+"""
+Run a small sharded job locally, break its outputs and recover from it.
+"""
+
+CONFIG_PATH = '{:s}/config/default.yaml'.format(MATCHA_DIR)
+SOURCE_DIR = os.path.join(MATCHA_DIR, 'src')
+N_FILES = 2
+N_EVENTS_PER_FILE = 3
+N_SHARDS = 3
+
+@pytest.fixture
+def sharded_job(tmp_path, monkeypatch):
+    # The run-local processes import matcha from the source tree
+    monkeypatch.setenv('PYTHONPATH', os.pathsep.join(filter(None, [SOURCE_DIR, os.environ.get('PYTHONPATH')])))
+    events = generate_events(N_FILES * N_EVENTS_PER_FILE, n_tracks=3, n_crthits=10, n_points=100)
+    input_files = []
+    for file_index in range(N_FILES):
+        file_events = events[file_index * N_EVENTS_PER_FILE:(file_index + 1) * N_EVENTS_PER_FILE]
+        file_name = 'input_{:d}.pkl'.format(file_index)
+        write_to_file([track for _, tracks, _ in file_events for track in tracks],
+                      [crthit for _, _, crthits in file_events for crthit in crthits],
+                      file_path=str(tmp_path), file_name=file_name)
+        input_files.append(str(tmp_path / file_name))
+
+    manifest_path = str(tmp_path / 'manifest.json')
+    assert cli.main(['manifest', '--config', CONFIG_PATH, '--n-shards', str(N_SHARDS), '--output', manifest_path,
+                     '--mode', 'event'] + input_files) == 0
+    return tmp_path, manifest_path
+
+def merge(tmp_path, manifest_path, file_name):
+    assert cli.main(['merge', manifest_path, str(tmp_path / 'shards'), '--file-path', str(tmp_path),
+                     '--file-name', file_name]) == 0
+    with open(tmp_path / file_name, 'rb') as file:
+        output_data = pickle.load(file)
+    return [(candidate.track_id, candidate.crthit_id, candidate.distance_of_closest_approach)
+            for candidate in output_data['match_candidates']]
+
+def test_sharded_job_recovers(sharded_job):
+    tmp_path, manifest_path = sharded_job
+    output_dir = str(tmp_path / 'shards')
+    manifest = load_manifest(manifest_path)
+    shard_paths = [os.path.join(output_dir, get_shard_file_name(manifest, i)) for i in range(N_SHARDS)]
+
+    assert cli.main(['run-local', manifest_path, output_dir]) == 0
+    assert cli.main(['status', manifest_path, output_dir]) == 0
+    expected_matches = merge(tmp_path, manifest_path, 'expected.pkl')
+    assert expected_matches
+
+    # A deleted and a corrupted output are missing, and the corrupted one has failed
+    os.remove(shard_paths[0])
+    with open(shard_paths[1], 'wb') as file:
+        file.write(b'not a pickle')
+    status = get_shard_status(manifest, output_dir)
+    assert status['missing'] == [0, 1]
+    assert status['failed'] == [shard_paths[1]]
+    assert cli.main(['status', manifest_path, output_dir]) == 1
+    with pytest.raises(ValueError):
+        merge_shards(manifest_path, output_dir, str(tmp_path), 'broken.pkl')
+
+    # Only the broken shards are run again
+    modification_time = os.path.getmtime(shard_paths[2])
+    assert cli.main(['run-local', manifest_path, output_dir]) == 0
+    assert os.path.getmtime(shard_paths[2]) == modification_time
+    status = get_shard_status(manifest, output_dir)
+    assert (status['missing'], status['duplicated'], status['failed']) == ([], [], [])
+    assert merge(tmp_path, manifest_path, 'recovered.pkl') == expected_matches
+
+    # A copied output duplicates its shard
+    shutil.copy(shard_paths[2], shard_paths[2].replace('.pkl', '_copy.pkl'))
+    assert get_shard_status(manifest, output_dir)['duplicated'] == [2]
+    assert cli.main(['status', manifest_path, output_dir]) == 1
+    with pytest.raises(ValueError):
+        merge_shards(manifest_path, output_dir, str(tmp_path), 'duplicated.pkl')